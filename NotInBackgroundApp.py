@@ -1,8 +1,6 @@
 import os
 import json
 import numpy as np
-import bokeh.plotting
-import bokeh.models
 import twolocus
 
 import TwoLocusWebHelper as helper
@@ -17,7 +15,7 @@ this_file = "NotInBackgroundDev"
 
 
 def indexPage(form):
-    tl = twolocus.TwoLocus('/csbiodata/public/www.csbio.unc.edu/htdocs/sgreens/pairwise_origins/')
+    available = helper.available_strains()
     panel = markup.page()
     helper.link_css_and_js(panel)
     panel.div(style="padding:20px 20px;")
@@ -31,9 +29,9 @@ def indexPage(form):
     panel.form(_class="form-horizontal", action="", method="POST", enctype="multipart/form-data")
     panel.div(_class="control-group")
     panel.h3('Background Samples')
-    has_bg_strains = helper.strain_set_selector(panel, tl, 'background')
+    has_bg_strains = helper.strain_set_selector(panel, available, 'background')
     panel.h3('Foreground Samples')
-    has_fg_strains = helper.strain_set_selector(panel, tl, 'foreground')
+    has_fg_strains = helper.strain_set_selector(panel, available, 'foreground')
     panel.script("""$(".chosen").chosen()""", type="text/javascript")
     panel.script('''$("form").submit(function () {return %s() && %s();});''' % (has_bg_strains, has_fg_strains),
                  type="text/javascript")
@@ -48,11 +46,14 @@ def indexPage(form):
 
 
 def visualizationResponse(form):
+    # imported by the pages which plot, as bokeh is slow to import
+    import bokeh.plotting
+    import bokeh.models
     panel = markup.page()
     radio_buttons(panel)
     plot_file = 'not_in_background.html'
     bokeh.plotting.output_file(plot_file)
-    tl = twolocus.TwoLocus('/csbiodata/public/www.csbio.unc.edu/htdocs/sgreens/pairwise_origins/')
+    tl = helper.two_locus()
     panel.script(type="text/javascript")
     panel.add('var offsets = ' + json.dumps(tl.offsets, cls=helper.NumpyEncoder) + ';')
     panel.add('var sizes = ' + json.dumps(tl.sizes, cls=helper.NumpyEncoder) + ';')
@@ -92,8 +93,18 @@ def visualizationResponse(form):
     plot.axis.visible = False
     plot.grid.grid_line_color = None
     chrom_source = plot_chroms(plot, tl)
+    # each combo's rows are contiguous, and within them each chromosome pair's
+    # a module function of the offsets, as tl may be a TwoLocus or a client of the query service
+    layout = twolocus.group_by_chromosome_pair(data, colors, tl.offsets)
+    num_pairs = len(tl.sizes) ** 2
+    pair_index = [(layout['index'][i * num_pairs:(i + 1) * num_pairs + 1] - layout['index'][i * num_pairs]).tolist()
+                  for i in xrange(len(colors))]
+    panel.script('var pair_index = %s;' % json.dumps(pair_index), type="text/javascript")
     combo_sources = []
-    for i, (combo_data, color) in enumerate(zip(data, colors)):
+    for i, color in enumerate(colors):
+        rows = slice(layout['index'][i * num_pairs], layout['index'][(i + 1) * num_pairs])
+        combo_data = [layout['columns'][name][rows] for name in ('prox_start', 'prox_end', 'dist_start', 'dist_end')]
+        combo_data.append(layout['columns']['sample'][rows].tolist())
         width = np.subtract(combo_data[1], combo_data[0])
         height = np.subtract(combo_data[3], combo_data[2])
         combo_sources.append(bokeh.models.ColumnDataSource(data=dict(
@@ -219,29 +230,21 @@ def visualizationResponse(form):
     offset_proximal = function (position) {
                         return position - offsets[distal - 1];
                 };
-    while (data.proximal_start[i] < offsets[proximal - 1]) {
-        i++;  // get through data before proximal chrom
+    // rows of the chromosome pair, from the combo's pair index
+    var pair = (proximal - 1) * sizes.length + distal - 1;
+    start_index = pair_index[getActiveCombo()][pair];
+    i = pair_index[getActiveCombo()][pair + 1];
+    for (var j = 0; j < 3; j++) {
+        field = fields[j];
+        inset_data[field] = data[field].slice(start_index, i).map(offset_distal);
     }
-    while (data.proximal_start[i] < offsets[proximal]) {
-        while (data.distal_start[i] < offsets[distal - 1] || data.distal_start[i] > offsets[distal]) {
-            i++;  // get through data before/after distal chrom
-        }
-        start_index = i;
-        while (data.proximal_start[i] < offsets[proximal] && data.distal_start[i] < offsets[distal]) {
-            i++;  // get through data for this chrom pair
-        }
-        for (var j = 0; j < 3; j++) {
-            field = fields[j];
-            inset_data[field] = inset_data[field].concat(data[field].slice(start_index, i).map(offset_distal));
-        }
-        for (var j = 3; j < 6; j++) {
-            field = fields[j];
-            inset_data[field] = inset_data[field].concat(data[field].slice(start_index, i).map(offset_proximal));
-        }
-        for (var j = 6; j < 9; j++) {
-            field = fields[j];
-            inset_data[field] = inset_data[field].concat(data[field].slice(start_index, i));
-        }
+    for (var j = 3; j < 6; j++) {
+        field = fields[j];
+        inset_data[field] = data[field].slice(start_index, i).map(offset_proximal);
+    }
+    for (var j = 6; j < 9; j++) {
+        field = fields[j];
+        inset_data[field] = data[field].slice(start_index, i);
     }
 
     // update labels
@@ -297,6 +300,7 @@ def button_callbacks(panel):
 
 
 def plot_chroms(plot, tl):
+    import bokeh.models
     chrom_data = dict(
         x=[],
         y=[],
@@ -39,7 +39,7 @@ def parse_position(string):
 
 
 def indexPage(form):
-    tl = twolocus.TwoLocus('/csbiodata/public/www.csbio.unc.edu/htdocs/sgreens/pairwise_origins/')
+    available = helper.available_strains()
     panel = markup.page()
     helper.link_css_and_js(panel)
     panel.div(style="padding:20px 20px;")
@@ -53,7 +53,7 @@ def indexPage(form):
     panel.form(_class="form-horizontal", action="", method="POST", enctype="multipart/form-data")
     panel.div(_class="control-group")
     panel.h3('Set of Samples')
-    has_strains = helper.strain_set_selector(panel, tl)
+    has_strains = helper.strain_set_selector(panel, available)
     for pos_num in ('1', '2'):
         panel.h3('Position ' + pos_num)
         helper.open_control(panel, 'Chromosome')
@@ -80,7 +80,7 @@ def indexPage(form):
     panel.div.close()
     chromo_sizes = {}
     for string, integer in twolocus.CHROMO_TO_INT.iteritems():
-        chromo_sizes[string] = tl.sizes[integer-1]
+        chromo_sizes[string] = twolocus.CHROMO_SIZES[integer-1]
     panel.script('''
     var chromoSizes = %s;
     ''' % json.dumps(chromo_sizes), type="text/javascript")
@@ -136,7 +136,7 @@ def countMatrixResponse(form):
     :return: json encoding of combo counts and interval bounds
     """
     # print "content-type: text/json\n"
-    tl = twolocus.TwoLocus('/csbiodata/public/www.csbio.unc.edu/htdocs/sgreens/pairwise_origins/')
+    tl = helper.two_locus()
     strains = []
     for _, _, value, _ in helper.STRAIN_SETS:
         new_strains = form.getvalue(value)
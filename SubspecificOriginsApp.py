@@ -1,13 +1,11 @@
 import os
-import json
 import numpy as np
-import bokeh.plotting
-import bokeh.models
 
 import TwoLocusWebHelper as helper
 
 if __name__ != '__main__':
     from pairwise_origins import twolocus
+    from pairwise_origins import jsonStream
     import WikiApp
     import markup
     from markup import oneliner as element
@@ -17,7 +15,7 @@ this_file = os.path.basename(__file__).replace('App.pyc', '')
 
 
 def indexPage(form):
-    tl = twolocus.TwoLocus('/csbiodata/public/www.csbio.unc.edu/htdocs/sgreens/pairwise_origins/')
+    available = helper.available_strains()
     panel = markup.page()
     helper.link_css_and_js(panel)
     panel.div(style="padding:20px 20px;")
@@ -31,7 +29,7 @@ def indexPage(form):
     panel.form(_class="form-horizontal", action="", method="POST", enctype="multipart/form-data")
     panel.div(_class="control-group")
     panel.h3('Set of Samples')
-    has_strains = helper.strain_set_selector(panel, tl)
+    has_strains = helper.strain_set_selector(panel, available)
     panel.script(type="text/javascript")
     panel.add("""$(".chosen").chosen()""")
     panel.script.close()
@@ -47,12 +45,15 @@ def indexPage(form):
 
 
 def originsVisualizationResponse(form):
+    # imported by the pages which plot, as bokeh is slow to import
+    import bokeh.plotting
+    import bokeh.models
     # print "content-type: text/json\n"
     coarse_cutoff = 1e7
     panel = markup.page()
     plot_file = 'ss_origins.html'
     bokeh.plotting.output_file(plot_file)
-    tl = twolocus.TwoLocus('/csbiodata/public/www.csbio.unc.edu/htdocs/sgreens/pairwise_origins/')
+    tl = helper.two_locus()
     strains = []
     for _, _, value, _ in helper.STRAIN_SETS:
         new_strains = form.getvalue(value)
@@ -131,7 +132,7 @@ def originsVisualizationResponse(form):
     with open(plot_file) as fp:
         panel.add(fp.read())
     return panel
-    helper.visualize_genome(data, tl, len(strains))
+    helper.visualize_genome(helper.query_tile(tl, 'pairwise_frequencies', strain_names=strains), tl, len(strains))
     # print json.dumps(data, cls=helper.NumpyEncoder)
 
 
@@ -141,31 +142,28 @@ def to_rect(prox_start, prox_end, dist_start, dist_end):
     return prox_start + width/2, dist_start + height/2, width, height
 
 
-def json_data_by_chrom(data, panel, tl, var_name):
-    """
-    :param data: array of (x, y, width, height)
+def json_data_by_chrom(layout, panel, tl, var_name):
+    """ Writes the rectangles of a result to the page, indexed by combo, proximal chromosome and distal chromosome
+    :param layout: result laid out by twolocus.group_by_chromosome_pair()
     :param panel: panel for writing to output webpage
-    :param tl: twolocus instance
-    :param var_name: what to call the json object in which the data is stored
+    :param tl: twolocus instance or client of the query service
+    :param var_name: what to call the json object in which the data is stored, whose [combo][i][j] is the list of
+    (x, y, width, height) on proximal chromosome i and distal chromosome j, counting from 0
     """
-    data_index = 0
+    columns = [layout['columns'][name] for name in ('prox_start', 'prox_end', 'dist_start', 'dist_end')]
     data_by_chrom = []
-    for combo_num, combo_data in data:
-        i = 1
+    for combo in xrange(len(layout['colors'])):
         data_by_chrom.append([])
-        while i < len(tl.sizes):
-            j = 1
-            data_by_chrom[combo_num].append([])
-            while data[data_index][0] < tl.offsets[i]:
-                data_by_chrom[combo_num][i].append([])
-                while data[data_index][1] < tl.offsets[j]:
-                    data_by_chrom[combo_num][i][j].append(to_rect(*data[data_index]))
-                    data_index += 1
-                j += 1
-            i += 1
+        for i in xrange(len(tl.sizes)):
+            data_by_chrom[combo].append([])
+            for j in xrange(len(tl.sizes)):
+                rows = twolocus.chromosome_pair_rows(layout, i, j, combo)
+                data_by_chrom[combo][i].append(np.column_stack(to_rect(*[column[rows] for column in columns])))
     panel.script(type="text/javascript")
     panel.add('var %s = ' % var_name)
-    panel.add(json.dumps(data_by_chrom))
+    # encoded from the arrays a block of rows at a time, rather than from lists of every row
+    for chunk in jsonStream.iterencode(data_by_chrom):
+        panel.add(chunk)
     panel.add(';')
     panel.script.close()
 
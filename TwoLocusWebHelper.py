@@ -1,16 +1,19 @@
 import numpy as np
 import json
+import base64
+import logging
+import sys
 from pairwise_origins import twolocus
-import pyximport
-pyximport.install()
-from pairwise_origins import subspeciesCython as subspecies
+# whichever of the compiled or pure python module twolocus found
+subspecies = twolocus.subspecies
 
 with open('../sgreens/pairwise_origins/strain_sets.json') as fp:
     STRAIN_SETS = json.load(fp)
 
 
 class NumpyEncoder(json.JSONEncoder):
-    """ Converts numpy dtypes to the native python equivalent to enable json serialization
+    """ Converts numpy dtypes to the native python equivalent to enable json serialization of small values.  Results
+    are encoded a chunk at a time from their arrays by jsonStream.iterencode()
     """
     def default(self, o):
         if isinstance(o, np.integer):
@@ -23,6 +26,89 @@ class NumpyEncoder(json.JSONEncoder):
             return super(NumpyEncoder, self).default(o)
 
 
+def two_locus():
+    """ Connects to the query service (see queryService.py), or loads the sample dictionary in this process if the
+    service isn't running
+    :return: QueryClient or TwoLocus instance
+    """
+    # imported on first use, so that importing this module stays cheap
+    from pairwise_origins import queryService
+    from pairwise_origins import stageTimer
+    if stageTimer.ENABLED:
+        stageTimer.start(None)
+    try:
+        return queryService.QueryClient()
+    except IOError:
+        return twolocus.TwoLocus(queryService.DATA_PATH)
+
+
+def available_strains():
+    """ Strains to offer on pages which only pick strains, read from the header of the sample store if it's current
+    rather than by loading the sample dictionary or connecting to the query service
+    :return: set of strain names
+    """
+    from pairwise_origins import queryService
+    strains = twolocus.available_strains(queryService.DATA_PATH)
+    if strains is None:
+        strains = two_locus().list_available_strains()
+    return set(strains)
+
+
+def query_tile(tl, query, address=None, **kwargs):
+    """ Gets a tile of the result of a query to be visualized, from the query service's cache if connected to one,
+    else by running the query
+    :param tl: QueryClient or TwoLocus instance
+    :param query: name of the TwoLocus method
+    :param address: (level, proximal chromosome, distal chromosome, x, y), see tiles.py, default the whole genome
+    :param kwargs: keyword arguments of the query
+    :return: payload of the tile
+    """
+    from pairwise_origins import queryService
+    from pairwise_origins import columnar
+    from pairwise_origins import tiles
+    from pairwise_origins import stageTimer
+    if address is None:
+        address = tiles.GENOME_TILE
+    if stageTimer.ENABLED:
+        stageTimer.start(query)
+    if isinstance(tl, queryService.QueryClient):
+        with stageTimer.stage('service request'):
+            return tl.tile(query, address, **kwargs)
+    columns, header = columnar.layout_columns(query, getattr(tl, query)(by_chromosome_pair=True, **kwargs))
+    return tiles.Pyramid(columns, header, tl.offsets).tile(*address)
+
+
+def finish_trace():
+    """ Ends the trace of a query started by query_tile(), logging its report (see stageTimer.py)
+    :return: report, or None if queries aren't traced
+    """
+    from pairwise_origins import stageTimer
+    report = stageTimer.finish()
+    if report is not None:
+        logging.info('stages %s', json.dumps(report))
+    return report
+
+
+def tile_request(form, target):
+    """ Fields for the visualization to post to get further tiles of the same query
+    :param form: form of the query
+    :param target: name of the response function sending tiles, e.g. 'UniqueCombinations.tile'
+    :return: dictionary of field values
+    """
+    fields = {key: form.getvalue(key) for key in form.keys() if key not in ('submit', 'tile')}
+    fields['target'] = target
+    return fields
+
+
+def send_tile(data):
+    """ Responds with a tile
+    :param data: payload of the tile
+    """
+    finish_trace()
+    print "content-type: application/octet-stream\n"
+    sys.stdout.write(data)
+
+
 def open_control(panel, name):
     panel.div(_class="control-group")
     panel.label(_class="control-label")
@@ -56,7 +142,13 @@ def link_css_and_js(panel):
     panel.link(rel="stylesheet", type="text/css", href="../sgreens/pairwise_origins/all.css")
 
 
-def strain_set_selector(panel, tl, set_id=''):
+def strain_set_selector(panel, available, set_id=''):
+    """ Adds selectors of the available strains of each strain set
+    :param panel: markup page
+    :param available: collection of available strain names, as returned by available_strains()
+    :param set_id: suffix of the selectors' names, distinguishing several sets of strains on a page
+    :return: name of the javascript function checking that strains are selected
+    """
     validation_func = "hasSelectedStrains" + set_id
     panel.script('''
     function %s (event) {
@@ -90,7 +182,7 @@ def strain_set_selector(panel, tl, set_id=''):
             panel.add("""<select data-placeholder=%s name=%s multiple="multiple" class="chosen %s">""" %
                       (text, value + set_id, set_id))
             for strain in strains:
-                if tl.is_available(strain):
+                if strain in available:
                     panel.option(strain, value=strain)
             panel.add('</select>')
             panel.div.close()
@@ -161,17 +253,27 @@ def select_all_buttons(panel):
     panel.script.close()
 
 
-def visualize_genome(data, tl, num_samples=None):
+def visualize_genome(data, tl, num_samples=None, tile_fields=None):
     """ Creates the pairwise genome visualization
-    :param data: data to visualize
+    :param data: whole genome tile of the result to visualize, as returned by query_tile()
     :param tl: twolocus instance
+    :param num_samples: number of strains whose subspecific origins are shown, None for other results
+    :param tile_fields: form fields to post for further tiles, as returned by tile_request(), or None to show
+        only the whole genome tile
     """
+    from pairwise_origins import stageTimer
+    with stageTimer.stage('serialization'):
+        encoded = base64.b64encode(data)
+    report = finish_trace()
     print "content-type: text/html\n"
     print '''
 <!DOCTYPE html>
 <meta charset="utf-8">
 <div style="text-align: center">
-<svg class="chart" style="display: inline-block;"></svg>
+<div style="position: relative; display: inline-block;">
+<canvas class="rects" style="position: absolute; left: 0; top: 0;"></canvas>
+<svg class="chart" style="position: relative; display: block;"></svg>
+</div>
 </div>
 <div id="slider"></div>
 <button id="zoomout">Zoom out</button>
@@ -182,13 +284,16 @@ def visualize_genome(data, tl, num_samples=None):
 <script src="../sgreens/pairwise_origins/d3-zoom-pan-extent.js"></script>
 <script type=text/javascript>
 var is_ss_origins = false;
-var all_data = %s;
+var payload = "%s";
+var tile_request = %s;
 var chrom_offsets = %s;
 var chrom_sizes = %s;
-var chrom_names = %s
+var chrom_names = %s;
+var stage_report = %s;
 </script>
-    ''' % (data, json.dumps(tl.offsets, cls=NumpyEncoder), json.dumps(tl.sizes, cls=NumpyEncoder),
-           json.dumps(twolocus.INT_TO_CHROMO[1:-1]))
+    ''' % (encoded, json.dumps(tile_fields), json.dumps(tl.offsets, cls=NumpyEncoder),
+           json.dumps(tl.sizes, cls=NumpyEncoder),
+           json.dumps(twolocus.INT_TO_CHROMO[1:-1]), json.dumps(report))
     if num_samples is not None:
         subspecies_names = [subspecies.to_string(ss) for ss in subspecies.iter_subspecies()]
         print '''
@@ -14,7 +14,7 @@ this_file = os.path.basename(__file__).replace('App.pyc', '')
 
 
 def indexPage(form):
-    tl = twolocus.TwoLocus('/csbiodata/public/www.csbio.unc.edu/htdocs/sgreens/pairwise_origins/')
+    available = helper.available_strains()
     panel = markup.page()
     helper.link_css_and_js(panel)
     panel.div(style="padding:20px 20px;")
@@ -28,9 +28,9 @@ def indexPage(form):
     panel.form(_class="form-horizontal", action="", method="POST", enctype="multipart/form-data")
     panel.div(_class="control-group")
     panel.h3('Background Samples')
-    has_bg_strains = helper.strain_set_selector(panel, tl, 'background')
+    has_bg_strains = helper.strain_set_selector(panel, available, 'background')
     panel.h3('Foreground Samples')
-    has_fg_strains = helper.strain_set_selector(panel, tl, 'foreground')
+    has_fg_strains = helper.strain_set_selector(panel, available, 'foreground')
     panel.script("""$(".chosen").chosen()""", type="text/javascript")
     panel.script('''$("form").submit(function () {return %s() && %s();});''' % (has_bg_strains, has_fg_strains),
                  type="text/javascript")
@@ -44,9 +44,10 @@ def indexPage(form):
     return panel
 
 
-def uniqueCombosResponse(form):
-    # print "content-type: text/json\n"
-    tl = twolocus.TwoLocus('/csbiodata/public/www.csbio.unc.edu/htdocs/sgreens/pairwise_origins/')
+def query_strains(form):
+    """
+    :return: keyword arguments of unique_combos for the strains selected in form
+    """
     strains = [[], []]
     for set_num, set_id in enumerate(['background', 'foreground']):
         for _, _, value, _ in helper.STRAIN_SETS:
@@ -55,8 +56,14 @@ def uniqueCombosResponse(form):
                 strains[set_num] += new_strains
             elif new_strains is not None:
                 strains[set_num].append(new_strains)
+    return {'background_strains': strains[0], 'foreground_strains': strains[1]}
+
+
+def uniqueCombosResponse(form):
+    # print "content-type: text/json\n"
+    tl = helper.two_locus()
     # print '\n'.join(hex(line[0]) + ' ' + ' '.join(map(str, line[1:])) for line in tl.unique_combos(strains[0], strains[1]))
-    data = json.dumps(tl.unique_combos(strains[0], strains[1]), cls=helper.NumpyEncoder)
+    data = helper.query_tile(tl, 'unique_combos', **query_strains(form))
     # with open('unique.json', "w+") as fp:
     # with open('unique.json', "r") as fp:
         # json.dump(tl.unique_combos(strains[0], strains[1]), fp, cls=helper.NumpyEncoder)
@@ -68,7 +75,14 @@ def uniqueCombosResponse(form):
     # print "content-type: text/html\n"
     # with open('../sgreens/pairwise_origins/pairwiseGenome.html') as fp:
     #     print fp.read()<!DOCTYPE html>
-    helper.visualize_genome(data, tl)
+    helper.visualize_genome(data, tl, tile_fields=helper.tile_request(form, '%s.tile' % this_file))
+
+
+def tileResponse(form):
+    """ Sends a tile of the result, as the visualization zooms in
+    """
+    tl = helper.two_locus()
+    helper.send_tile(helper.query_tile(tl, 'unique_combos', json.loads(form.getvalue('tile')), **query_strains(form)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+"""
+File: benchmark.py
+Purpose: Reproducible timings of TwoLocus queries on synthetic panels, so that performance changes can be compared
+        from run to run on one machine.  Panels are generated from a seed over the real CHROMO_SIZES (see
+        synthetic_panel()), and every operation is timed on panels of each number of strains in a sweep, with the
+        stages of its last run (see stageTimer.py).
+        python benchmark.py --strains 4 8 16 32 --breakpoints 3 --repeat 3 --output before.json
+        python benchmark.py --compare before.json after.json
+        With --backend, the queries count with that backend rather than the one TwoLocus.plan_counting() chooses.
+        Results are JSON:
+            {"config": {arguments}, "machine": {"platform", "python", "numpy", "cpus"},
+             "results": [{"operation", "strains", "elementary_intervals", "seconds": [per run], "median",
+                          "stages"}, ...]}
+        with "error" in place of timings for an operation which raised.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import stageTimer
+import twolocus
+# whichever of the compiled or pure python module twolocus found
+subspecies = twolocus.subspecies
+
+OPERATIONS = ('make_elementary_intervals', 'elementary_grid', 'build_pairwise_matrix', 'unique_combos',
+              'not_in_background', 'pairwise_frequencies', 'interlocus_dependence', 'contingency_table',
+              'sources_at_point_pair')
+# share of intervals of each origin, as found in classical strains
+ORIGIN_MIX = {'dom': 0.8, 'mus': 0.1, 'cas': 0.05, 'unknown': 0.05}
+# locus pairs looked up per run of sources_at_point_pair
+POINT_PAIRS = 100
+
+
+def synthetic_panel(num_strains, breakpoints=3, origin_mix=None, seed=0, chrom_sizes=None):
+    """ Generates the intervals and sources of a panel of strains, as held in TwoLocus.sample_dict.  Each chromosome
+    of each strain is split at uniformly random breakpoints, a Poisson number of them in proportion to its length,
+    and each interval gets an origin drawn from the origin mix.
+    :param num_strains: number of strains, named S0, S1, ...
+    :param breakpoints: mean number of breakpoints on a chromosome of average length
+    :param origin_mix: {origin name: share of intervals}, default ORIGIN_MIX
+    :param seed: random seed
+    :param chrom_sizes: chromosome sizes, default twolocus.CHROMO_SIZES
+    :return: {strain name: (array of interval ends, array of sources)}
+    """
+    origin_mix = origin_mix or ORIGIN_MIX
+    sizes = np.asarray(chrom_sizes or twolocus.CHROMO_SIZES, dtype=np.int64)
+    offsets = np.cumsum(np.append(0, sizes))
+    origins = np.array([subspecies.UNKNOWN if name == 'unknown' else subspecies.to_int(name)
+                        for name in sorted(origin_mix)], dtype=np.uint8)
+    shares = np.array([origin_mix[name] for name in sorted(origin_mix)], dtype=np.float64)
+    rng = np.random.RandomState(seed)
+    panel = {}
+    for strain in xrange(num_strains):
+        ends = []
+        for chrom, size in enumerate(sizes):
+            num_breakpoints = rng.poisson(breakpoints * size / sizes.mean())
+            positions = np.unique(rng.randint(1, size, size=num_breakpoints))
+            ends.append(offsets[chrom] + np.append(positions, size))
+        intervals = np.concatenate(ends).astype(np.uint32)
+        panel['S%d' % strain] = (intervals, rng.choice(origins, size=len(intervals), p=shares / shares.sum()))
+    return panel
+
+
+def _operation(tl, name, strain_names, rng, output_file, backend=None):
+    """
+    :return: function running an operation on a panel
+    """
+    half = len(strain_names) // 2
+    background, foreground = strain_names[:half], strain_names[half:]
+    if name == 'make_elementary_intervals':
+        return lambda: tl.make_elementary_intervals([tl.sample_dict[sn][0] for sn in strain_names])
+    if name == 'elementary_grid':
+        return lambda: tl.elementary_grid(strain_names)
+    if name == 'build_pairwise_matrix':
+        elem_intervals = tl.make_elementary_intervals([tl.sample_dict[sn][0] for sn in strain_names])
+        return lambda: tl.build_pairwise_matrix(strain_names, elem_intervals)
+    if name in ('unique_combos', 'not_in_background'):
+        return lambda: getattr(tl, name)(background, foreground, backend=backend)
+    if name in ('pairwise_frequencies', 'interlocus_dependence'):
+        return lambda: getattr(tl, name)(strain_names)
+    if name == 'contingency_table':
+        return lambda: tl.contingency_table(background, foreground, output_file, backend=backend)
+    if name == 'sources_at_point_pair':
+        chroms = rng.randint(1, len(tl.sizes) + 1, size=(POINT_PAIRS, 2))
+        positions = [[rng.randint(1, tl.sizes[chrom - 1]) for chrom in pair] for pair in chroms]
+        loci = [(twolocus.INT_TO_CHROMO[pair[0]], position[0], twolocus.INT_TO_CHROMO[pair[1]], position[1])
+                for pair, position in zip(chroms, positions)]
+        return lambda: [tl.sources_at_point_pair(*(locus + (strain_names,))) for locus in loci]
+    raise ValueError('Unknown operation ' + name)
+
+
+def run(strain_counts, operations=OPERATIONS, breakpoints=3, origin_mix=None, repeat=3, seed=0, num_workers=1,
+        backend=None):
+    """ Times operations on synthetic panels of each size
+    :param strain_counts: numbers of strains in the panels
+    :param operations: names of the operations (see OPERATIONS)
+    :param breakpoints: mean number of breakpoints on a chromosome of average length
+    :param origin_mix: {origin name: share of intervals}, default ORIGIN_MIX
+    :param repeat: number of runs of each operation on each panel
+    :param seed: random seed of the panels and loci
+    :param num_workers: number of processes TwoLocus counts with
+    :param backend: counting backend of the queries (see twolocus.COUNTING_BACKENDS), or None to let TwoLocus choose
+    :return: list of results (see module docstring)
+    """
+    directory = tempfile.mkdtemp(prefix='benchmark')
+    results = []
+    try:
+        for num_strains in strain_counts:
+            # a fresh instance, so no haplotypes are cached from the last panel
+            tl = twolocus.TwoLocus(directory, num_workers=num_workers)
+            tl.sample_dict = synthetic_panel(num_strains, breakpoints, origin_mix, seed)
+            strain_names = sorted(tl.sample_dict, key=lambda name: int(name[1:]))
+            # also builds the breakpoint index of the panel, outside the timings
+            num_elem_intervals = len(tl.elementary_grid(strain_names)[0])
+            for name in operations:
+                result = {'operation': name, 'strains': num_strains, 'elementary_intervals': num_elem_intervals}
+                try:
+                    operation = _operation(tl, name, strain_names, np.random.RandomState(seed),
+                                           os.path.join(directory, 'contingency.csv'), backend)
+                    seconds = []
+                    for _ in xrange(repeat):
+                        stageTimer.start(name)
+                        start = time.time()
+                        try:
+                            operation()
+                        finally:
+                            seconds.append(time.time() - start)
+                            stages = stageTimer.finish()['stages']
+                    result.update(seconds=seconds, median=float(np.median(seconds)), stages=stages)
+                except Exception as e:
+                    result['error'] = '%s: %s' % (type(e).__name__, e)
+                results.append(result)
+                print '{:28s} {:5d} strains {:7d} intervals  {}'.format(
+                    name, num_strains, num_elem_intervals,
+                    '{:9.3f}s'.format(result['median']) if 'median' in result else result['error'])
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def compare(before, after):
+    """ Prints the ratio of median times of the operations timed in both of two results files
+    :param before: path to JSON results
+    :param after: path to JSON results
+    """
+    timings = []
+    for path in (before, after):
+        with open(path) as fp:
+            timings.append({(result['operation'], result['strains']): result.get('median')
+                            for result in json.load(fp)['results']})
+    for key in sorted(set(timings[0]) & set(timings[1])):
+        old, new = timings[0][key], timings[1][key]
+        print '{:28s} {:5d} strains  {}'.format(
+            key[0], key[1], '{:9.3f}s {:9.3f}s {:7.2f}x'.format(old, new, old / new) if old and new else 'error')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time TwoLocus queries on synthetic panels')
+    parser.add_argument('--strains', type=int, nargs='+', default=[4, 8, 16, 32], help='panel sizes to sweep')
+    parser.add_argument('--operations', nargs='+', default=list(OPERATIONS), choices=OPERATIONS)
+    parser.add_argument('--breakpoints', type=float, default=3,
+                        help='mean breakpoints on a chromosome of average length')
+    parser.add_argument('--origin-mix', type=json.loads, default=ORIGIN_MIX,
+                        help='JSON object of the share of intervals of each origin (dom, mus, cas, unknown)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--backend', choices=twolocus.COUNTING_BACKENDS, help='counting backend of the queries')
+    parser.add_argument('--output', help='JSON file to write results to')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two results files')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = run(args.strains, args.operations, args.breakpoints, args.origin_mix, args.repeat, args.seed,
+                  args.workers, args.backend)
+    if args.output:
+        config = {key: value for key, value in vars(args).iteritems() if key not in ('output', 'compare')}
+        machine = {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+                   'cpus': multiprocessing.cpu_count()}
+        with open(args.output, 'w') as fp:
+            json.dump({'config': config, 'machine': machine, 'results': results}, fp, indent=1)
+
+
+if __name__ == '__main__':
+    main()
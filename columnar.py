@@ -0,0 +1,105 @@
+"""
+File: columnar.py
+Purpose: Binary columnar encoding of query results for the genome visualization, so that the browser reads them as
+        typed arrays instead of parsing a JSON literal of every row.  A payload is
+            8 bytes     little-endian length of the header
+            header      JSON, padded with spaces to a multiple of 8 bytes:
+                        {"query": name, "length": rows, "columns": [{"name", "dtype", "offset", "length"}, ...],
+                         "layers": [color of each combo], "chromosomes": number of chromosomes, "strains": [...]}
+            columns     each a little-endian array of "length" values, "offset" bytes after the header and
+                        aligned to 8 bytes
+        Results are encoded as laid out by twolocus.group_by_chromosome_pair().  Interval columns are prox_start,
+        prox_end, dist_start and dist_end, as uint32 genome indices (which exceed the range of int32), and the layer
+        column gives the origin combo of each row.  not_in_background has a sample column indexing "strains".  The
+        pair_index column gives the first row of each (layer, proximal chromosome, distal chromosome) in row-major
+        order followed by the number of rows, so that the rows of a chromosome pair are sliced without a search.
+"""
+
+import json
+import struct
+import numpy as np
+import stageTimer
+
+INTERVAL_COLUMNS = ('prox_start', 'prox_end', 'dist_start', 'dist_end')
+# dtypes written, named as in the header
+DTYPES = {'uint8': '<u1', 'uint16': '<u2', 'uint32': '<u4', 'int32': '<i4', 'float32': '<f4',
+          'float64': '<f8'}
+
+_ALIGNMENT = 8
+
+
+@stageTimer.timed('serialization')
+def encode(columns, **header):
+    """
+    :param columns: list of (name, array), the first of which has a value per row
+    :param header: further JSON-serializable header entries
+    :return: payload string
+    """
+    header['length'] = len(columns[0][1]) if columns else 0
+    header['columns'] = []
+    arrays = []
+    offset = 0
+    for name, array in columns:
+        dtype = np.dtype(array.dtype).newbyteorder('<')
+        dtype_name = [key for key, value in DTYPES.iteritems() if np.dtype(value) == dtype][0]
+        arrays.append(np.ascontiguousarray(array, dtype=dtype))
+        header['columns'].append({'name': name, 'dtype': dtype_name, 'offset': offset, 'length': len(array)})
+        offset += -(-arrays[-1].nbytes // _ALIGNMENT) * _ALIGNMENT
+    header_bytes = json.dumps(header, separators=(',', ':'))
+    header_bytes += ' ' * (-len(header_bytes) % _ALIGNMENT)
+    parts = [struct.pack('<Q', len(header_bytes)), header_bytes]
+    for array in arrays:
+        parts.append(array.tostring())
+        parts.append('\0' * (-array.nbytes % _ALIGNMENT))
+    return ''.join(parts)
+
+
+def decode(payload):
+    """ Inverse of encode()
+    >>> header, columns = decode(encode([('prox_start', np.array([3000000000, 7], dtype=np.uint32)),
+    ...                                  ('layer', np.array([2, 0], dtype=np.uint8)),
+    ...                                  ('area', np.array([0.5, -1.25]))], query='unique_combos'))
+    >>> str(header['query']), header['length'], [(str(c['dtype']), c['offset']) for c in header['columns']]
+    ('unique_combos', 2, [('uint32', 0), ('uint8', 8), ('float64', 16)])
+    >>> map(int, columns['prox_start']), columns['layer'].tolist(), columns['area'].tolist()
+    ([3000000000, 7], [2, 0], [0.5, -1.25])
+
+    :param payload: payload string
+    :return: header dictionary, {column name: array}
+    """
+    header_length, = struct.unpack_from('<Q', payload)
+    header = json.loads(payload[_ALIGNMENT:_ALIGNMENT + header_length])
+    columns = {}
+    for column in header['columns']:
+        columns[column['name']] = np.frombuffer(payload, dtype=DTYPES[column['dtype']], count=column['length'],
+                                                offset=_ALIGNMENT + header_length + column['offset'])
+    return header, columns
+
+
+def encode_layout(query, layout):
+    """ Encodes the result of a TwoLocus query
+    :param query: name of the TwoLocus method
+    :param layout: result laid out by twolocus.group_by_chromosome_pair()
+    :return: payload string
+    """
+    columns, header = layout_columns(query, layout)
+    return encode(columns, **header)
+
+
+def layout_columns(query, layout):
+    """ Converts the result of a TwoLocus query to the columns encoded
+    :param query: name of the TwoLocus method
+    :param layout: result laid out by twolocus.group_by_chromosome_pair()
+    :return: list of (name, array), header entries
+    """
+    num_layers = len(layout['colors'])
+    header = {'query': query, 'layers': [int(color) for color in layout['colors']],
+              'chromosomes': layout['chromosomes']}
+    columns = [(name, np.asarray(layout['columns'][name]).astype(np.uint32)) for name in INTERVAL_COLUMNS]
+    columns.append(('layer', np.asarray(layout['combo']).astype(np.uint8 if num_layers <= 1 << 8 else np.uint16)))
+    if 'sample' in layout['columns']:
+        strains, samples = np.unique(layout['columns']['sample'].astype(str), return_inverse=True)
+        header['strains'] = strains.tolist()
+        columns.append(('sample', samples.astype(np.uint16 if len(strains) <= 1 << 16 else np.uint32)))
+    columns.append(('pair_index', np.asarray(layout['index']).astype(np.uint32)))
+    return columns, header
@@ -1,19 +1,284 @@
+"""
+File: dumpOrigins.py
+Purpose: Bulk extraction of subspecific origins and founders from the MegaMUGA database, written in the
+        strain,chrom,start,end,subspecies layout read by TwoLocus.parse_csvs().
+        Strains are queried in batches of IN (...) parameters over a single read-only connection, and calls are
+        streamed with fetchmany() and collapsed into intervals a chunk at a time.
+
+        The database is assumed to hold per-marker calls of every sample:
+            samples(id INTEGER PRIMARY KEY, name TEXT UNIQUE)
+            markers(id INTEGER PRIMARY KEY, name TEXT, chromosome TEXT, position INTEGER)
+            calls(sample_id INTEGER, marker_id INTEGER, subspecies TEXT, founder TEXT)
+        write_fixture() generates a small database of this form for testing, on which check_extraction() compares
+        the extracted intervals with calls collapsed a marker at a time, by
+            python -m doctest dumpOrigins.py
+"""
+
+import os
 import sqlite3
 import csv
+import numpy as np
 
 MEGA_DB = '/csbiodata/public/www.csbio.unc.edu/htdocs/CCstatus/megamuga.db'
 
+# strains per query, below SQLite's limit of 999 parameters
+BATCH_SIZE = 500
+# rows fetched at a time
+FETCH_ROWS = 1 << 16
+
+_CALLS_QUERY = """SELECT sample_id, marker_id, {column} FROM calls WHERE sample_id IN ({params})
+ORDER BY sample_id, marker_id"""
+
+_connections = {}
+# per database: marker ids in ascending order, and their chromosomes and positions
+_marker_tables = {}
+
+
+def connect(db=MEGA_DB):
+    """ Opens a database read-only, or returns the connection already opened to it
+    :param db: path to SQLite database
+    :return: sqlite3 connection
+    :raises: IOError if there is no database at the path
+    """
+    if db not in _connections:
+        # sqlite3 would create an empty database.  The path is opened as a plain filename, as python 2 can't ask for
+        # a URI (file:...?mode=ro), which SQLite built without URI filenames would take as the name of a new file.
+        if not os.path.isfile(db):
+            raise IOError('No database at ' + db)
+        connection = sqlite3.connect(db, check_same_thread=False)
+        connection.execute('PRAGMA query_only = ON')
+        connection.text_factory = str
+        _connections[db] = connection
+    return _connections[db]
+
+
+def get_strains(db=MEGA_DB):
+    """
+    :param db: path to SQLite database
+    :return: list of the names of all samples
+    """
+    return [name for name, in connect(db).execute('SELECT name FROM samples ORDER BY id')]
+
+
+def get_markers(strains, outfile, db=MEGA_DB):
+    """ Writes the subspecific origins of strains to a csv file, as read by TwoLocus.parse_csvs()
+    :param strains: list of strain names
+    :param outfile: path to csv file
+    :param db: path to SQLite database
+    :return: number of intervals written
+    """
+    num_rows = 0
+    with open(outfile, 'w') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['strain', 'chrom', 'start', 'end', 'subspecies'])
+        for rows in get_ss_origins(strains, db):
+            writer.writerows(rows)
+            num_rows += len(rows)
+    return num_rows
+
+
+def get_ss_origins(strains, db=MEGA_DB):
+    """ Subspecific origins of strains, collapsed from markers into intervals.  Markers without a call are left out,
+    so that parse_csvs() fills them in as unknown.
+    :param strains: list of strain names
+    :param db: path to SQLite database
+    :return: iterator over lists of (strain, chromosome, start, end, subspecies)
+    """
+    return _intervals(strains, 'subspecies', db)
+
+
+def get_founders(strains, db=MEGA_DB):
+    """ Founder haplotypes of strains, collapsed from markers into intervals
+    :param strains: list of strain names
+    :param db: path to SQLite database
+    :return: iterator over lists of (strain, chromosome, start, end, founder)
+    """
+    return _intervals(strains, 'founder', db)
+
+
+def _intervals(strains, column, db):
+    """ Collapses runs of markers with the same call into intervals, ending each interval halfway to the next marker
+    :param strains: list of strain names
+    :param column: column of calls to collapse
+    :param db: path to SQLite database
+    :return: iterator over lists of (strain, chromosome, start, end, call)
+    """
+    connection = connect(db)
+    marker_ids, marker_chromosomes, marker_positions = _markers(db)
+    # rank of each marker by chromosome then position
+    _, chromosome_codes = np.unique(marker_chromosomes, return_inverse=True)
+    marker_ranks = np.empty(len(marker_ids), dtype=np.int64)
+    marker_ranks[np.lexsort((marker_positions, chromosome_codes))] = np.arange(len(marker_ids))
+    strains = list(set(strains))
+    sample_names = {}
+    for batch_start in xrange(0, len(strains), BATCH_SIZE):
+        batch = strains[batch_start:batch_start + BATCH_SIZE]
+        sample_names.update(connection.execute('SELECT id, name FROM samples WHERE name IN (%s)'
+                                               % ','.join('?' * len(batch)), batch))
+    sample_ids = sorted(sample_names)
+    for batch_start in xrange(0, len(sample_ids), BATCH_SIZE):
+        batch = sample_ids[batch_start:batch_start + BATCH_SIZE]
+        # scanned in index order, without joins or sorting, which are left to numpy
+        cursor = connection.execute(_CALLS_QUERY.format(column=column, params=','.join('?' * len(batch))), batch)
+        # calls of the sample which may continue into the next chunk
+        pending = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=object))
+        while True:
+            rows = cursor.fetchmany(FETCH_ROWS)
+            if rows:
+                columns = zip(*rows)
+                samples, markers, calls = [np.concatenate([held, np.array(values, dtype=held.dtype)])
+                                           for held, values in zip(pending, columns)]
+                # hold back the last sample until all its calls are read
+                complete = np.searchsorted(samples, samples[-1])
+            else:
+                samples, markers, calls = pending
+                complete = len(samples)
+            pending = (samples[complete:], markers[complete:], calls[complete:])
+            if complete:
+                markers = np.searchsorted(marker_ids, markers[:complete])
+                order = np.lexsort((marker_ranks[markers], samples[:complete]))
+                yield _collapse(samples[order], marker_chromosomes[markers[order]], marker_positions[markers[order]],
+                                calls[order], sample_names)
+            if not rows:
+                break
+
+
+def _markers(db):
+    """
+    :param db: path to SQLite database
+    :return: marker ids in ascending order, array of their chromosomes, array of their positions
+    """
+    if db not in _marker_tables:
+        ids, chromosomes, positions = zip(*connect(db).execute(
+            'SELECT id, chromosome, position FROM markers ORDER BY id').fetchall()) or ([], [], [])
+        _marker_tables[db] = (np.array(ids, dtype=np.int64), np.array(chromosomes, dtype=object),
+                              np.array(positions, dtype=np.int64))
+    return _marker_tables[db]
+
+
+def _collapse(samples, chromosomes, positions, calls, sample_names):
+    """ Collapses runs of calls of samples, sorted by sample, chromosome then position
+    :return: list of (strain, chromosome, start, end, call), leaving out runs without calls
+    """
+    new_group = np.ones(len(samples), dtype=bool)
+    new_group[1:] = (samples[1:] != samples[:-1]) | (chromosomes[1:] != chromosomes[:-1])
+    new_run = new_group.copy()
+    new_run[1:] |= calls[1:] != calls[:-1]
+    firsts = np.flatnonzero(new_run)
+    lasts = np.append(firsts[1:], len(samples)) - 1
+    # runs start and end at the markers at the edges of a chromosome, else halfway between markers
+    ends = positions[lasts].copy()
+    inner = lasts < len(samples) - 1
+    inner[inner] = ~new_group[lasts[inner] + 1]
+    ends[inner] = (positions[lasts[inner]] + positions[lasts[inner] + 1]) // 2
+    starts = positions[firsts].copy()
+    continued = ~new_group[firsts]
+    starts[continued] = ends[np.flatnonzero(continued) - 1] + 1
+    called = np.array([call is not None and call != '' for call in calls[firsts]], dtype=bool)
+    firsts = firsts[called]
+    return zip([sample_names[sample] for sample in samples[firsts].tolist()], chromosomes[firsts],
+               starts[called].tolist(), ends[called].tolist(), calls[firsts])
+
+
+def write_fixture(db, strains, num_markers=1000, chromosomes=None, seed=0, switch_rate=0.05):
+    """ Writes a database of random calls in the assumed schema, with runs of markers sharing an origin
+    :param db: path to SQLite database to create
+    :param strains: list of strain names
+    :param num_markers: number of markers, spread over the chromosomes
+    :param chromosomes: list of chromosome names, default autosomes and X
+    :param seed: random seed
+    :param switch_rate: fraction of markers at which a new run of origins starts
+    """
+    chromosomes = chromosomes or [str(c) for c in xrange(1, 20)] + ['X']
+    rng = np.random.RandomState(seed)
+    marker_chromosomes = np.sort(rng.randint(len(chromosomes), size=num_markers))
+    positions = np.sort(rng.randint(3000000, 150000000, size=num_markers))
+    connection = sqlite3.connect(db)
+    connection.executescript("""
+        CREATE TABLE samples(id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+        CREATE TABLE markers(id INTEGER PRIMARY KEY, name TEXT, chromosome TEXT, position INTEGER);
+        CREATE TABLE calls(sample_id INTEGER, marker_id INTEGER, subspecies TEXT, founder TEXT);
+    """)
+    connection.executemany('INSERT INTO samples VALUES (?, ?)', enumerate(strains))
+    connection.executemany('INSERT INTO markers VALUES (?, ?, ?, ?)',
+                           [(m, 'UNC%d' % m, chromosomes[c], int(p))
+                            for m, (c, p) in enumerate(zip(marker_chromosomes, positions))])
+    subspecies_names = [None, 'dom', 'mus', 'cas']
+    founders = list('ABCDEFGH')
+    for sample_id in xrange(len(strains)):
+        runs = np.cumsum(rng.rand(num_markers) < switch_rate)
+        run_subspecies = rng.choice(len(subspecies_names), size=runs[-1] + 1, p=[0.05, 0.8, 0.1, 0.05])
+        run_founders = rng.randint(len(founders), size=runs[-1] + 1)
+        connection.executemany('INSERT INTO calls VALUES (?, ?, ?, ?)',
+                               [(sample_id, m, subspecies_names[run_subspecies[r]], founders[run_founders[r]])
+                                for m, r in enumerate(runs)])
+    connection.execute('CREATE INDEX calls_sample ON calls(sample_id, marker_id)')
+    connection.commit()
+    connection.close()
 
-def get_markers(strains, outfile):
-    pass
 
+def check_extraction(num_strains=7, num_markers=300, batch_size=3, fetch_rows=128):
+    """ Extracts the origins of a fixture database to a csv file and reads them back with TwoLocus.parse_csvs(),
+    comparing them with the runs of calls of each strain collapsed a marker at a time.  Strains are queried a few at a
+    time, and fewer rows are fetched at a time than a strain has markers, so that each strain's calls are held back
+    across fetches.
+    >>> check_extraction()
+    7 strains, 335 intervals
+    []
 
-def get_ss_origins(strains):
-    pass
+    :param num_strains: number of strains of the fixture
+    :param num_markers: number of markers of the fixture
+    :param batch_size: strains per query, in place of BATCH_SIZE
+    :param fetch_rows: rows fetched at a time, in place of FETCH_ROWS
+    :return: list of strains whose intervals differ
+    """
+    global BATCH_SIZE, FETCH_ROWS
+    import shutil
+    import tempfile
+    import twolocus
+    import subspecies
+    directory = tempfile.mkdtemp()
+    db = os.path.join(directory, 'fixture.db')
+    batch_size, fetch_rows, BATCH_SIZE, FETCH_ROWS = BATCH_SIZE, FETCH_ROWS, batch_size, fetch_rows
+    try:
+        strains = ['strain%d' % i for i in xrange(num_strains)]
+        write_fixture(db, strains, num_markers, chromosomes=['1', '2', 'X'], switch_rate=0.5)
+        num_intervals = get_markers(strains, os.path.join(directory, 'origins.csv'), db)
+        parsed = twolocus.TwoLocus(directory).parse_csvs(['origins.csv'])
+        expected = _collapse_one_by_one(db)
+        print '%d strains, %d intervals' % (len(parsed), num_intervals)
+        return [strain for strain in strains
+                if {chromosome: [interval for interval in intervals if interval[0] != subspecies.UNKNOWN]
+                    for chromosome, intervals in parsed.get(strain, {}).iteritems()} != expected.get(strain, {})]
+    finally:
+        BATCH_SIZE, FETCH_ROWS = batch_size, fetch_rows
+        if db in _connections:
+            _connections.pop(db).close()
+        _marker_tables.pop(db, None)
+        shutil.rmtree(directory)
 
 
-def get_founders(strains):
-    pass
+def _collapse_one_by_one(db):
+    """ Collapses runs of subspecies calls as _intervals() does, a marker at a time
+    :param db: path to SQLite database
+    :return: {strain name: {chromosome number: list of (subspecies id, interval end)}} of runs with calls, as read
+    by TwoLocus.parse_csvs()
+    """
+    import twolocus
+    import subspecies
+    calls = connect(db).execute("""SELECT samples.name, markers.chromosome, markers.position, calls.subspecies
+        FROM calls JOIN samples ON samples.id = calls.sample_id JOIN markers ON markers.id = calls.marker_id
+        ORDER BY samples.name, markers.chromosome, markers.position, markers.id""").fetchall()
+    strains = {}
+    for i, (strain, chromosome, position, call) in enumerate(calls):
+        next_marker = calls[i + 1] if i + 1 < len(calls) else (None, None, None, None)
+        if next_marker[:2] == (strain, chromosome) and next_marker[3] == call:
+            continue  # the run goes on
+        if call:
+            end = (position + next_marker[2]) // 2 if next_marker[:2] == (strain, chromosome) else position
+            strains.setdefault(strain, {}).setdefault(twolocus.CHROMO_TO_INT[chromosome], []).append(
+                (subspecies.to_int(call), end))
+    return strains
 
 
 def main():
@@ -0,0 +1,168 @@
+"""
+File: genotypeStore.py
+Purpose: Compact genotype storage for marker-level analyses.  Calls take 2 bits each in a memory-mappable
+        markers x samples matrix, next to a table of per-marker metadata.  Calls are coded relative to each
+        marker's own alleles: 0 for its first allele, 1 for its second, 2 for a heterozygous call (H) and 3 for
+        any further allele, so that het and multi-allelic markers are found from the high bits alone.
+"""
+
+import csv
+import json
+import os
+import numpy as np
+
+FIRST = 0
+SECOND = 1
+HET = 2
+OTHER = 3
+
+CALLS_PER_BYTE = 4
+# the low bit of each of the 4 calls in a byte
+_LOW_BITS = 0x55
+_POPCOUNT = np.array([bin(byte).count('1') for byte in xrange(256)], dtype=np.uint8)
+
+_GENOTYPES = 'genotypes.bin'
+_MARKERS = 'markers.csv'
+_SAMPLES = 'samples.json'
+# markers processed at once when scanning the whole store
+_CHUNK_MARKERS = 1 << 16
+
+
+def pack(codes):
+    """ Packs 2 bit calls, 4 to a byte with the first call in the lowest bits
+    :param codes: uint8 array of calls, whose last dimension is samples
+    :return: uint8 array whose last dimension is bytes
+    """
+    codes = np.asarray(codes, dtype=np.uint8)
+    padding = -codes.shape[-1] % CALLS_PER_BYTE
+    if padding:
+        codes = np.concatenate([codes, np.zeros(codes.shape[:-1] + (padding,), dtype=np.uint8)], axis=-1)
+    codes = codes.reshape(codes.shape[:-1] + (-1, CALLS_PER_BYTE))
+    return codes[..., 0] | (codes[..., 1] << 2) | (codes[..., 2] << 4) | (codes[..., 3] << 6)
+
+
+def unpack(packed, num_samples):
+    """ Inverse of pack()
+    >>> pack([[SECOND, HET, OTHER, FIRST, OTHER], [FIRST, FIRST, FIRST, FIRST, SECOND]]).tolist()
+    [[57, 3], [0, 1]]
+    >>> codes = np.random.RandomState(0).randint(4, size=(3, 10))
+    >>> np.array_equal(unpack(pack(codes), 10), codes)
+    True
+
+    :param packed: uint8 array whose last dimension is bytes
+    :param num_samples: number of calls to keep from the last dimension
+    :return: uint8 array of calls
+    """
+    packed = np.asarray(packed, dtype=np.uint8)
+    codes = np.stack([(packed >> shift) & 0b11 for shift in (0, 2, 4, 6)], axis=-1)
+    return codes.reshape(packed.shape[:-1] + (-1,))[..., :num_samples]
+
+
+def encode_calls(calls):
+    """ Codes one marker's calls relative to its alleles, numbered in order of appearance
+    :param calls: list of allele strings
+    :return: array of codes, (first allele, second allele) with '' for an allele that never appears
+    """
+    alleles, first_seen, inverse = np.unique(calls, return_index=True, return_inverse=True)
+    codes = np.full(len(alleles), OTHER, dtype=np.uint8)
+    named = []
+    for allele in np.argsort(first_seen):
+        if alleles[allele] == 'H':
+            codes[allele] = HET
+        elif len(named) < 2:
+            codes[allele] = len(named)
+            named.append(alleles[allele])
+    named += [''] * (2 - len(named))
+    return codes[inverse], tuple(named)
+
+
+def convert(genotype_dump, store_path):
+    """ One-time conversion of a genotype dump (one row per marker: marker, chromosome, position, then every
+    sample's call in every other column starting from the fifth), streamed a marker at a time
+    :param genotype_dump: path to csv file
+    :param store_path: directory to write the store to
+    """
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    with open(genotype_dump) as dump_fp, open(os.path.join(store_path, _GENOTYPES), 'wb') as genotypes_fp, \
+            open(os.path.join(store_path, _MARKERS), 'w') as markers_fp:
+        reader = csv.reader(dump_fp)
+        writer = csv.writer(markers_fp)
+        samples = reader.next()[4::2]
+        writer.writerow(['marker', 'chromosome', 'position', 'first allele', 'second allele'])
+        for row in reader:
+            codes, alleles = encode_calls(row[4::2])
+            genotypes_fp.write(pack(codes).tostring())
+            writer.writerow(row[:3] + list(alleles))
+    with open(os.path.join(store_path, _SAMPLES), 'w') as fp:
+        json.dump(samples, fp)
+
+
+class GenotypeStore:
+    def __init__(self, store_path):
+        """ Opens a store written by convert(), mapping the genotypes into memory
+        :param store_path: directory of the store
+        """
+        with open(os.path.join(store_path, _SAMPLES)) as fp:
+            self.samples = json.load(fp)
+        self.num_samples = len(self.samples)
+        with open(os.path.join(store_path, _MARKERS)) as fp:
+            reader = csv.reader(fp)
+            reader.next()  # skip header
+            rows = list(reader)
+        self.markers = [tuple(row[:3]) for row in rows]
+        self.alleles = [tuple(row[3:5]) for row in rows]
+        num_bytes = -(-self.num_samples // CALLS_PER_BYTE)
+        self.packed = np.memmap(os.path.join(store_path, _GENOTYPES), dtype=np.uint8, mode='r',
+                                shape=(len(self.markers), num_bytes)) if rows else np.empty((0, num_bytes), np.uint8)
+
+    def codes(self, indices):
+        """
+        :param indices: marker indices
+        :return: markers x samples matrix of calls
+        """
+        return unpack(self.packed[indices], self.num_samples)
+
+    def testable(self):
+        """ Finds markers with exactly two alleles and no het calls, i.e. those whose calls all have a clear high
+        bit and some of which are set
+        :return: boolean array over markers
+        """
+        testable = np.empty(len(self.markers), dtype=bool)
+        for start in xrange(0, len(self.markers), _CHUNK_MARKERS):
+            packed = np.asarray(self.packed[start:start + _CHUNK_MARKERS])
+            high = (packed >> 1) & _LOW_BITS
+            testable[start:start + _CHUNK_MARKERS] = np.logical_and(
+                np.logical_not(high.any(axis=1)), (packed & _LOW_BITS).any(axis=1))
+        return testable
+
+    def second_allele_bits(self, indices):
+        """
+        :param indices: marker indices
+        :return: packed bytes with the low bit of each call set where the call is the marker's second allele
+        """
+        packed = np.asarray(self.packed[indices])
+        return packed & _LOW_BITS & ~(packed >> 1)
+
+    def allele_counts(self, indices):
+        """
+        :param indices: marker indices
+        :return: number of calls of each marker's second allele
+        """
+        return _POPCOUNT[self.second_allele_bits(indices)].sum(axis=-1, dtype=np.int64)
+
+    def pair_counts(self, prox_indices, dist_indices, chunk_bytes=1 << 24):
+        """ Counts samples with the second allele at both markers of every pair, by popcount of the bitwise and
+        :param prox_indices: proximal marker indices
+        :param dist_indices: distal marker indices
+        :param chunk_bytes: maximum size of the intermediate array of anded bytes
+        :return: proximal markers x distal markers matrix of counts
+        """
+        prox_bits = self.second_allele_bits(prox_indices)
+        dist_bits = self.second_allele_bits(dist_indices)
+        counts = np.empty([len(prox_bits), len(dist_bits)], dtype=np.int64)
+        rows = max(1, chunk_bytes // max(dist_bits.size, 1))
+        for start in xrange(0, len(prox_bits), rows):
+            both = prox_bits[start:start + rows, np.newaxis, :] & dist_bits[np.newaxis, :, :]
+            counts[start:start + rows] = _POPCOUNT[both].sum(axis=-1, dtype=np.int64)
+        return counts
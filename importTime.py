@@ -0,0 +1,66 @@
+"""
+File: importTime.py
+Purpose: Measures how long fresh interpreters take to import modules, so that cold starts don't regress.
+        python importTime.py twolocus --repeat 10 --max 0.5
+        exits with status 1 if the median import time of any module exceeds --max seconds.  The cold start of a
+        page is the import of its app followed by a call of the page, timed together with --run:
+        python importTime.py UniqueCombinationsApp --run "UniqueCombinationsApp.indexPage(form)" \
+            --setup "import cgi; form = cgi.FieldStorage()"
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# output is redirected to the null device, leaving the time on stderr
+_TIMER = '''import sys, time
+sys.stdout = open(%(null)r, 'w')
+%(setup)s
+start = time.time()
+import %(module)s
+%(run)s
+sys.stderr.write('%%r\\n' %% (time.time() - start))
+'''
+
+
+def import_time(module, repeat=5, path=None, run='', setup=''):
+    """ Imports a module in fresh interpreters
+    :param module: name of the module to import
+    :param repeat: number of interpreters to start
+    :param path: directory to import from, default the directory of this file
+    :param run: statement timed after the import, e.g. a call of a page
+    :param setup: statement run before timing
+    :return: median time in seconds
+    """
+    path = path or os.path.dirname(os.path.abspath(__file__))
+    script = _TIMER % {'null': os.devnull, 'setup': setup, 'module': module, 'run': run}
+    times = []
+    for _ in xrange(repeat):
+        process = subprocess.Popen([sys.executable, '-c', script], cwd=path, stderr=subprocess.PIPE)
+        _, err = process.communicate()
+        if process.returncode:
+            raise RuntimeError('%s failed:\n%s' % (module, err))
+        times.append(float(err.splitlines()[-1]))
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold import times')
+    parser.add_argument('modules', nargs='+')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max', type=float, default=None, help='maximum median seconds per module')
+    parser.add_argument('--run', default='', help='statement timed after each import')
+    parser.add_argument('--setup', default='', help='statement run before timing')
+    args = parser.parse_args()
+    regressed = False
+    for module in args.modules:
+        seconds = import_time(module, args.repeat, run=args.run, setup=args.setup)
+        print '{:30s} {:8.3f}s'.format(module, seconds)
+        if args.max is not None and seconds > args.max:
+            regressed = True
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
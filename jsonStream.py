@@ -0,0 +1,229 @@
+"""
+File: jsonStream.py
+Purpose: Streaming JSON encoding of query results, so that a large result is written out in chunks as it is encoded
+        instead of being converted to python lists (ndarray.tolist()) and one string of the whole document first.
+            for chunk in jsonStream.iterencode(result):
+                fp.write(chunk)
+        Arrays and runs of numbers are encoded a block of BLOCK_ROWS values at a time, the python objects of a block
+        being freed before the next, so that memory beyond the result itself is bounded by the size of a chunk and a
+        block.  Integer arrays are written by joining the decimal strings of the block, with no further checks.
+        Output is compact (no spaces after separators) and parses to the same values as json.dumps of the result with
+        numpy types converted to their python equivalents.  NaN and infinities are written as json.dumps writes them.
+"""
+
+import json
+import numpy as np
+
+# bytes of output gathered before a chunk is yielded
+CHUNK_BYTES = 1 << 16
+# values of an array or list converted to python objects at a time
+BLOCK_ROWS = 1 << 14
+
+_encode_string = json.encoder.encode_basestring_ascii
+_NUMBER_TYPES = (int, long, float, np.number)
+
+
+def _float(value):
+    """
+    :return: JSON of a float, as json.dumps writes it
+    """
+    if value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return 'Infinity'
+    elif value == -float('inf'):
+        return '-Infinity'
+    return repr(value)
+
+
+def _scalar(o):
+    """
+    :return: JSON of anything but a container or array
+    :raises: TypeError if it has no JSON equivalent
+    """
+    if o is None:
+        return 'null'
+    elif o is True or o is False or isinstance(o, np.bool_):
+        return 'true' if o else 'false'
+    elif isinstance(o, basestring):
+        return _encode_string(o)
+    elif isinstance(o, (int, long, np.integer)):
+        return str(int(o))
+    elif isinstance(o, (float, np.floating)):
+        return _float(float(o))
+    raise TypeError(repr(o) + ' is not JSON serializable')
+
+
+def _key(key):
+    """
+    :return: JSON of a key of an object, converted to a string as json.dumps does
+    """
+    if isinstance(key, basestring):
+        return _encode_string(key)
+    elif key is True or key is False or key is None or isinstance(key, (float, np.floating)):
+        return '"%s"' % _scalar(key)
+    elif isinstance(key, (int, long, np.integer)):
+        return '"%d"' % key
+    raise TypeError('key ' + repr(key) + ' is not a string')
+
+
+def _values(block):
+    """ Encodes a one dimensional block of values
+    :param block: array
+    :return: JSON of the values, separated by commas
+    """
+    kind = block.dtype.kind
+    if kind in 'iu':
+        return ','.join(map(str, block.tolist()))
+    elif kind == 'f' and np.isfinite(block).all():
+        return ','.join(map(repr, block.tolist()))
+    elif kind in 'SU':
+        return ','.join(map(_encode_string, block.tolist()))
+    return ','.join(map(_scalar, block.tolist()))
+
+
+def _rows(block):
+    """ Encodes a block of rows of a two dimensional array of numbers
+    :param block: array
+    :return: JSON of the rows, separated by commas
+    """
+    kind = block.dtype.kind
+    if kind in 'iu':
+        row_format = '[' + ','.join(['%d'] * block.shape[1]) + ']'
+    elif kind == 'f' and np.isfinite(block).all():
+        row_format = '[' + ','.join(['%r'] * block.shape[1]) + ']'
+    else:
+        return ','.join('[%s]' % _values(row) for row in block)
+    return ','.join([row_format % tuple(row) for row in block.tolist()])
+
+
+def _encode_array(array):
+    yield '['
+    if array.ndim == 1 or (array.ndim == 2 and array.dtype.kind in 'iuf' and array.shape[1]):
+        encode = _values if array.ndim == 1 else _rows
+        for start in xrange(0, len(array), BLOCK_ROWS):
+            if start:
+                yield ','
+            yield encode(array[start:start + BLOCK_ROWS])
+    elif array.dtype.kind == 'O':
+        for i, item in enumerate(array):
+            if i:
+                yield ','
+            for piece in _encode(item):
+                yield piece
+    else:
+        for i, row in enumerate(array):
+            if i:
+                yield ','
+            for piece in _encode_array(row):
+                yield piece
+    yield ']'
+
+
+def _homogeneous_values(block):
+    """
+    :return: JSON of a block of a list, if its items are all numbers or all strings of the same type, otherwise None
+    """
+    types = set(map(type, block))
+    if len(types) != 1:
+        return None
+    item_type = types.pop()
+    if issubclass(item_type, basestring):
+        # encoded as they are, as an array of them would drop trailing NULs
+        return ','.join(map(_encode_string, block))
+    if issubclass(item_type, bool) or not issubclass(item_type, _NUMBER_TYPES):
+        return None
+    return _values(np.asarray(block))
+
+
+def _encode_list(items):
+    yield '['
+    for start in xrange(0, len(items), BLOCK_ROWS):
+        if start:
+            yield ','
+        block = items[start:start + BLOCK_ROWS]
+        values = _homogeneous_values(block)
+        if values is not None:
+            yield values
+            continue
+        for i, item in enumerate(block):
+            if i:
+                yield ','
+            for piece in _encode(item):
+                yield piece
+    yield ']'
+
+
+def _encode(o):
+    if isinstance(o, np.ndarray):
+        pieces = _encode_array(o)
+    elif isinstance(o, (list, tuple)):
+        pieces = _encode_list(o)
+    elif isinstance(o, dict):
+        pieces = _encode_dict(o)
+    else:
+        yield _scalar(o)
+        return
+    for piece in pieces:
+        yield piece
+
+
+def _encode_dict(o):
+    yield '{'
+    for i, (key, value) in enumerate(o.iteritems()):
+        yield (',' if i else '') + _key(key) + ':'
+        for piece in _encode(value):
+            yield piece
+    yield '}'
+
+
+def iterencode(o, chunk_bytes=CHUNK_BYTES):
+    """ Encodes an object as JSON a chunk at a time
+    :param o: dicts, lists, tuples, numpy arrays and scalars, strings, numbers, booleans and None
+    :param chunk_bytes: least length of every chunk but the last
+    :return: generator of strings, which joined are the JSON document
+    :raises: TypeError, from the chunk at which an object has no JSON equivalent
+    """
+    pieces = []
+    size = 0
+    for piece in _encode(o):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_bytes:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+    if pieces:
+        yield ''.join(pieces)
+
+
+def dump(o, fp, chunk_bytes=CHUNK_BYTES):
+    """ Writes an object to a file as JSON, a chunk at a time
+    :param o: object (see iterencode())
+    :param fp: file-like object
+    :param chunk_bytes: least length of every write but the last
+    :return: number of bytes written
+    """
+    num_bytes = 0
+    for chunk in iterencode(o, chunk_bytes):
+        fp.write(chunk)
+        num_bytes += len(chunk)
+    return num_bytes
+
+
+def dumps(o):
+    """ Checked against json.dumps, with lists and arrays longer than a block:
+    >>> from collections import OrderedDict
+    >>> result = OrderedDict([('ints', np.arange(40000, dtype=np.uint32)), ('rows', np.arange(6.).reshape(3, 2) / 4),
+    ...                       ('names', ['a\\x00', 'b'] * 10000), ('accented', [u'\\u00e9'] * 3), (3, range(40000)),
+    ...                       ('mixed', [1, 'x', None, True, 2.5, float('nan')]),
+    ...                       ('scalars', (np.int64(4), np.float32(0.5)))])
+    >>> dumps(result) == json.dumps(result, separators=(',', ':'),
+    ...                             default=lambda o: o.tolist() if isinstance(o, np.ndarray) else o.item())
+    True
+    >>> dumps(['a\\x00'])
+    '["a\\\\u0000"]'
+
+    :return: JSON of an object (see iterencode())
+    """
+    return ''.join(iterencode(o))
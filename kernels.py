@@ -0,0 +1,157 @@
+"""
+File: kernels.py
+Purpose: Counting and extraction kernels for twolocus, in pure NumPy.  kernelsCython.pyx implements the same
+        functions as compiled loops; this module is used when that extension hasn't been built.
+
+        Kernels work on the intervals of many strains concatenated into single arrays, along with the index of
+        each strain's first interval, and on blocks of interval pairs.  A block is a row of
+        (strain index, first proximal interval, end of proximal intervals, first distal interval,
+        end of distal intervals, weight), with interval indices relative to the strain's first interval.
+        count_blocks() is checked against the compiled module, where it's built, by
+            python -m doctest kernels.py
+"""
+
+import numpy as np
+
+
+def _block_pairs(block, starts):
+    """ Lists the interval pairs of a block (upper triangle only), in row-major order
+    :param block: row of the blocks array
+    :param starts: index of each strain's first interval, followed by the total number of intervals
+    :return: absolute proximal interval indices, absolute distal interval indices
+    """
+    strain_index, row_lo, row_hi, col_lo, col_hi = block[:5]
+    rows, cols = np.meshgrid(np.arange(row_lo, row_hi), np.arange(col_lo, col_hi), indexing='ij')
+    upper = rows <= cols
+    return rows[upper] + starts[strain_index], cols[upper] + starts[strain_index]
+
+
+def _interval_starts(indices, first, last):
+    """ Index of the interval ending where each interval starts.  As elsewhere in twolocus, the start of a
+    strain's first interval is read from its last interval.
+    :param indices: absolute interval indices
+    :param first: index of the strain's first interval
+    :param last: index one past the strain's last interval
+    """
+    return np.where(indices == first, last - 1, indices - 1)
+
+
+def count_blocks(source_counts, blocks, interval_breaks, sources, starts, ordinal_lut):
+    """ Adds the weighted source combos of blocks of interval pairs to counts over pairs of elementary intervals.
+    Each interval pair covers a rectangle of elementary interval pairs, so the rectangles are added to a 2d
+    difference array per combo, which is then integrated.  The difference arrays take the dtype of the counts: sums
+    which overflow it along the way wrap around, and the counts they integrate to come out exact.
+    :param source_counts: 3d matrix. First index is combo, remaining 2d matrices are counts for pairwise intervals
+    :param blocks: 2d int64 array of blocks
+    :param interval_breaks: index of the elementary interval ending where each interval ends
+    :param sources: concatenated sources of all strains
+    :param starts: index of each strain's first interval, followed by the total number of intervals
+    :param ordinal_lut: ordinal of the combo of every pair of sources, indexed by the sources
+    """
+    num_combos, num_elem = source_counts.shape[:2]
+    differences = np.zeros([num_combos, num_elem + 1, num_elem + 1], dtype=source_counts.dtype)
+    for block in blocks:
+        rows, cols = _block_pairs(block, starts)
+        first = starts[block[0]]
+        combos = ordinal_lut[sources[rows], sources[cols]]
+        # pairs with an unknown origin aren't counted (-1 would index the last combo)
+        keep = combos >= 0
+        rows, cols, combos = rows[keep], cols[keep], combos[keep]
+        row_lo = np.where(rows == first, 0, interval_breaks[rows - 1] + 1)
+        row_hi = interval_breaks[rows] + 1
+        col_lo = np.where(cols == first, 0, interval_breaks[cols - 1] + 1)
+        col_hi = interval_breaks[cols] + 1
+        weight = block[5]
+        np.add.at(differences, (combos, row_lo, col_lo), weight)
+        np.add.at(differences, (combos, row_hi, col_lo), -weight)
+        np.add.at(differences, (combos, row_lo, col_hi), -weight)
+        np.add.at(differences, (combos, row_hi, col_hi), weight)
+    np.cumsum(differences, axis=1, dtype=differences.dtype, out=differences)
+    np.cumsum(differences, axis=2, dtype=differences.dtype, out=differences)
+    source_counts += differences[:, :num_elem, :num_elem]
+
+
+def block_frequencies(blocks, intervals, sources, starts, ordinal_lut, num_combos):
+    """ Lists the interval pairs of blocks whose combos have the lowest ordinals, i.e. those with known
+    origins, once per unit of the block's weight
+    :param blocks: 2d int64 array of blocks
+    :param intervals: concatenated interval ends of all strains
+    :param sources: concatenated sources of all strains
+    :param starts: index of each strain's first interval, followed by the total number of intervals
+    :param ordinal_lut: ordinal of the combo of every pair of sources, indexed by the sources
+    :param num_combos: number of combos to list
+    :return: for each combo, arrays of proximal starts, proximal ends, distal starts and distal ends
+    """
+    columns = [[[] for _ in xrange(4)] for _ in xrange(num_combos)]
+    for block in blocks:
+        rows, cols = _block_pairs(block, starts)
+        first, last = starts[block[0]], starts[block[0] + 1]
+        combos = ordinal_lut[sources[rows], sources[cols]]
+        for combo in np.unique(combos[(combos >= 0) & (combos < num_combos)]):
+            selected = combos == combo
+            combo_rows, combo_cols = rows[selected], cols[selected]
+            for column, indices in zip(columns[combo], [_interval_starts(combo_rows, first, last), combo_rows,
+                                                        _interval_starts(combo_cols, first, last), combo_cols]):
+                column.append(np.repeat(intervals[indices], block[5]))
+    return [[np.concatenate(column) if column else np.empty(0, dtype=intervals.dtype) for column in combo_columns]
+            for combo_columns in columns]
+
+
+def check_count_blocks(num_trials=20, seed=0):
+    """ Compares count_blocks() with kernelsCython.count_blocks() on random blocks, whose weights overflow int16
+    along the way and whose sources fill a random lookup table, so that many pairs aren't counted.  Without the
+    compiled module, compares with its loops run in python (_count_blocks_loops()).
+    >>> check_count_blocks()
+    []
+
+    :param num_trials: number of random sets of blocks
+    :param seed: random seed
+    :return: list of the trials whose counts differ
+    """
+    try:
+        from kernelsCython import count_blocks as reference
+    except ImportError:
+        reference = _count_blocks_loops
+    rng = np.random.RandomState(seed)
+    ordinal_lut = rng.randint(-1, 16, size=(9, 9)).astype(np.int8)
+    mismatches = []
+    for trial in xrange(num_trials):
+        num_elem = rng.randint(1, 30)
+        interval_breaks, sources, starts = [], [], [0]
+        for _ in xrange(rng.randint(1, 5)):
+            # a strain's intervals end at distinct elementary intervals, the last at the end of the genome
+            num_intervals = rng.randint(1, num_elem + 1)
+            interval_breaks.extend(np.sort(rng.choice(num_elem - 1, num_intervals - 1, replace=False)).tolist() +
+                                   [num_elem - 1])
+            sources.extend(rng.randint(len(ordinal_lut), size=num_intervals))
+            starts.append(starts[-1] + num_intervals)
+        blocks = []
+        for _ in xrange(rng.randint(1, 10)):
+            strain = rng.randint(len(starts) - 1)
+            rows = np.sort(rng.choice(starts[strain + 1] - starts[strain] + 1, 2, replace=False))
+            cols = np.sort(rng.randint(starts[strain + 1] - starts[strain] + 1, size=2))
+            blocks.append([strain, rows[0], rows[1], cols[0], cols[1], rng.randint(1, 4000)])
+        inputs = (np.array(blocks, dtype=np.int64), np.array(interval_breaks, dtype=np.int64),
+                  np.array(sources, dtype=np.uint8), np.array(starts, dtype=np.int64), ordinal_lut)
+        counts, expected = [np.zeros([16, num_elem, num_elem], dtype=np.int16) for _ in xrange(2)]
+        count_blocks(counts, *inputs)
+        reference(expected, *inputs)
+        if not np.array_equal(counts, expected):
+            mismatches.append(trial)
+    return mismatches
+
+
+def _count_blocks_loops(source_counts, blocks, interval_breaks, sources, starts, ordinal_lut):
+    """ count_blocks() as kernelsCython.pyx loops over the interval pairs of blocks, adding each one's combo to its
+    rectangle of elementary interval pairs
+    """
+    for strain_index, row_lo, row_hi, col_lo, col_hi, weight in blocks:
+        first = starts[strain_index]
+        for row in xrange(first + row_lo, first + row_hi):
+            # only upper triangle
+            for col in xrange(max(row, first + col_lo), first + col_hi):
+                combo = ordinal_lut[sources[row], sources[col]]
+                if combo < 0:
+                    continue
+                source_counts[combo, 0 if row == first else interval_breaks[row - 1] + 1:interval_breaks[row] + 1,
+                              0 if col == first else interval_breaks[col - 1] + 1:interval_breaks[col] + 1] += weight
@@ -0,0 +1,97 @@
+# cython: boundscheck=False, wraparound=False, language_level=2
+"""
+File: kernelsCython.pyx
+Purpose: Counting and extraction kernels for twolocus, compiled ahead of time (python setup.py build_ext --inplace).
+        Loops run over typed memoryviews without the GIL.  kernels.py implements the same functions in pure NumPy.
+
+        Kernels work on the intervals of many strains concatenated into single arrays, along with the index of
+        each strain's first interval, and on blocks of interval pairs.  A block is a row of
+        (strain index, first proximal interval, end of proximal intervals, first distal interval,
+        end of distal intervals, weight), with interval indices relative to the strain's first interval.
+"""
+
+import numpy as np
+from libc.stdint cimport int8_t, int16_t, int64_t, uint8_t, uint32_t
+
+
+def count_blocks(int16_t[:, :, ::1] source_counts, int64_t[:, ::1] blocks, int64_t[::1] interval_breaks,
+                 uint8_t[::1] sources, int64_t[::1] starts, int8_t[:, ::1] ordinal_lut):
+    """ Adds the weighted source combos of blocks of interval pairs to counts over pairs of elementary intervals
+    :param source_counts: 3d matrix. First index is combo, remaining 2d matrices are counts for pairwise intervals
+    :param blocks: 2d int64 array of blocks
+    :param interval_breaks: index of the elementary interval ending where each interval ends
+    :param sources: concatenated sources of all strains
+    :param starts: index of each strain's first interval, followed by the total number of intervals
+    :param ordinal_lut: ordinal of the combo of every pair of sources, indexed by the sources
+    """
+    cdef Py_ssize_t block, row, col, i, j, first, row_lo, row_hi, col_lo, col_hi
+    cdef int8_t combo
+    cdef int16_t weight
+    with nogil:
+        for block in range(blocks.shape[0]):
+            first = starts[blocks[block, 0]]
+            weight = <int16_t> blocks[block, 5]
+            for row in range(first + blocks[block, 1], first + blocks[block, 2]):
+                row_lo = 0 if row == first else interval_breaks[row - 1] + 1
+                row_hi = interval_breaks[row] + 1
+                # only upper triangle
+                for col in range(max(row, first + blocks[block, 3]), first + blocks[block, 4]):
+                    col_lo = 0 if col == first else interval_breaks[col - 1] + 1
+                    col_hi = interval_breaks[col] + 1
+                    combo = ordinal_lut[sources[row], sources[col]]
+                    if combo < 0:
+                        continue
+                    for i in range(row_lo, row_hi):
+                        for j in range(col_lo, col_hi):
+                            source_counts[combo, i, j] += weight
+
+
+def block_frequencies(int64_t[:, ::1] blocks, uint32_t[::1] intervals, uint8_t[::1] sources, int64_t[::1] starts,
+                      int8_t[:, ::1] ordinal_lut, int num_combos):
+    """ Lists the interval pairs of blocks whose combos have the lowest ordinals, i.e. those with known
+    origins, once per unit of the block's weight
+    :param blocks: 2d int64 array of blocks
+    :param intervals: concatenated interval ends of all strains
+    :param sources: concatenated sources of all strains
+    :param starts: index of each strain's first interval, followed by the total number of intervals
+    :param ordinal_lut: ordinal of the combo of every pair of sources, indexed by the sources
+    :param num_combos: number of combos to list
+    :return: for each combo, arrays of proximal starts, proximal ends, distal starts and distal ends
+    """
+    cdef Py_ssize_t block, row, col, copy, first, last, row_start, col_start
+    cdef int8_t combo
+    cdef int64_t[::1] sizes = np.zeros(num_combos + 1, dtype=np.int64)
+    # first pass sizes the output, second pass fills it
+    with nogil:
+        for block in range(blocks.shape[0]):
+            first = starts[blocks[block, 0]]
+            for row in range(first + blocks[block, 1], first + blocks[block, 2]):
+                for col in range(max(row, first + blocks[block, 3]), first + blocks[block, 4]):
+                    combo = ordinal_lut[sources[row], sources[col]]
+                    if 0 <= combo < num_combos:
+                        sizes[combo + 1] += blocks[block, 5]
+    # combos are laid out one after another, each starting at its offset
+    offsets = np.cumsum(sizes)
+    output = np.empty([4, offsets[num_combos]], dtype=np.uint32)
+    cdef uint32_t[:, ::1] columns = output
+    cdef int64_t[::1] positions = offsets.copy()
+    with nogil:
+        for block in range(blocks.shape[0]):
+            first = starts[blocks[block, 0]]
+            last = starts[blocks[block, 0] + 1]
+            for row in range(first + blocks[block, 1], first + blocks[block, 2]):
+                # the start of a strain's first interval is read from its last interval
+                row_start = last - 1 if row == first else row - 1
+                for col in range(max(row, first + blocks[block, 3]), first + blocks[block, 4]):
+                    combo = ordinal_lut[sources[row], sources[col]]
+                    if not 0 <= combo < num_combos:
+                        continue
+                    col_start = last - 1 if col == first else col - 1
+                    for copy in range(blocks[block, 5]):
+                        columns[0, positions[combo]] = intervals[row_start]
+                        columns[1, positions[combo]] = intervals[row]
+                        columns[2, positions[combo]] = intervals[col_start]
+                        columns[3, positions[combo]] = intervals[col]
+                        positions[combo] += 1
+    return [[output[column, offsets[combo]:offsets[combo + 1]] for column in xrange(4)]
+            for combo in xrange(num_combos)]
@@ -0,0 +1,239 @@
+"""
+File: multipleTesting.py
+Purpose: Multiple-testing correction (Benjamini-Hochberg FDR or Bonferroni) of the p-values in csv output too
+        large to sort in memory, such as that of pairwiseMarkers.py or TwoLocus.contingency_table().
+        P-values are sorted in chunks that are spilled to disk as sorted runs and merged back, so memory is bounded
+        by the chunk size rather than by the number of tests.
+        python multipleTesting.py outfile.csv corrected.csv --column p --method bh
+        The corrections are checked against benjamini_hochberg() and bonferroni() of the p-values in memory by
+            python -m doctest multipleTesting.py
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+METHODS = ('bh', 'bonferroni')
+# p-values sorted in memory at once, 16 bytes each along with their rows
+CHUNK_ROWS = 1 << 22
+
+_RUN_DTYPE = np.dtype([('p', '<f8'), ('row', '<i8')])
+
+
+def benjamini_hochberg(p_values):
+    """ Benjamini-Hochberg adjusted p-values of an array small enough to sort in memory
+    :param p_values: array of p-values, nan for untested
+    :return: array of adjusted p-values, nan where untested
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    tested = np.flatnonzero(np.isfinite(p_values))
+    order = tested[np.argsort(-p_values[tested], kind='mergesort')]
+    adjusted = np.full(p_values.shape, np.nan)
+    if len(order):
+        ranks = np.arange(len(order), 0, -1)
+        adjusted[order] = np.minimum.accumulate(np.minimum(p_values[order] * len(order) / ranks, 1.))
+    return adjusted
+
+
+def bonferroni(p_values, num_tests=None):
+    """ Bonferroni adjusted p-values
+    >>> bonferroni([0.01, np.nan, 0.125, 0.5]).tolist()
+    [0.03, nan, 0.375, 1.0]
+    >>> bonferroni([0.01, np.nan], num_tests=4).tolist()
+    [0.04, nan]
+
+    :param p_values: array of p-values, nan for untested
+    :param num_tests: number of tests corrected for, default the number of p-values which aren't nan
+    :return: array of adjusted p-values, nan where untested
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    if num_tests is None:
+        num_tests = np.isfinite(p_values).sum()
+    return np.minimum(p_values * num_tests, 1.)
+
+
+def correct_csv(in_path, out_path, p_column='p', corrected_column='corrected p-value', method='bh',
+                chunk_rows=CHUNK_ROWS, work_dir=None):
+    """ Writes a copy of a csv file with corrected p-values, reading it twice in chunks.  Rows whose p-value is
+    not a number are left out of the correction and left blank.
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'tests.csv')
+    >>> p_values = np.random.RandomState(0).uniform(size=1000) ** 3
+    >>> p_values[::7] = np.nan
+    >>> with open(path, 'w') as fp:
+    ...     csv.writer(fp).writerows([['p']] + [['' if p != p else repr(p)] for p in p_values])
+    >>> for method, correct in (('bh', benjamini_hochberg), ('bonferroni', bonferroni)):
+    ...     stats = correct_csv(path, path, method=method, chunk_rows=64)
+    ...     with open(path) as fp:
+    ...         corrected = _p_values(list(csv.reader(fp))[1:], 1)
+    ...     print method, stats['tests'], stats['runs'], np.allclose(corrected, correct(p_values), equal_nan=True)
+    bh 857 16 True
+    bonferroni 857 0 True
+    >>> shutil.rmtree(directory)
+
+    :param in_path: csv file with a header
+    :param out_path: csv file to write, which may be in_path
+    :param p_column: header of the p-value column
+    :param corrected_column: header of the column to fill, appended if in_path lacks it
+    :param method: 'bh' (Benjamini-Hochberg) or 'bonferroni'
+    :param chunk_rows: maximum number of p-values held in memory at once
+    :param work_dir: directory for sorted runs and the adjusted p-values, default beside out_path
+    :return: dict of the number of rows, tests and sorted runs, seconds taken and rows per second
+    """
+    if method not in METHODS:
+        raise ValueError('method must be one of ' + ', '.join(METHODS))
+    start_time = time.time()
+    work_dir = tempfile.mkdtemp(prefix='correction', dir=work_dir or os.path.dirname(os.path.abspath(out_path)))
+    try:
+        with open(in_path) as fp:
+            reader = csv.reader(fp)
+            header = reader.next()
+            runs, num_rows, num_tests = _sorted_runs(_chunks(reader, header.index(p_column), chunk_rows), work_dir,
+                                                     sort=method == 'bh')
+        adjusted = np.memmap(os.path.join(work_dir, 'adjusted'), dtype=np.float64, mode='w+',
+                             shape=(max(num_rows, 1),))
+        adjusted[:] = np.nan
+        if method == 'bh':
+            _adjust_bh(runs, num_tests, adjusted, chunk_rows)
+        temp_path = os.path.join(work_dir, 'corrected.csv')
+        with open(in_path) as in_fp, open(temp_path, 'w') as out_fp:
+            reader = csv.reader(in_fp)
+            writer = csv.writer(out_fp)
+            header = reader.next()
+            p_index = header.index(p_column)
+            if corrected_column not in header:
+                header.append(corrected_column)
+            corrected_index = header.index(corrected_column)
+            writer.writerow(header)
+            row_start = 0
+            while True:
+                rows = list(itertools.islice(reader, chunk_rows))
+                if not rows:
+                    break
+                if method == 'bh':
+                    values = adjusted[row_start:row_start + len(rows)]
+                else:
+                    values = bonferroni(_p_values(rows, p_index), num_tests)
+                for row, value in zip(rows, values.tolist()):
+                    row.extend([''] * (corrected_index + 1 - len(row)))
+                    row[corrected_index] = '' if value != value else value
+                writer.writerows(rows)
+                row_start += len(rows)
+        del adjusted
+        shutil.move(temp_path, out_path)
+    finally:
+        shutil.rmtree(work_dir)
+    seconds = time.time() - start_time
+    return {'rows': num_rows, 'tests': num_tests, 'runs': len(runs), 'seconds': seconds,
+            'rows per second': num_rows / seconds if seconds else float('inf')}
+
+
+def _p_values(rows, p_index):
+    """
+    :return: array of the p-values of rows, nan where missing
+    """
+    values = np.empty(len(rows))
+    for index, row in enumerate(rows):
+        try:
+            values[index] = float(row[p_index])
+        except (IndexError, ValueError):
+            values[index] = np.nan
+    return values
+
+
+def _chunks(reader, p_index, chunk_rows):
+    """ Reads p-values in chunks
+    :return: iterator over arrays of p-values
+    """
+    while True:
+        rows = list(itertools.islice(reader, chunk_rows))
+        if not rows:
+            return
+        yield _p_values(rows, p_index)
+
+
+def _sorted_runs(chunks, work_dir, sort=True):
+    """ Spills the tested p-values of each chunk to disk, sorted from largest to smallest, along with their rows
+    :param chunks: iterator over arrays of p-values
+    :param work_dir: directory to write runs to
+    :param sort: False to only count rows and tests
+    :return: list of paths to runs, number of rows, number of tests
+    """
+    runs = []
+    num_rows = 0
+    num_tests = 0
+    for p_values in chunks:
+        tested = np.flatnonzero(np.isfinite(p_values))
+        if sort and len(tested):
+            run = np.empty(len(tested), dtype=_RUN_DTYPE)
+            order = tested[np.argsort(-p_values[tested], kind='mergesort')]
+            run['p'] = p_values[order]
+            run['row'] = order + num_rows
+            runs.append(os.path.join(work_dir, 'run%06d.npy' % len(runs)))
+            np.save(runs[-1], run)
+        num_rows += len(p_values)
+        num_tests += len(tested)
+    return runs, num_rows, num_tests
+
+
+def _merge_runs(runs, chunk_rows):
+    """ Merges sorted runs, reading an equal share of chunk_rows from each at a time
+    :param runs: list of paths to runs
+    :return: iterator over arrays of _RUN_DTYPE, together sorted from largest p-value to smallest
+    """
+    runs = [np.load(path, mmap_mode='r') for path in runs]
+    buffer_rows = max(1, chunk_rows // max(len(runs), 1))
+    buffers = [np.array(run[:buffer_rows]) for run in runs]
+    positions = [len(buf) for buf in buffers]
+    while any(len(buf) for buf in buffers):
+        # values still on disk are no larger than the last buffered value of their run
+        bound = max([buf['p'][-1] for buf, run, position in zip(buffers, runs, positions)
+                     if position < len(run)] or [-np.inf])
+        counts = [np.searchsorted(-buf['p'], -bound, side='right') for buf in buffers]
+        merged = np.concatenate([buf[:count] for buf, count in zip(buffers, counts)])
+        yield merged[np.argsort(-merged['p'], kind='mergesort')]
+        for index, count in enumerate(counts):
+            buffers[index] = buffers[index][count:]
+            if not len(buffers[index]) and positions[index] < len(runs[index]):
+                buffers[index] = np.array(runs[index][positions[index]:positions[index] + buffer_rows])
+                positions[index] += len(buffers[index])
+
+
+def _adjust_bh(runs, num_tests, adjusted, chunk_rows):
+    """ Fills Benjamini-Hochberg adjusted p-values, taking the running minimum of p * tests / rank from the largest
+    p-value down
+    :param runs: list of paths to runs
+    :param num_tests: number of p-values in all runs
+    :param adjusted: array over rows to fill
+    """
+    rank = num_tests
+    running = 1.
+    for merged in _merge_runs(runs, chunk_rows):
+        ranks = np.arange(rank, rank - len(merged), -1)
+        rank -= len(merged)
+        values = np.minimum.accumulate(np.minimum(merged['p'] * num_tests / ranks, running))
+        running = values[-1]
+        adjusted[merged['row']] = values
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Correct the p-values of csv output for multiple testing')
+    parser.add_argument('infile')
+    parser.add_argument('outfile')
+    parser.add_argument('--column', default='p', help='header of the p-value column')
+    parser.add_argument('--corrected-column', default='corrected p-value')
+    parser.add_argument('--method', choices=METHODS, default='bh')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='maximum p-values in memory at once')
+    args = parser.parse_args()
+    stats = correct_csv(args.infile, args.outfile, args.column, args.corrected_column, args.method, args.chunk_rows)
+    print '{rows} rows, {tests} tests, {runs} sorted runs in {seconds:.1f}s ({rows per second:.0f} rows/s)'.format(
+        **stats)
+
+
+if __name__ == '__main__':
+    main()
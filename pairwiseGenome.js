@@ -1,13 +1,17 @@
-// constant indices into each array element of data
-var COLOR = 4;
-var PROX_START = 0;
-var PROX_END = 1;
-var DIST_START = 2;
-var DIST_END = 3;
+// typed arrays of the dtypes of columnar.py
+var TYPED_ARRAYS = {
+    uint8: Uint8Array,
+    uint16: Uint16Array,
+    uint32: Uint32Array,
+    int32: Int32Array,
+    float32: Float32Array,
+    float64: Float64Array
+};
 
 var color_scale = 20;
 
-var COARSE_CUTOFF = 10000000;  // anything with a dimension smaller than this will be filtered
+var TILE_CELLS = 128;  // cells along each side of a rasterized tile, as in tiles.py
+var GENOME_TILE = [0, 0, 0, 0, 0];
 
 var genome_length = chrom_offsets[chrom_offsets.length-1];
 
@@ -24,33 +28,168 @@ var chart_group = chart.append("g");
 
 var x_axis = chart_group.append("g").attr("id", "x-axis");
 var y_axis = chart_group.append("g").attr("id", "y-axis");
-var rect_group = chart_group.append("g").attr("id", "rect_group");
 var chrom_group = chart_group.append("g").attr("id", "chrom_group");
 var x_chrom_labels = chart_group.append("g").attr("id", "x_chrom_labels");
 var y_chrom_labels = chart_group.append("g").attr("id", "y_chrom_labels");
 
-var visible_data;
+// results are drawn on a canvas under the chart, at the resolution of the screen
+var pixel_ratio = window.devicePixelRatio || 1;
+var canvas = d3.select("canvas.rects")
+    .attr("width", chart_width * pixel_ratio)
+    .attr("height", chart_height * pixel_ratio)
+    .style("width", chart_width + "px")
+    .style("height", chart_height + "px")
+    .node();
+var context = canvas.getContext("2d");
 
-if (is_ss_origins) {
-    visible_data = all_data[0];
+// decodes a payload written by columnar.encode(), viewing its columns in place
+function decodeBuffer(buffer) {
+    var header_length = new DataView(buffer).getUint32(0, true);
+    var header = JSON.parse(String.fromCharCode.apply(null, new Uint8Array(buffer, 8, header_length)));
+    var table = {length: header.length, header: header};
+    header.columns.forEach(function (column) {
+        table[column.name] = new TYPED_ARRAYS[column.dtype](buffer, 8 + header_length + column.offset, column.length);
+    });
+    return table;
+}
+
+// decodes a base64 encoded payload
+function decodeColumns(encoded) {
+    var binary = atob(encoded);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return decodeBuffer(bytes.buffer);
+}
+
+// the rows from start to stop of a table, as views of its columns
+function sliceTable(table, start, stop) {
+    var slice = {length: stop - start, header: table.header};
+    table.header.columns.forEach(function (column) {
+        if (column.length == table.length) {
+            slice[column.name] = table[column.name].subarray(start, stop);
+        }
+    });
+    return slice;
 }
-else {
-    visible_data = all_data;
+
+// the rows of a chromosome pair in a table of the whole result, a table per shown layer, sliced by its pair index
+function pairTables(table, pair) {
+    var num_chroms = table.header.chromosomes;
+    var layer = shownLayer();
+    var tables = [];
+    table.header.layers.forEach(function (color, l) {
+        var key = (l * num_chroms + pair[0]) * num_chroms + pair[1];
+        if ((layer === null || l == layer) && table.pair_index[key] < table.pair_index[key + 1]) {
+            tables.push(sliceTable(table, table.pair_index[key], table.pair_index[key + 1]));
+        }
+    });
+    return tables;
 }
 
-var coarse_data;
-function filter_coarse_data () {
-    coarse_data = visible_data.filter(function (d) {
-        return (d[PROX_END] - d[PROX_START] > COARSE_CUTOFF) && (d[DIST_END] - d[DIST_START] > COARSE_CUTOFF)
+// genome indices of the x start, x end, y start and y end of a tile, as in tiles.py
+function tileBounds(address) {
+    var level = address[0];
+    if (level == 0) {
+        return [0, genome_length, 0, genome_length];
+    }
+    var split = Math.pow(2, level - 1);
+    var bounds = [];
+    [[address[1], address[3]], [address[2], address[4]]].forEach(function (chrom_position) {
+        var start = chrom_offsets[chrom_position[0]];
+        var size = chrom_offsets[chrom_position[0] + 1] - start;
+        bounds.push(start + Math.floor(size * chrom_position[1] / split),
+            start + Math.floor(size * (chrom_position[1] + 1) / split));
     });
+    return bounds;
 }
-filter_coarse_data();
 
-function dataForChromPair(prox_target, dist_target) {
-    return visible_data.filter(function (d) {
-            return (d[PROX_START] >= chrom_offsets[prox_target] && d[PROX_END] <= chrom_offsets[prox_target+1] &&
-                d[DIST_START] >= chrom_offsets[dist_target] && d[DIST_END] <= chrom_offsets[dist_target+1]);
+// gives the cells of a rasterized tile interval columns, so that all tiles are drawn alike
+function tileTable(table) {
+    var tile = table.header.tile;
+    if (!tile.exact) {
+        var cell_width = (tile.bounds[1] - tile.bounds[0]) / tile.cells;
+        var cell_height = (tile.bounds[3] - tile.bounds[2]) / tile.cells;
+        ["prox_start", "prox_end", "dist_start", "dist_end"].forEach(function (name) {
+            table[name] = new Float64Array(table.length);
+        });
+        for (var i = 0; i < table.length; i++) {
+            table.prox_start[i] = tile.bounds[0] + table.x[i] * cell_width;
+            table.prox_end[i] = table.prox_start[i] + cell_width;
+            table.dist_start[i] = tile.bounds[2] + table.y[i] * cell_height;
+            table.dist_end[i] = table.dist_start[i] + cell_height;
+        }
+    }
+    return table;
+}
+
+// tiles by address, null while being fetched
+var tile_cache = {};
+tile_cache[GENOME_TILE] = tileTable(decodeColumns(payload));
+
+// returns a tile, or null after starting to fetch it from the app, calling back once fetched
+function fetchTile(address, callback) {
+    if (tile_cache.hasOwnProperty(address)) {
+        return tile_cache[address];
+    }
+    tile_cache[address] = null;
+    var form = new FormData();
+    for (var field in tile_request) {
+        if (tile_request.hasOwnProperty(field)) {
+            [].concat(tile_request[field]).forEach(function (value) {
+                form.append(field, value);
             });
+        }
+    }
+    form.append("tile", JSON.stringify(address));
+    var request = new XMLHttpRequest();
+    request.open("POST", window.location.href);
+    request.responseType = "arraybuffer";
+    request.onload = function () {
+        if (request.status == 200) {
+            tile_cache[address] = tileTable(decodeBuffer(request.response));
+            callback();
+        }
+    };
+    request.send(form);
+    return null;
+}
+
+function overlaps(bounds, view) {
+    return bounds[0] < view[1] && bounds[1] > view[0] && bounds[2] < view[3] && bounds[3] > view[2];
+}
+
+// tiles to draw over view of the chromosome pair, down to level or to exact tiles.  Tiles being fetched are stood
+// in for by their parent.
+function tilesInView(pair, view, level) {
+    var genome = tile_cache[GENOME_TILE];
+    if (genome.header.tile.exact) {
+        return pairTables(genome, pair);
+    }
+    function visit(address) {
+        if (!overlaps(tileBounds(address), view)) {
+            return [];
+        }
+        var tile = fetchTile(address, scheduleRedraw);
+        if (tile === null) {
+            return null;
+        }
+        if (tile.header.tile.exact || address[0] >= level) {
+            return [tile];
+        }
+        var shown = [];
+        var children_fetched = true;
+        for (var x = 2 * address[3]; x < 2 * address[3] + 2; x++) {
+            for (var y = 2 * address[4]; y < 2 * address[4] + 2; y++) {
+                var child = visit([address[0] + 1, pair[0], pair[1], x, y]);
+                children_fetched = children_fetched && child !== null;
+                shown = shown.concat(child || []);
+            }
+        }
+        return children_fetched ? shown : [tile];
+    }
+    return visit([1, pair[0], pair[1], 0, 0]) || [];
 }
 
 function unflattenIndex(k) {
@@ -187,33 +326,64 @@ function drawChromLabels() {
         });
 }
 
-function drawRects(data) {
-    var color_function, alpha;
-    if (is_ss_origins) {
-        color_function = function () {
-            return hexColorString(source_colors[$("input:radio:checked").attr("value")]);
-        };
-        alpha = 1 / num_samples;
-    }
-    else {
-        color_function = function (d) { return hexColorString(d[COLOR])};
-        alpha = null;
+// the layer of the checked origin combo, or null to show all layers
+function shownLayer() {
+    return is_ss_origins ? +$("input:radio:checked").attr("value") : null;
+}
+
+// tiles drawn, and whether they are to be painted at the next frame
+var drawn_tiles = [];
+var paint_requested = false;
+
+function drawRects(tiles) {
+    drawn_tiles = tiles;
+    if (!paint_requested) {
+        paint_requested = true;
+        window.requestAnimationFrame(paintRects);
     }
-    var rectangles = rect_group.selectAll("rect")
-        .data(data, function (d) { return d[PROX_START].toString() + d[DIST_START]});
-    rectangles.enter().append("rect").attr("fill-opacity", alpha);
-    rectangles
-        .attr("transform", function (d) {
-            return "translate(" + translate(d[PROX_START]) + "," + translate(d[DIST_START]) + ")";
-        })
-        .attr("width", function (d) {
-            return scale(d[PROX_END] - d[PROX_START]);
-        })
-        .attr("height", function (d) {
-            return scale(d[DIST_END] - d[DIST_START]);
-        })
-        .attr("fill", color_function);
-    rectangles.exit().remove();
+}
+
+// paints the rows of the shown layer of the drawn tiles in one pass over their columns, under the current zoom.
+// Positions are scaled here rather than by the context's transform, whose single precision is coarser than a pixel
+// at genome indices once zoomed in.
+function paintRects() {
+    paint_requested = false;
+    var layer = shownLayer();
+    var zoomed = zoomed_pair !== null;
+    var pixels = (zoomed ? zoom_scale : 1) * scale(1);
+    var x_origin = (zoomed ? zoom_translate[0] : 0) + (zoomed ? zoom_scale : 1) * margin;
+    var y_origin = (zoomed ? zoom_translate[1] : 0) + (zoomed ? zoom_scale : 1) * margin;
+    // rasterized cells are as opaque as the share of them covered, by results of every sample for origins
+    var weight = is_ss_origins ? 1 / num_samples : 1;
+    context.setTransform(pixel_ratio, 0, 0, pixel_ratio, 0, 0);
+    context.clearRect(0, 0, chart_width, chart_height);
+    context.globalAlpha = weight;
+    drawn_tiles.forEach(function (table) {
+        var exact = table.header.tile.exact;
+        var colors = table.header.layers.map(hexColorString);
+        var row_layer = -1;
+        for (var i = 0; i < table.length; i++) {
+            if (layer !== null && table.layer[i] != layer) {
+                continue;
+            }
+            var x = x_origin + pixels * table.prox_start[i];
+            var y = y_origin + pixels * table.dist_start[i];
+            var width = pixels * (table.prox_end[i] - table.prox_start[i]);
+            var height = pixels * (table.dist_end[i] - table.dist_start[i]);
+            if (x > chart_width || y > chart_height || x + width < 0 || y + height < 0) {
+                continue;
+            }
+            if (table.layer[i] != row_layer) {
+                row_layer = table.layer[i];
+                context.fillStyle = colors[row_layer];
+            }
+            if (!exact) {
+                context.globalAlpha = Math.min(1, table.coverage[i] * weight);
+            }
+            context.fillRect(x, y, width, height);
+        }
+        context.globalAlpha = weight;
+    });
 }
 
 function drawAxes(i, j, zoom_scale) {
@@ -243,15 +413,44 @@ function drawAxes(i, j, zoom_scale) {
         .attr("style", "stroke:#000;stroke-width:0.05");
 }
 
+// chromosome pair zoomed into, and the zoom's translation and scale, or null for the whole genome
+var zoomed_pair = null;
+var zoom_translate, zoom_scale;
+
+// draws the tile of the whole genome, or tiles of the visible part of the zoomed chromosome pair at about a cell per
+// pixel if the page can get them
+function redraw() {
+    if (zoomed_pair === null || (tile_request === null && !tile_cache[GENOME_TILE].header.tile.exact)) {
+        drawRects([tile_cache[GENOME_TILE]]);
+        return;
+    }
+    var view = [translate.invert(-zoom_translate[0] / zoom_scale),
+        translate.invert((chart_width - zoom_translate[0]) / zoom_scale),
+        translate.invert(-zoom_translate[1] / zoom_scale),
+        translate.invert((chart_height - zoom_translate[1]) / zoom_scale)];
+    var pixels = zoom_scale * Math.max(scale(chrom_sizes[zoomed_pair[0]]), scale(chrom_sizes[zoomed_pair[1]]));
+    var level = 1 + Math.max(0, Math.ceil(Math.log(pixels / TILE_CELLS) / Math.LN2));
+    drawRects(tilesInView(zoomed_pair, view, level));
+}
+
+// redraws once zooming pauses, or once fetched tiles arrive
+var redraw_timeout = null;
+function scheduleRedraw() {
+    clearTimeout(redraw_timeout);
+    redraw_timeout = setTimeout(redraw, 100);
+}
+
 function zoomToChromPair(i, j) {
     $("#slider").hide();
     $("#zoomout").show();
     chromo_rect.attr("display", "None");
-    drawRects(dataForChromPair(i, j));
-    var zoom_scale = Math.min(genome_length / chrom_sizes[i],
+    zoom_scale = Math.min(genome_length / chrom_sizes[i],
         genome_length / chrom_sizes[j]);
     var x = -translate(chrom_offsets[i]) * zoom_scale;
     var y = -translate(chrom_offsets[j]) * zoom_scale;
+    zoomed_pair = [i, j];
+    zoom_translate = [x, y];
+    redraw();
     chart_group.attr("transform",
         "translate(" + x + "," + y + ")scale(" + zoom_scale + ")");
     var zoom = d3.behavior.zoom()
@@ -261,12 +460,17 @@ function zoomToChromPair(i, j) {
         .translate([x, y])
         .scale(zoom_scale);
     chart.call(zoom.on("zoom", function () {
-        chart_group.attr("transform", "translate(" + d3.event.translate + ")" + "scale(" + d3.event.scale + ")")
+        chart_group.attr("transform", "translate(" + d3.event.translate + ")" + "scale(" + d3.event.scale + ")");
+        zoom_translate = d3.event.translate;
+        zoom_scale = d3.event.scale;
+        // the tiles shown follow at once, finer tiles once zooming pauses
+        drawRects(drawn_tiles);
+        scheduleRedraw();
     }));
     drawAxes(i, j, zoom_scale);
 }
 
-drawRects(coarse_data);
+redraw();
 var chromo_rect = drawChroms();
 //colorChroms();
 drawChromLabels();
@@ -278,16 +482,14 @@ $("#zoomout").hide().click( function () {
         chart_group.attr("transform", null);
         var zoom = d3.behavior.zoom().on('zoom', null);
         chart.call(zoom.on("zoom", null));
-        drawRects(coarse_data);
+        zoomed_pair = null;
+        redraw();
     }
 );
 
 $("input:radio").change(
-    function (e) {
-        var source = e.target.value;
-        visible_data = all_data[source];
-        filter_coarse_data();
-        drawRects(coarse_data)
+    function () {
+        redraw();
     }
 );
 
@@ -1,50 +1,260 @@
+"""
+File: pairwiseMarkers.py
+Purpose: Test every pair of markers on different chromosomes (or, within a window, on the same chromosome) for
+        association between their alleles.  Pairs are split into blocks on one pair of chromosomes, tested on a
+        pool of processes and written to per-block shards, which are merged at the end.
+        The genotype dump is converted once into a packed genotype store (see genotypeStore.py), and the 2x2
+        contingency tables of whole blocks of marker pairs are counted by popcount of the packed calls.
+"""
+
 import scipy.stats
 import numpy as np
+import argparse
 import csv
+import multiprocessing
+import os
+import shutil
+import tempfile
+from functools import partial
+import genotypeStore
+import multipleTesting
 
+HEADER = ['Proximal Marker', 'Proximal ChrB37', 'Proximal PosB37',
+          'Distal Marker', 'Distal ChrB37', 'Distal PosB37',
+          'Chi-squared', 'p', 'corrected p-value']
 
-def main():
-    genotype_dump = 'CC_3.csv'
-    outfile = 'outfile.csv'
-    with open(genotype_dump) as p_fp, open(genotype_dump) as d_fp, open(outfile, 'w+') as output_fp:
-        p_reader = csv.reader(p_fp)
-        d_reader = csv.reader(d_fp)
-        writer = csv.writer(output_fp)
-        writer.writerow(['Proximal Marker', 'Proximal ChrB37', 'Proximal PosB37',
-                         'Distal Marker', 'Distal ChrB37', 'Distal PosB37',
-                         'Chi-squared', 'p', 'corrected p-value'])
-        d_reader.next()  # skip header
-        table = np.empty([2, 2])
-        for d_row in d_reader:
-            filter_distal = False
-            p_fp.seek(0)
-            p_reader.next()  # skip header
-            d_present_alleles = []
-            for p_row in p_reader:
-                filter_proximal = False
-                if p_row[1] >= d_row[1]:
-                    break
-                table.fill(0)
-                p_present_alleles = []
-                for p_allele, d_allele in zip(p_row[4::2], d_row[4::2]):
-                    if p_allele not in p_present_alleles:
-                        p_present_alleles.append(p_allele)
-                        if p_allele == 'H' or len(p_present_alleles) > 2:
-                            filter_proximal = True
-                            break
-                    if d_allele not in d_present_alleles:
-                        d_present_alleles.append(d_allele)
-                        if d_allele == 'H' or len(d_present_alleles) > 2:
-                            filter_distal = True
-                            break
-                    table[p_present_alleles.index(p_allele), d_present_alleles.index(d_allele)] += 1
-                if filter_distal:
+# maximum number of marker pairs tested at once
+BLOCK_SIZE = 1 << 20
+
+
+def packed_contingency_tables(store, prox, dist):
+    """ Counts allele combinations for every pair of a proximal and a distal marker of a genotype store, from the
+    packed calls
+    :param store: genotypeStore.GenotypeStore
+    :param prox: proximal marker indices
+    :param dist: distal marker indices
+    :return: proximal markers x distal markers x 2 x 2 array of counts, indexed by proximal then distal allele
+    """
+    return tables_from_counts(store.pair_counts(prox, dist), store.allele_counts(prox), store.allele_counts(dist),
+                              store.num_samples)
+
+
+def tables_from_counts(both, prox_counts, dist_counts, num_samples):
+    """ Fills 2x2 contingency tables from the number of samples with the second allele of each marker
+    :param both: proximal markers x distal markers matrix of samples with the second allele at both markers
+    :param prox_counts: samples with the second allele of each proximal marker
+    :param dist_counts: samples with the second allele of each distal marker
+    :param num_samples: number of samples
+    :return: proximal markers x distal markers x 2 x 2 array of counts, indexed by proximal then distal allele
+    """
+    both = np.asarray(both, dtype=np.float64)
+    prox_counts = np.asarray(prox_counts, dtype=np.float64)[:, np.newaxis]
+    dist_counts = np.asarray(dist_counts, dtype=np.float64)[np.newaxis, :]
+    tables = np.empty(both.shape + (2, 2))
+    tables[..., 1, 1] = both
+    tables[..., 1, 0] = prox_counts - both
+    tables[..., 0, 1] = dist_counts - both
+    tables[..., 0, 0] = num_samples - prox_counts - dist_counts + both
+    return tables
+
+
+def chi2_contingency(tables, correction=True):
+    """ scipy.stats.chi2_contingency for whole arrays of 2x2 tables
+    :param tables: array of counts whose last two dimensions are 2 x 2 tables
+    :param correction: apply Yates' correction for continuity, default True (as does scipy)
+    :return: array of chi-squared statistics, array of p-values (both nan where an expected frequency is zero)
+    """
+    totals = tables.sum(axis=(-2, -1))[..., np.newaxis, np.newaxis]
+    old_settings = np.seterr(invalid='ignore', divide='ignore')
+    expected = tables.sum(axis=-1)[..., :, np.newaxis] * tables.sum(axis=-2)[..., np.newaxis, :] / totals
+    deviations = np.abs(tables - expected)
+    if correction:
+        # scipy moves each nonzero deviation 0.5 towards zero (newer versions stop at zero)
+        deviations = np.abs(deviations - 0.5 * (deviations > 0))
+    chi_squared = np.where(np.all(expected > 0, axis=(-2, -1)),
+                           np.sum(deviations ** 2 / expected, axis=(-2, -1)), np.nan)
+    np.seterr(**old_settings)
+    return chi_squared, scipy.stats.chi2.sf(chi_squared, 1)
+
+
+def marker_order(markers, testable, max_distance=None):
+    """ Orders the testable markers so that every block of marker pairs is a pair of ranges of the order
+    :param markers: list of (marker, chromosome, position), in file order
+    :param testable: boolean array of markers which can be tested
+    :param max_distance: if given, order for a cis-only scan (by chromosome, then position), else file order
+    :return: array of marker indices
+    """
+    order = np.flatnonzero(testable)
+    if max_distance is not None:
+        _, first_seen, chromosome_indices = np.unique([markers[i][1] for i in order], return_index=True,
+                                                      return_inverse=True)
+        positions = np.array([int(markers[i][2]) for i in order])
+        order = order[np.lexsort((order, positions, np.argsort(np.argsort(first_seen))[chromosome_indices]))]
+    return order
+
+
+def plan_blocks(markers, order, block_size=BLOCK_SIZE, max_distance=None):
+    """ Splits the marker pairs to test into blocks of at most block_size pairs on a single pair of chromosomes.
+    Without max_distance, each marker is tested against every marker before the first marker on a chromosome at or
+    after its own (chromosomes compared as strings, like the rows of the dump).  With max_distance, only pairs of
+    markers on the same chromosome and at most max_distance apart are tested.
+    :param markers: list of (marker, chromosome, position), in file order
+    :param order: testable markers, from marker_order()
+    :param block_size: maximum number of marker pairs in a block
+    :param max_distance: maximum distance between cis markers, default None for a trans scan
+    :return: list of blocks (first proximal, end of proximal, first distal, end of distal), as ranges of the order.
+    Pairs are only tested if the proximal marker comes first in the order
+    """
+    chromosomes = np.array([markers[i][1] for i in order])
+    run_starts = np.append(0, np.flatnonzero(chromosomes[1:] != chromosomes[:-1]) + 1) if len(order) else []
+    runs = zip(run_starts, np.append(run_starts[1:], len(order)))
+    blocks = []
+    if max_distance is None:
+        marker_chromosomes = np.array([chromosome for _, chromosome, _ in markers])
+        for dist_lo, dist_hi in runs:
+            # first marker of the file on a chromosome at or after the distal chromosome
+            limit = np.searchsorted(order, np.argmax(np.append(marker_chromosomes >= chromosomes[dist_lo], True)))
+            for prox_lo, prox_hi in runs:
+                if prox_lo >= limit:
                     break
-                elif not filter_proximal:
-                    try:
-                        writer.writerow(tuple(p_row[:3]) + tuple(d_row[:3]) + scipy.stats.chi2_contingency(table)[:2])
-                    except ValueError:
-                        pass  # had zero as expected
+                blocks.extend(_split_block(prox_lo, min(prox_hi, limit), dist_lo, dist_hi, block_size))
+    else:
+        positions = np.array([int(markers[i][2]) for i in order])
+        for run_lo, run_hi in runs:
+            window_starts = np.searchsorted(positions[run_lo:run_hi], positions[run_lo:run_hi] - max_distance) + run_lo
+            dist_lo = run_lo
+            while dist_lo < run_hi:
+                # as many distal markers as fit in a block with the markers within reach of the first
+                dist_hi = dist_lo + 1
+                while dist_hi < run_hi and (dist_hi + 1 - dist_lo) * (dist_hi + 1 - window_starts[dist_lo - run_lo]) \
+                        <= block_size:
+                    dist_hi += 1
+                blocks.extend(_split_block(window_starts[dist_lo - run_lo], dist_hi, dist_lo, dist_hi, block_size))
+                dist_lo = dist_hi
+    return blocks
+
+
+def _split_block(prox_lo, prox_hi, dist_lo, dist_hi, block_size):
+    """ Splits a pair of ranges into blocks of at most block_size pairs, skipping those with no proximal marker
+    before a distal marker
+    """
+    prox_step = max(1, min(prox_hi - prox_lo, block_size))
+    dist_step = max(1, block_size // prox_step)
+    return [(int(lo), int(min(lo + prox_step, prox_hi)), int(d_lo), int(min(d_lo + dist_step, dist_hi)))
+            for d_lo in xrange(dist_lo, dist_hi, dist_step)
+            for lo in xrange(prox_lo, prox_hi, prox_step)
+            if lo < min(d_lo + dist_step, dist_hi) - 1]
+
+
+def test_block(block, order, tables, positions=None, max_distance=None):
+    """ Tests the marker pairs of a block
+    :param block: (first proximal, end of proximal, first distal, end of distal), as ranges of the order
+    :param order: testable markers, from marker_order()
+    :param tables: function of proximal and distal marker indices returning their contingency tables, i.e.
+    packed_contingency_tables() bound to a store
+    :param positions: positions of the markers, in file order, for a cis-only scan
+    :param max_distance: maximum distance between cis markers, default None for a trans scan
+    :return: proximal marker indices, distal marker indices, chi-squared, p, ordered by distal marker then
+    proximal marker
+    """
+    prox_lo, prox_hi, dist_lo, dist_hi = block
+    prox = order[prox_lo:prox_hi]
+    dist = order[dist_lo:dist_hi]
+    chi_squared, p = chi2_contingency(tables(prox, dist))
+    tested = np.isfinite(chi_squared)
+    tested &= np.arange(prox_lo, prox_hi)[:, np.newaxis] < np.arange(dist_lo, dist_hi)[np.newaxis, :]
+    if max_distance is not None:
+        tested &= positions[dist][np.newaxis, :] - positions[prox][:, np.newaxis] <= max_distance
+    dist_indices, prox_indices = np.meshgrid(dist, prox, indexing='ij')
+    tested = tested.T
+    return prox_indices[tested], dist_indices[tested], chi_squared.T[tested], p.T[tested]
+
+
+def write_pairs(writer, markers, prox, dist, chi_squared, p):
+    """ Writes rows of tested marker pairs, as laid out by HEADER
+    """
+    writer.writerows(markers[p_index] + markers[d_index] + (chi_sq, p_value)
+                     for p_index, d_index, chi_sq, p_value in zip(prox, dist, chi_squared.tolist(), p.tolist()))
+
+
+def scan_store(store_path, outfile, num_workers=1, block_size=BLOCK_SIZE, max_distance=None, correction='bh'):
+    """ Tests the marker pairs of a genotype store on a pool of processes.  Each block is written to its own shard,
+    and the shards are concatenated in block order once all have been tested, so memory is bounded by the blocks
+    being tested rather than by the output.
+    :param store_path: directory of a genotype store (see genotypeStore.convert())
+    :param outfile: path to csv file
+    :param num_workers: number of processes testing blocks
+    :param block_size: maximum number of marker pairs in a block
+    :param max_distance: maximum distance between cis markers, default None for a trans scan
+    :param correction: multiple-testing correction of the p-values (see multipleTesting.py), or None
+    """
+    store = genotypeStore.GenotypeStore(store_path)
+    order = marker_order(store.markers, store.testable(), max_distance)
+    blocks = plan_blocks(store.markers, order, block_size, max_distance)
+    shard_dir = tempfile.mkdtemp(prefix='shards', dir=os.path.dirname(os.path.abspath(outfile)))
+    shards = [os.path.join(shard_dir, '%08d.csv' % index) for index in xrange(len(blocks))]
+    try:
+        args = (store_path, order, max_distance)
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers, _init_worker, args)
+            try:
+                for _ in pool.imap_unordered(_test_block_worker, zip(blocks, shards)):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_worker(*args)
+            for task in zip(blocks, shards):
+                _test_block_worker(task)
+        with open(outfile, 'w+') as output_fp:
+            csv.writer(output_fp).writerow(HEADER)
+            for shard in shards:
+                with open(shard) as shard_fp:
+                    shutil.copyfileobj(shard_fp, output_fp)
+                os.remove(shard)
+        if correction:
+            multipleTesting.correct_csv(outfile, outfile, 'p', 'corrected p-value', correction, work_dir=shard_dir)
+    finally:
+        shutil.rmtree(shard_dir)
+
+
+_worker_scan = {}
+
+
+def _init_worker(store_path, order, max_distance):
+    store = genotypeStore.GenotypeStore(store_path)
+    _worker_scan['markers'] = store.markers
+    _worker_scan['order'] = order
+    _worker_scan['tables'] = partial(packed_contingency_tables, store)
+    _worker_scan['max_distance'] = max_distance
+    _worker_scan['positions'] = None if max_distance is None else \
+        np.array([int(position) for _, _, position in store.markers])
+
+
+def _test_block_worker(task):
+    block, shard = task
+    results = test_block(block, _worker_scan['order'], _worker_scan['tables'], _worker_scan['positions'],
+                         _worker_scan['max_distance'])
+    with open(shard, 'w') as shard_fp:
+        write_pairs(csv.writer(shard_fp), _worker_scan['markers'], *results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Test marker pairs for association between their alleles')
+    parser.add_argument('--genotypes', default='CC_3.csv', help='genotype dump')
+    parser.add_argument('--store', default='CC_3.genotypes', help='genotype store, converted from the dump if absent')
+    parser.add_argument('--out', default='outfile.csv')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE, help='maximum marker pairs per block')
+    parser.add_argument('--max-distance', type=int, default=None,
+                        help='only test markers on the same chromosome at most this far apart')
+    parser.add_argument('--correction', choices=multipleTesting.METHODS + ('none',), default='bh')
+    args = parser.parse_args()
+    if not os.path.exists(args.store):
+        genotypeStore.convert(args.genotypes, args.store)
+    scan_store(args.store, args.out, args.workers, args.block_size, args.max_distance,
+               None if args.correction == 'none' else args.correction)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,618 @@
+"""
+File: queryService.py
+Purpose: Long-lived local query service, so that web requests don't each pay for interpreter startup, imports and
+        loading the sample dictionary.  The dictionary is loaded once, and queries run on a pool of worker
+        processes which inherit it when the pool is forked.  Requests and responses are JSON over HTTP, responses
+        streamed as they are encoded (see jsonStream.py):
+            GET  /strains                    list of available strains
+            GET  /genome                     chromosome offsets and sizes
+            GET  /stats                      number of queries, and of those coalesced with identical running ones
+            GET  /metrics                    latency histograms, cache and coalescing hit rates, pool queue depth and
+                                             bytes serialized, as plain text (see QueryServer.metrics())
+            POST /<query>                    keyword arguments of a TwoLocus query (see QUERIES), returns its result,
+                                             or for contingency_table the csv it writes (see FILE_QUERIES)
+            POST /<query>.bin                the same, returning the result laid out by chromosome pair in binary
+                                             columns (see columnar.py)
+            POST /<query>.tile               the same with a "tile" address, returning that tile of the result (see
+                                             tiles.py), from tiles cached for the query
+        Arguments are checked before a query runs (see _check_arguments()): a malformed request is answered 400 and a
+        query which fails 500, each with {"error": message}.
+        python queryService.py --path /csbiodata/.../pairwise_origins/ --workers 4
+        QueryClient stands in for TwoLocus in the web apps.  With --trace, the stages of every query (see
+        stageTimer.py) and of every request are logged.  A summary of the metrics is logged every
+        --metrics-interval seconds.
+"""
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+import numpy as np
+import columnar
+import jsonStream
+import multipleTesting
+import stageTimer
+import tiles
+from collections import OrderedDict, Counter
+
+DATA_PATH = '/csbiodata/public/www.csbio.unc.edu/htdocs/sgreens/pairwise_origins/'
+SERVICE_ADDRESS = ('127.0.0.1', 8650)
+
+# TwoLocus methods served, run on the worker processes
+QUERIES = ('unique_combos', 'not_in_background', 'pairwise_frequencies', 'absent_regions', 'sources_at_point_pair',
+           'contingency_table')
+# queries whose results can be laid out by chromosome pair, and so served as binary columns and tiles
+LAYOUT_QUERIES = ('unique_combos', 'not_in_background', 'pairwise_frequencies', 'absent_regions')
+# queries which write their result to a file, by the argument naming it.  The service names the file, in a directory
+# of its own, and returns its contents: a path from a client would let it overwrite any file the service can write.
+FILE_QUERIES = {'contingency_table': 'output_file'}
+
+# arguments of queries which name strains, and which give a locus by chromosome and position
+STRAIN_ARGUMENTS = ('strain_names', 'background_strains', 'foreground_strains', 'dead_strains', 'live_strains')
+LOCUS_ARGUMENTS = (('chrom1', 'pos1'), ('chrom2', 'pos2'))
+
+# queries whose tiles are cached
+PYRAMIDS_CACHED = 16
+
+# upper bounds of the buckets of request latency histograms, in seconds
+LATENCY_BUCKETS = (0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100)
+# upper bounds of the buckets of the number of strains of a query
+STRAIN_BUCKETS = (1, 4, 16, 64, 256)
+# seconds between log lines of metrics
+METRICS_INTERVAL = 300
+
+# the TwoLocus instance of the service and the directory of its files, inherited by workers when the pool is forked
+_service = {}
+
+
+def _to_str(o):
+    """ Converts the unicode strings decoded from json to str, as used for strain names and chromosomes
+    """
+    if isinstance(o, unicode):
+        return str(o)
+    elif isinstance(o, list):
+        return [_to_str(v) for v in o]
+    elif isinstance(o, dict):
+        return {_to_str(k): _to_str(v) for k, v in o.iteritems()}
+    return o
+
+
+def _query_key(name, kwargs):
+    """ Normalizes a query, so that identical queries are computed once.  Lists of strains keep their order, which
+    some results follow (sources_at_point_pair() lists strains in the order asked for).
+    >>> _query_key('unique_combos', {'foreground_strains': ['B'], 'background_strains': ['A', 'C']})
+    '["unique_combos", {"background_strains": ["A", "C"], "foreground_strains": ["B"]}]'
+    >>> len({_query_key('sources_at_point_pair', {'strain_names': names}) for names in (['B', 'A'], ['A', 'B'])})
+    2
+
+    :return: hashable key
+    """
+    return json.dumps([name, kwargs], sort_keys=True)
+
+
+def _check_arguments(two_locus, name, kwargs):
+    """ Checks the keyword arguments of a query before it runs, so that a malformed request is told apart from a
+    query which fails
+    :param two_locus: TwoLocus instance of the service
+    :param name: one of QUERIES
+    :param kwargs: keyword arguments decoded from the request
+    :raises: ValueError describing the first invalid argument
+    """
+    import twolocus
+    if not isinstance(kwargs, dict):
+        raise ValueError('Arguments must be an object')
+    args, _, _, defaults = inspect.getargspec(getattr(two_locus, name))
+    args = [arg for arg in args[1:] if arg != FILE_QUERIES.get(name)]
+    for key in kwargs:
+        if key == FILE_QUERIES.get(name):
+            raise ValueError(key + ' is named by the service')
+        elif key not in args:
+            raise ValueError('Unknown argument ' + key)
+    for key in args[:len(args) - len(defaults or ())]:
+        if key not in kwargs:
+            raise ValueError('Missing argument ' + key)
+    for key in STRAIN_ARGUMENTS:
+        if key not in kwargs:
+            continue
+        strains = kwargs[key]
+        if not isinstance(strains, list) or not strains or not all(isinstance(strain, str) for strain in strains):
+            raise ValueError(key + ' must be a list of strain names')
+        unknown = [strain for strain in strains if not two_locus.is_available(strain)]
+        if unknown:
+            raise ValueError('Unknown strains ' + ', '.join(unknown))
+    for chrom_key, pos_key in LOCUS_ARGUMENTS:
+        if chrom_key not in kwargs:
+            continue
+        chromosome = kwargs[chrom_key]
+        if isinstance(chromosome, str):
+            chromosome = twolocus.CHROMO_TO_INT.get(chromosome)
+        if type(chromosome) is not int or not 1 <= chromosome <= len(two_locus.sizes):
+            raise ValueError('Unknown chromosome %s' % (kwargs[chrom_key],))
+        position = kwargs.get(pos_key)
+        if type(position) not in (int, long) or not 0 <= position < two_locus.sizes[chromosome - 1]:
+            raise ValueError('%s must be a position on chromosome %s' % (pos_key, kwargs[chrom_key]))
+    if kwargs.get('backend') not in (None,) + twolocus.COUNTING_BACKENDS:
+        raise ValueError('Unknown backend %s' % (kwargs['backend'],))
+    if kwargs.get('correction') not in (None,) + multipleTesting.METHODS:
+        raise ValueError('Unknown correction %s' % (kwargs['correction'],))
+    if not isinstance(kwargs.get('by_chromosome_pair', False), bool):
+        raise ValueError('by_chromosome_pair must be true or false')
+
+
+def _num_strains(kwargs):
+    """
+    :return: number of strains named in the keyword arguments of a query
+    """
+    return sum(len(value) for value in kwargs.itervalues() if isinstance(value, list))
+
+
+def _strain_bucket(num_strains):
+    """
+    :return: label of the bucket of STRAIN_BUCKETS holding a number of strains
+    """
+    for bound in STRAIN_BUCKETS:
+        if num_strains <= bound:
+            return '<=%d' % bound
+    return '>%d' % STRAIN_BUCKETS[-1]
+
+
+def _run_query(name, kwargs):
+    """
+    :return: result of a query, or the contents of the file written by one of FILE_QUERIES
+    """
+    query = getattr(_service['two_locus'], name)
+    if name not in FILE_QUERIES:
+        return query(**kwargs)
+    handle, path = tempfile.mkstemp(suffix='.csv', dir=_service['output_dir'])
+    os.close(handle)
+    try:
+        query(**dict(kwargs, **{FILE_QUERIES[name]: path}))
+        with open(path) as fp:
+            return fp.read()
+    finally:
+        os.remove(path)
+
+
+def _query_worker(task):
+    """
+    :return: result of the query (see _run_query()), report of its stages or None if not traced
+    """
+    name, kwargs, trace = task
+    if not trace:
+        return _run_query(name, kwargs), None
+    stageTimer.start(name)
+    try:
+        result = _run_query(name, kwargs)
+    finally:
+        report = stageTimer.finish()
+    return result, report
+
+
+class _Flight:
+    """ A query being computed, whose result or error identical queries wait for.  (Waiting on a shared
+    AsyncResult would wake only one of them.)
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Histogram:
+    """ Counts of observations at most each bucket bound, cumulatively, with their number and sum
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, two_locus, address=SERVICE_ADDRESS, num_workers=1, trace=False,
+                 metrics_interval=METRICS_INTERVAL):
+        """ Serves queries of a TwoLocus instance
+        :param two_locus: TwoLocus instance, counting serially (its workers can't start pools of their own)
+        :param address: (host, port) to listen on
+        :param num_workers: number of processes running queries
+        :param trace: True to log the stages of queries and requests
+        :param metrics_interval: seconds between log lines of metrics, or None not to log them
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, QueryHandler)
+        self.two_locus = two_locus
+        _service['two_locus'] = two_locus
+        # readable only by the service
+        self.output_dir = _service['output_dir'] = tempfile.mkdtemp(prefix='queryService')
+        # built before the pool is forked, so that workers share it even if the store has none
+        two_locus.breakpoint_index()
+        self.pool = multiprocessing.Pool(num_workers)
+        self.num_workers = num_workers
+        self.trace = trace
+        # queries being computed, by normalized query
+        self._in_flight = {}
+        # tile pyramids by normalized query, least recently used first
+        self._pyramids = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_queries = 0
+        self.num_coalesced = 0
+        self.start_time = time.time()
+        # metrics (see metrics()), under the lock
+        self.counters = Counter()
+        self.bytes_serialized = Counter()
+        self.latencies = {}
+        self.on_pool = 0
+        self.max_queued = 0
+        self._closed = threading.Event()
+        if metrics_interval:
+            thread = threading.Thread(target=self._log_metrics, args=(metrics_interval,))
+            thread.daemon = True
+            thread.start()
+
+    def query(self, name, kwargs):
+        """ Runs a query on a worker, blocking only the calling request thread.  Identical queries arriving while
+        it runs wait for the same result rather than computing their own.
+        :param name: one of QUERIES
+        :param kwargs: keyword arguments of the query
+        :return: result of the query
+        """
+        key = _query_key(name, kwargs)
+        with self._lock:
+            self.num_queries += 1
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+            else:
+                self.num_coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        with self._lock:
+            self.on_pool += 1
+            self.max_queued = max(self.max_queued, self.on_pool - self.num_workers)
+        try:
+            with stageTimer.stage('query'):
+                flight.result, report = self.pool.apply(_query_worker, ((name, kwargs, self.trace),))
+            if report is not None:
+                logging.info('query stages %s', json.dumps(report))
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self.on_pool -= 1
+                del self._in_flight[key]
+            flight.done.set()
+
+    def tile(self, name, kwargs, address):
+        """ Gets a tile of a query's result, running the query and indexing its result for tiling only the first time
+        :param name: one of QUERIES
+        :param kwargs: keyword arguments of the query
+        :param address: (level, proximal chromosome, distal chromosome, x, y), see tiles.py
+        :return: payload of the tile
+        """
+        key = _query_key(name, kwargs)
+        with self._lock:
+            pyramid = self._pyramids.pop(key, None)
+            if pyramid is not None:
+                self._pyramids[key] = pyramid
+        self.count('tile cache hits' if pyramid is not None else 'tile cache misses')
+        if pyramid is None:
+            columns, header = columnar.layout_columns(name, self.query(name, dict(kwargs, by_chromosome_pair=True)))
+            pyramid = tiles.Pyramid(columns, header, self.two_locus.offsets)
+            with self._lock:
+                self._pyramids[key] = pyramid
+                while len(self._pyramids) > PYRAMIDS_CACHED:
+                    self._pyramids.popitem(last=False)
+        return pyramid.tile(*address)
+
+    def observe(self, operation, num_strains, seconds):
+        """ Records the latency of a request
+        :param operation: query and encoding requested, e.g. 'unique_combos.tile'
+        :param num_strains: number of strains of the query
+        :param seconds: time taken to respond
+        """
+        key = (operation, _strain_bucket(num_strains))
+        with self._lock:
+            if key not in self.latencies:
+                self.latencies[key] = _Histogram(LATENCY_BUCKETS)
+            self.latencies[key].observe(seconds)
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def count_bytes(self, content_type, num_bytes):
+        with self._lock:
+            self.bytes_serialized[content_type] += num_bytes
+
+    def stats(self):
+        """
+        :return: dictionary of the number of queries, those which shared another's computation and those running,
+        requests rejected and queries failed, hit rates of coalescing and the tile cache, the depth of the worker
+        pool's queue and bytes serialized
+        """
+        with self._lock:
+            tile_requests = self.counters['tile cache hits'] + self.counters['tile cache misses']
+            return {'queries': self.num_queries, 'coalesced': self.num_coalesced, 'in flight': len(self._in_flight),
+                    'coalescing hit rate': float(self.num_coalesced) / self.num_queries if self.num_queries else 0.,
+                    'tile cache hit rate':
+                        float(self.counters['tile cache hits']) / tile_requests if tile_requests else 0.,
+                    'queued': max(0, self.on_pool - self.num_workers), 'max queued': self.max_queued,
+                    'rejected': self.counters['rejected'], 'failed': self.counters['failed'],
+                    'bytes serialized': sum(self.bytes_serialized.values()),
+                    'requests': sum(histogram.count for histogram in self.latencies.itervalues())}
+
+    def metrics(self):
+        """ Metrics of the service in the plain text format of Prometheus, so that they can be read or scraped:
+            <name>{<label>="<value>",...} <value>
+        Request latencies are histograms by operation and strain count bucket.
+        :return: text
+        """
+        stats = self.stats()
+        lines = ['uptime_seconds %.3f' % (time.time() - self.start_time)]
+        for name in ('queries', 'coalesced', 'coalescing hit rate', 'tile cache hit rate', 'in flight', 'queued',
+                     'max queued', 'rejected', 'failed'):
+            lines.append('%s %s' % (name.replace(' ', '_'), stats[name]))
+        with self._lock:
+            for name in ('tile cache hits', 'tile cache misses'):
+                lines.append('%s %d' % (name.replace(' ', '_'), self.counters[name]))
+            for content_type, num_bytes in sorted(self.bytes_serialized.iteritems()):
+                lines.append('bytes_serialized{content_type="%s"} %d' % (content_type, num_bytes))
+            for (operation, strains), histogram in sorted(self.latencies.iteritems()):
+                labels = 'operation="%s",strains="%s"' % (operation, strains)
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    lines.append('request_seconds_bucket{%s,le="%g"} %d' % (labels, bound, count))
+                lines.append('request_seconds_bucket{%s,le="+Inf"} %d' % (labels, histogram.count))
+                lines.append('request_seconds_sum{%s} %.6f' % (labels, histogram.sum))
+                lines.append('request_seconds_count{%s} %d' % (labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def _log_metrics(self, interval):
+        while not self._closed.wait(interval):
+            logging.info('metrics %s', json.dumps(self.stats(), sort_keys=True))
+
+    def server_close(self):
+        self._closed.set()
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        two_locus = self.server.two_locus
+        if self.path == '/strains':
+            self._respond(200, two_locus.list_available_strains())
+        elif self.path == '/genome':
+            self._respond(200, {'offsets': two_locus.offsets, 'sizes': two_locus.sizes})
+        elif self.path == '/stats':
+            self._respond(200, self.server.stats())
+        elif self.path == '/metrics':
+            self._send(200, self.server.metrics(), 'text/plain; version=0.0.4')
+        else:
+            self._respond(404, {'error': 'Unknown path ' + self.path})
+
+    def do_POST(self):
+        name, _, encoding = self.path.strip('/').partition('.')
+        if name not in QUERIES or encoding not in ('', 'bin', 'tile') or (encoding and name not in LAYOUT_QUERIES):
+            self._respond(404, {'error': 'Unknown query ' + self.path})
+            return
+        start = time.time()
+        if self.server.trace:
+            stageTimer.start(self.path)
+        kwargs = None
+        try:
+            kwargs, address = self._read_query(name, encoding)
+            if kwargs is not None:
+                self._answer_query(name, encoding, kwargs, address)
+        finally:
+            report = stageTimer.finish()
+            if report is not None:
+                logging.info('request stages %s', json.dumps(report))
+            if kwargs is not None:
+                self.server.observe(self.path.strip('/'), _num_strains(kwargs), time.time() - start)
+
+    def _read_query(self, name, encoding):
+        """ Reads and checks the arguments of a query, responding 400 if they are malformed
+        :return: keyword arguments of the query and tile address, or None, None if it was rejected
+        """
+        try:
+            kwargs = _to_str(json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0)))))
+            address = None
+            if encoding == 'tile':
+                if not isinstance(kwargs, dict) or not isinstance(kwargs.get('tile'), list):
+                    raise ValueError('Missing tile address')
+                address = [int(i) for i in kwargs.pop('tile')]
+                tiles.check_address(address, len(self.server.two_locus.sizes))
+            _check_arguments(self.server.two_locus, name, kwargs)
+        except (ValueError, TypeError) as e:
+            self.server.count('rejected')
+            self._respond(400, {'error': '%s: %s' % (type(e).__name__, e)})
+            return None, None
+        return kwargs, address
+
+    def _answer_query(self, name, encoding, kwargs, address):
+        """ Runs a query and responds with its result, or 500 if it failed
+        """
+        try:
+            if encoding == 'tile':
+                body = self.server.tile(name, kwargs, address)
+            elif encoding == 'bin':
+                body = columnar.encode_layout(name, self.server.query(name, dict(kwargs, by_chromosome_pair=True)))
+            else:
+                result = self.server.query(name, kwargs)
+        except Exception as e:
+            logging.exception('%s failed', self.path)
+            self.server.count('failed')
+            self._respond(500, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        if encoding:
+            self._send(200, body, 'application/octet-stream')
+        elif name in FILE_QUERIES:
+            self._send(200, result, 'text/csv')
+        else:
+            self._respond(200, result)
+
+    def _respond(self, status, obj):
+        """ Writes JSON a chunk at a time as it is encoded, so that a large result isn't held as one string.  Without
+        a Content-Length, the end of the body is the end of the connection (closed after every HTTP/1.0 request).
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        with stageTimer.stage('serialization'):
+            num_bytes = jsonStream.dump(obj, self.wfile)
+        self.server.count_bytes('application/json', num_bytes)
+
+    def _send(self, status, body, content_type):
+        self.server.count_bytes(content_type, len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info('%s %s', self.address_string(), format % args)
+
+
+class QueryClient:
+    def __init__(self, address=SERVICE_ADDRESS, timeout=600):
+        """ Connects to a query service, standing in for a TwoLocus instance
+        :param address: (host, port) of the service
+        :param timeout: seconds to wait for a query
+        :raises: IOError if the service can't be reached
+        """
+        self.url = 'http://%s:%d/' % address
+        self.timeout = timeout
+        genome = self._request('genome')
+        self.offsets = np.array(genome['offsets'])
+        self.sizes = genome['sizes']
+        self._strains = None
+
+    def _request(self, path, kwargs=None):
+        """
+        :param path: endpoint
+        :param kwargs: keyword arguments of a query to post, or None to get
+        :return: decoded response
+        :raises: ValueError if the service rejected the query, RuntimeError if the query failed, IOError if the service
+        couldn't be reached
+        """
+        response = self._open(path, kwargs)
+        return _to_str(json.load(response))
+
+    def _open(self, path, kwargs=None):
+        """
+        :return: file-like response
+        :raises: ValueError if the service rejected the query, RuntimeError if the query failed, IOError if the service
+        couldn't be reached
+        """
+        data = None if kwargs is None else json.dumps(kwargs)
+        try:
+            return urllib2.urlopen(urllib2.Request(self.url + path, data, {'Content-Type': 'application/json'}),
+                                   timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 400:
+                raise ValueError(json.load(e)['error'])
+            elif e.code == 500:
+                raise RuntimeError(json.load(e)['error'])
+            raise
+
+    def list_available_strains(self):
+        if self._strains is None:
+            self._strains = self._request('strains')
+        return self._strains
+
+    def is_available(self, strain):
+        return strain in self.list_available_strains()
+
+    def columns(self, query, **kwargs):
+        """ Runs a query, getting its result encoded by columnar.encode_layout()
+        :param query: one of QUERIES
+        :param kwargs: keyword arguments of the query
+        :return: payload string
+        """
+        return self._open(query + '.bin', kwargs).read()
+
+    def tile(self, query, address, **kwargs):
+        """ Gets a tile of a query's result, cached by the service
+        :param query: one of QUERIES
+        :param address: (level, proximal chromosome, distal chromosome, x, y), see tiles.py
+        :param kwargs: keyword arguments of the query
+        :return: payload of the tile
+        """
+        return self._open(query + '.tile', dict(kwargs, tile=address)).read()
+
+    def unique_combos(self, background_strains, foreground_strains):
+        return self._request('unique_combos', {'background_strains': background_strains,
+                                               'foreground_strains': foreground_strains})
+
+    def not_in_background(self, background_strains, foreground_strains):
+        return self._request('not_in_background', {'background_strains': background_strains,
+                                                   'foreground_strains': foreground_strains})
+
+    def pairwise_frequencies(self, strain_names):
+        return self._request('pairwise_frequencies', {'strain_names': strain_names})
+
+    def absent_regions(self, strain_names):
+        return self._request('absent_regions', {'strain_names': strain_names})
+
+    def sources_at_point_pair(self, chrom1, pos1, chrom2, pos2, strain_names):
+        return self._request('sources_at_point_pair', {'chrom1': chrom1, 'pos1': pos1, 'chrom2': chrom2,
+                                                       'pos2': pos2, 'strain_names': strain_names})
+
+    def contingency_table(self, dead_strains, live_strains, output_file, correction='bh'):
+        """ Writes the table the service returns, from this process
+        """
+        response = self._open('contingency_table', {'dead_strains': dead_strains, 'live_strains': live_strains,
+                                                    'correction': correction})
+        with open(output_file, 'w+') as fp:
+            shutil.copyfileobj(response, fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve TwoLocus queries')
+    parser.add_argument('--path', default=DATA_PATH, help='directory of the sample dictionary')
+    parser.add_argument('--host', default=SERVICE_ADDRESS[0])
+    parser.add_argument('--port', type=int, default=SERVICE_ADDRESS[1])
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--trace', action='store_true', help='log the stages of every query and request')
+    parser.add_argument('--metrics-interval', type=float, default=METRICS_INTERVAL,
+                        help='seconds between log lines of metrics, 0 not to log them')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    import twolocus
+    server = QueryServer(twolocus.TwoLocus(args.path), (args.host, args.port), args.workers, args.trace,
+                         args.metrics_interval)
+    logging.info('serving %d strains on %s:%d', len(server.two_locus.sample_dict), args.host, args.port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+"""
+File: setup.py
+Purpose: Compiles the Cython extension modules ahead of time, so that web requests never compile at import time.
+        python setup.py build_ext --inplace
+        Without the compiled modules, twolocus falls back to subspecies.py and kernels.py.
+"""
+
+from distutils.core import setup
+from distutils.extension import Extension
+from Cython.Build import cythonize
+
+setup(
+    name='pairwise-subspecific-origins',
+    ext_modules=cythonize([
+        Extension('subspeciesCython', ['subspeciesCython.pyx']),
+        Extension('kernelsCython', ['kernelsCython.pyx'], extra_compile_args=['-O3']),
+    ], compiler_directives={'language_level': 2}),
+)
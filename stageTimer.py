@@ -0,0 +1,161 @@
+"""
+File: stageTimer.py
+Purpose: Per-stage timing of queries, to see where a slow query spends its time and memory.  A trace is started on
+        the thread running a query, and the code it runs marks its stages, either as blocks or as functions:
+            with stageTimer.stage('statistics'):
+                ...
+            @stageTimer.timed('matrix build')
+            def build_pairwise_matrix(...):
+        Stages nest, and are named by their path ('elementary intervals', 'layout/serialization').  Repeated stages
+        of the same path are summed.  Each records its wall and CPU seconds, and the high-water mark of resident
+        memory (from getrusage) when it last ended, with how far the stage raised it.  Worker processes count towards
+        children_max_rss_kb once they have exited.
+        finish() returns the trace as a JSON-serializable report:
+            {"query": name, "seconds": total, "cpu_seconds": total, "max_rss_kb": high-water mark,
+             "stages": [{"stage", "calls", "seconds", "cpu_seconds", "max_rss_kb", "rss_growth_kb",
+                         "children_max_rss_kb"}, ...]}
+        Without a trace running on the thread, stage() costs a thread-local lookup.  The web apps trace queries when
+        the TWOLOCUS_TRACE environment variable is set, and the query service with --trace.
+"""
+
+import functools
+import os
+import resource
+import threading
+import time
+
+ENABLED = bool(os.environ.get('TWOLOCUS_TRACE'))
+
+_local = threading.local()
+
+
+def _cpu_seconds():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def _max_rss(who=resource.RUSAGE_SELF):
+    """
+    :return: high-water mark of resident memory in kilobytes (as Linux reports it)
+    """
+    return resource.getrusage(who).ru_maxrss
+
+
+class _NullStage:
+    """ Stands in for a stage while nothing is traced
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.trace.path.append(self.name)
+        self.start = time.time()
+        self.cpu_start = _cpu_seconds()
+        self.rss_start = _max_rss()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.record('/'.join(self.trace.path), time.time() - self.start, _cpu_seconds() - self.cpu_start,
+                          self.rss_start)
+        self.trace.path.pop()
+        return False
+
+
+class _Trace:
+    def __init__(self, query):
+        self.query = query
+        self.path = []
+        # stage reports by path, in the order stages first started
+        self.stages = []
+        self._by_path = {}
+        self.start = time.time()
+        self.cpu_start = _cpu_seconds()
+
+    def record(self, path, seconds, cpu_seconds, rss_start):
+        stage = self._by_path.get(path)
+        if stage is None:
+            stage = self._by_path[path] = {'stage': path, 'calls': 0, 'seconds': 0., 'cpu_seconds': 0.,
+                                           'rss_growth_kb': 0}
+            self.stages.append(stage)
+        max_rss = _max_rss()
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+        stage['cpu_seconds'] += cpu_seconds
+        stage['max_rss_kb'] = max_rss
+        stage['rss_growth_kb'] += max_rss - rss_start
+        stage['children_max_rss_kb'] = _max_rss(resource.RUSAGE_CHILDREN)
+
+    def report(self):
+        return {'query': self.query, 'seconds': time.time() - self.start,
+                'cpu_seconds': _cpu_seconds() - self.cpu_start, 'max_rss_kb': _max_rss(), 'stages': self.stages}
+
+
+def start(query):
+    """ Starts tracing the stages run on this thread, or names the trace already running (as when the sample
+    dictionary is loaded before the query is known)
+    :param query: name of the query traced
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        _local.trace = _Trace(query)
+    else:
+        trace.query = query
+
+
+def finish():
+    """ Stops tracing the stages run on this thread
+    >>> start(None)
+    >>> for _ in xrange(2):
+    ...     with stage('layout'):
+    ...         with stage('serialization'):
+    ...             pass
+    >>> start('unique_combos')
+    >>> report = finish()
+    >>> report['query'], [(entry['stage'], entry['calls']) for entry in report['stages']]
+    ('unique_combos', [('layout/serialization', 2), ('layout', 2)])
+    >>> report['stages'][0]['seconds'] <= report['stages'][1]['seconds'] <= report['seconds']
+    True
+    >>> finish() is None
+    True
+
+    :return: report of the trace (see module docstring), or None if none was running
+    """
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    return trace.report() if trace is not None else None
+
+
+def stage(name):
+    """
+    :param name: name of the stage
+    :return: context manager timing the stage, if a trace is running on this thread
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _NULL_STAGE
+    return _Stage(trace, name)
+
+
+def timed(name):
+    """ Decorates a function as a stage
+    :param name: name of the stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -18,15 +18,19 @@ Purpose: Provide methods for working with subspecies and combinations of subspec
 ...                    print 'Failed'
 """
 
+import numpy as np
+
 DOM = 0b001
 MUS = 0b010
 CAS = 0b100
 UNK = 0b1000
 NUM_SUBSPECIES = 3
 
+UNKNOWN = UNK
+
 _SHIFT = 4
-_PROXIMAL_MASK = 0b111 << _SHIFT
-_DISTAL_MASK = 0b111
+_PROXIMAL_MASK = 0b1111 << _SHIFT
+_DISTAL_MASK = 0b1111
 
 
 def combine(proximal_origin, distal_origin):
@@ -49,6 +53,7 @@ _combos = []
 
 def iter_subspecies(include_unknown=False):
     """ an iterator for all subspecies
+    :param include_unknown: Include combos with UNK as one of the sources, default False
     """
     return _subspecies_ints[:len(_subspecies_ints) - (not include_unknown)]
 
@@ -63,6 +68,7 @@ _combos.append(combine(UNK, UNK))
 
 def iter_combos(include_unknown=False):
     """ an iterator for all combinations of subspecies
+    :param include_unknown: Include combos with UNK as one of the sources, default False
     """
     if include_unknown:
         return _combos
@@ -76,17 +82,39 @@ for n, c in enumerate(iter_combos(True)):
     combo_names.append(_int_to_str[c])
 
 
-def ordinal(combo):
+def to_color(integer, ordinal=False):
+    """
+    :param integer: int representation of subspecies or subspecies combo
+    :param ordinal: if the integer is the ordinal representation, default False
+    :return: integer representing the rgb color
+    >>> to_color(combine(DOM, MUS)) == to_color(to_ordinal(combine(DOM, MUS)), True)
+    True
+    """
+    if ordinal:
+        return _ORDINAL_COLORS[integer]
+    return _COLORS[integer]
+
+
+def to_ordinal(integer):
     """
-    :param combo: int representation of subspecies combo
+    :param integer: int representation of subspecies combo
     :return: integer in the range 0...num combos/subspecies
+    >>> to_ordinal(MUS) == iter_subspecies().index(MUS)
+    True
+    >>> to_ordinal(combine(DOM, CAS)) == iter_combos().index(combine(DOM, CAS))
+    True
     """
-    return combo_nums[combo]
+    if proximal(integer):
+        return combo_nums[integer]
+    return iter_subspecies(True).index(integer)
+
+ordinal = to_ordinal
 
 
 def to_string(integer, ordinal=False):
     """
     :param integer: int representation of subspecies
+    :param ordinal: if the integer is the ordinal representation, default False
     :return: subspecies name
     >>> to_string(DOM)
     'dom'
@@ -107,7 +135,7 @@ def to_int(string):
     """
     # TODO: remove stuff about "bad" (residual heterozygosity)
     if len(string) == 2:
-        return 'bad'
+        return -999
     return _subspecies_ints[_subspecies_names.index(string.lower())]
 
 
@@ -182,6 +210,74 @@ def distal(combo):
     """
     return combo & _DISTAL_MASK
 
+# colors depend on proximal() and distal(), so are only computed once those are defined
+_COLORS = {DOM: 0x0000ff, MUS: 0xff0000, CAS: 0x00ff00}
+_ORDINAL_COLORS = []
+
+for combo in iter_combos():
+    prox_color = _COLORS[proximal(combo)]
+    dist_color = _COLORS[distal(combo)]
+    color = ((prox_color >> 1) & prox_color) + ((dist_color >> 1) & dist_color)
+    _ORDINAL_COLORS.append(color)
+    _COLORS[combo] = color
+
+
+# lookup tables over every 8 bit int, for mapping whole arrays of subspecies or combos at once
+_ORDINAL_TABLE = np.full(256, -1, dtype=np.int8)
+for integer in iter_subspecies(True) + iter_combos(True):
+    _ORDINAL_TABLE[integer] = to_ordinal(integer)
+_COLOR_TABLE = np.zeros(256, dtype=np.uint32)
+for integer, color in _COLORS.iteritems():
+    _COLOR_TABLE[integer] = color
+_ORDINAL_COLOR_TABLE = np.array(_ORDINAL_COLORS, dtype=np.uint32)
+
+
+def combine_arrays(proximal_origins, distal_origins):
+    """ Converts arrays of int species to an array of int combinations (broadcasting like any numpy operation)
+    :param proximal_origins: array of ints representing subspecific origins of proximal loci
+    :param distal_origins: array of ints representing subspecific origins of distal loci
+    :return: uint8 array of ints representing the combinations
+    >>> combine_arrays([DOM, CAS], [MUS, UNK]).tolist() == [combine(DOM, MUS), combine(CAS, UNK)]
+    True
+    """
+    return np.left_shift(np.asarray(proximal_origins, dtype=np.uint8), _SHIFT) | \
+        np.asarray(distal_origins, dtype=np.uint8)
+
+
+def to_ordinal_array(integers):
+    """
+    :param integers: array of int representations of subspecies or subspecies combos
+    :return: int8 array of integers in the range 0...num combos/subspecies, -1 where the int is neither
+    >>> to_ordinal_array([MUS, combine(DOM, CAS), 0]).tolist() == [to_ordinal(MUS), to_ordinal(combine(DOM, CAS)), -1]
+    True
+    """
+    return _ORDINAL_TABLE[np.asarray(integers, dtype=np.uint8)]
+
+
+def to_color_array(integers, ordinal=False):
+    """
+    :param integers: array of int representations of subspecies or subspecies combos
+    :param ordinal: if the integers are ordinal representations, default False
+    :return: uint32 array of integers representing rgb colors (0 for combos without a color)
+    >>> to_color_array([combine(DOM, MUS)]).tolist() == [to_color(combine(DOM, MUS))]
+    True
+    >>> to_color_array([to_ordinal(combine(DOM, MUS))], True).tolist() == [to_color(combine(DOM, MUS))]
+    True
+    """
+    if ordinal:
+        return _ORDINAL_COLOR_TABLE[np.asarray(integers, dtype=np.intp)]
+    return _COLOR_TABLE[np.asarray(integers, dtype=np.uint8)]
+
+
+def is_known_mask(combos):
+    """ Checks to see if either origin of each combo is unknown
+    :param combos: array of int representations of origin combinations (or single origins)
+    :return: boolean array, True where neither origin is unknown
+    >>> is_known_mask([combine(DOM, CAS), combine(UNK, CAS), UNK]).tolist()
+    [True, False, False]
+    """
+    return np.bitwise_and(combos, _NONE_NONE) == 0
+
 
 if __name__ == '__main__':
     import doctest
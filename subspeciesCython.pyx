@@ -18,6 +18,8 @@ Purpose: Provide methods for working with subspecies and combinations of subspec
 ...                    print 'Failed'
 """
 
+import numpy as np
+
 cdef int DOM = 0b001
 cdef int MUS = 0b010
 cdef int CAS = 0b100
@@ -217,6 +219,63 @@ cpdef int distal(int combo):
     return combo & _DISTAL_MASK
 
 
+# lookup tables over every 8 bit int, for mapping whole arrays of subspecies or combos at once
+_ORDINAL_TABLE = np.full(256, -1, dtype=np.int8)
+for integer in iter_subspecies(True) + iter_combos(True):
+    _ORDINAL_TABLE[integer] = to_ordinal(integer)
+_COLOR_TABLE = np.zeros(256, dtype=np.uint32)
+for integer, color in _COLORS.iteritems():
+    _COLOR_TABLE[integer] = color
+_ORDINAL_COLOR_TABLE = np.array(_ORDINAL_COLORS, dtype=np.uint32)
+
+
+def combine_arrays(proximal_origins, distal_origins):
+    """ Converts arrays of int species to an array of int combinations (broadcasting like any numpy operation)
+    :param proximal_origins: array of ints representing subspecific origins of proximal loci
+    :param distal_origins: array of ints representing subspecific origins of distal loci
+    :return: uint8 array of ints representing the combinations
+    >>> combine_arrays([DOM, CAS], [MUS, UNK]).tolist() == [combine(DOM, MUS), combine(CAS, UNK)]
+    True
+    """
+    return np.left_shift(np.asarray(proximal_origins, dtype=np.uint8), _SHIFT) | \
+        np.asarray(distal_origins, dtype=np.uint8)
+
+
+def to_ordinal_array(integers):
+    """
+    :param integers: array of int representations of subspecies or subspecies combos
+    :return: int8 array of integers in the range 0...num combos/subspecies, -1 where the int is neither
+    >>> to_ordinal_array([MUS, combine(DOM, CAS), 0]).tolist() == [to_ordinal(MUS), to_ordinal(combine(DOM, CAS)), -1]
+    True
+    """
+    return _ORDINAL_TABLE[np.asarray(integers, dtype=np.uint8)]
+
+
+def to_color_array(integers, ordinal=False):
+    """
+    :param integers: array of int representations of subspecies or subspecies combos
+    :param ordinal: if the integers are ordinal representations, default False
+    :return: uint32 array of integers representing rgb colors (0 for combos without a color)
+    >>> to_color_array([combine(DOM, MUS)]).tolist() == [to_color(combine(DOM, MUS))]
+    True
+    >>> to_color_array([to_ordinal(combine(DOM, MUS))], True).tolist() == [to_color(combine(DOM, MUS))]
+    True
+    """
+    if ordinal:
+        return _ORDINAL_COLOR_TABLE[np.asarray(integers, dtype=np.intp)]
+    return _COLOR_TABLE[np.asarray(integers, dtype=np.uint8)]
+
+
+def is_known_mask(combos):
+    """ Checks to see if either origin of each combo is unknown
+    :param combos: array of int representations of origin combinations (or single origins)
+    :return: boolean array, True where neither origin is unknown
+    >>> is_known_mask([combine(DOM, CAS), combine(UNK, CAS), UNK]).tolist()
+    [True, False, False]
+    """
+    return np.bitwise_and(combos, _NONE_NONE) == 0
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
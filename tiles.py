@@ -0,0 +1,175 @@
+"""
+File: tiles.py
+Purpose: Multi-resolution tiles of query results for the genome by genome view, so that a page loads an overview
+        whose size doesn't depend on the number of results, and fetches detail as it zooms in.
+        Tiles are addressed by (level, proximal chromosome, distal chromosome, x, y), chromosomes counting from 0:
+            level 0     the whole genome as one tile (chromosomes, x and y are 0)
+            level 1     the region of a pair of chromosomes
+            level n     that region split into 2^(n-1) by 2^(n-1) tiles, x and y counting from its start
+        A tile overlapped by at most EXACT_ROWS results holds those results exactly.  Otherwise it is rasterized
+        into TILE_CELLS by TILE_CELLS cells, giving the area of the results of each layer which covers each cell, as
+        a fraction of the cell's area.  Layers are the origin combos of the result.
+        Tiles are columnar.encode() payloads:
+            exact       interval columns, a layer column and any further columns of the result
+            rasterized  x and y cell columns, a layer column and a coverage column
+        with the header of the result and a "tile" entry {"level", "bounds": [x start, x end, y start, y end],
+        "exact", "cells"}.  An exact whole genome tile also has the pair_index column of the result.
+"""
+
+import numpy as np
+import columnar
+import stageTimer
+
+GENOME_TILE = (0, 0, 0, 0, 0)
+EXACT_ROWS = 100000
+TILE_CELLS = 128
+# smallest fraction of a cell reported as covered, above the rounding error of rasterization
+MIN_COVERAGE = 1e-4
+
+
+def check_address(address, num_chroms):
+    """
+    :param address: (level, proximal chromosome, distal chromosome, x, y)
+    :param num_chroms: number of chromosomes
+    :raises: ValueError for a tile outside the genome
+    """
+    if (not isinstance(address, (list, tuple)) or len(address) != 5 or
+            not all(isinstance(i, (int, long, np.integer)) for i in address)):
+        raise ValueError('Tile address must be 5 integers')
+    level, prox_chrom, dist_chrom, x, y = address
+    if level == 0:
+        return
+    split = 1 << max(level - 1, 0)
+    if level < 0 or not (0 <= prox_chrom < num_chroms and 0 <= dist_chrom < num_chroms and
+                         0 <= x < split and 0 <= y < split):
+        raise ValueError('No tile %s' % (tuple(address),))
+
+
+class Pyramid:
+    def __init__(self, columns, header, offsets):
+        """ Makes tiles of a query result as they are asked for
+        :param columns: list of (name, array), as returned by columnar.layout_columns()
+        :param header: header entries, as returned by columnar.layout_columns()
+        :param offsets: genome index at which each chromosome starts, followed by the length of the genome
+        """
+        self.header = header
+        self.colors = header['layers']
+        self.num_chroms = header['chromosomes']
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.columns = [(name, np.asarray(column)) for name, column in columns if name != 'pair_index']
+        self.pair_index = np.asarray(dict(columns)['pair_index'], dtype=np.int64)
+        self._arrays = dict(self.columns)
+        self._tiles = {}
+
+    def pair_rows(self, prox_chrom, dist_chrom):
+        """
+        :return: indices of the rows of a chromosome pair, of every layer
+        """
+        keys = (np.arange(len(self.colors)) * self.num_chroms + prox_chrom) * self.num_chroms + dist_chrom
+        return np.concatenate([np.arange(self.pair_index[key], self.pair_index[key + 1]) for key in keys] or
+                              [np.empty(0, dtype=np.int64)])
+
+    def tile(self, level, prox_chrom, dist_chrom, x, y):
+        """
+        :return: payload of the tile (see module docstring)
+        :raises: ValueError for a tile outside the genome
+        """
+        address = GENOME_TILE if level == 0 else (level, prox_chrom, dist_chrom, x, y)
+        if address not in self._tiles:
+            self._tiles[address] = self._make_tile(*address)
+        return self._tiles[address]
+
+    def bounds(self, level, prox_chrom, dist_chrom, x, y):
+        """
+        :return: genome indices of the x start, x end, y start and y end of a tile
+        :raises: ValueError for a tile outside the genome
+        """
+        check_address((level, prox_chrom, dist_chrom, x, y), self.num_chroms)
+        if level == 0:
+            return 0, int(self.offsets[-1]), 0, int(self.offsets[-1])
+        split = 1 << (level - 1)
+        bounds = []
+        for chrom, position in ((prox_chrom, x), (dist_chrom, y)):
+            start, size = int(self.offsets[chrom]), int(self.offsets[chrom + 1] - self.offsets[chrom])
+            bounds += [start + size * position // split, start + size * (position + 1) // split]
+        return tuple(bounds)
+
+    @stageTimer.timed('tiling')
+    def _make_tile(self, level, prox_chrom, dist_chrom, x, y):
+        bounds = self.bounds(level, prox_chrom, dist_chrom, x, y)
+        x_start, x_end, y_start, y_end = bounds
+        if level == 0:
+            rows = slice(None)
+        else:
+            rows = self.pair_rows(prox_chrom, dist_chrom)
+            arrays = {name: self._arrays[name][rows] for name in columnar.INTERVAL_COLUMNS}
+            rows = rows[(arrays['prox_end'] > x_start) & (arrays['prox_start'] < x_end) &
+                        (arrays['dist_end'] > y_start) & (arrays['dist_start'] < y_end)]
+        arrays = [(name, column[rows]) for name, column in self.columns]
+        tile = {'level': level, 'bounds': bounds}
+        num_rows = len(arrays[0][1])
+        if num_rows <= EXACT_ROWS:
+            tile.update(exact=True, cells=0)
+            if level == 0:
+                # the whole result, so the page can zoom into chromosome pairs without asking for tiles
+                arrays.append(('pair_index', self.pair_index.astype(np.uint32)))
+            return columnar.encode(arrays, tile=tile, **self.header)
+        arrays = dict(arrays)
+        cell_width = float(x_end - x_start) / TILE_CELLS
+        cell_height = float(y_end - y_start) / TILE_CELLS
+        edges = [arrays[name].astype(np.int64) for name in columnar.INTERVAL_COLUMNS]
+        coverage = rasterize([(edges[0] - x_start) / cell_width, (edges[1] - x_start) / cell_width,
+                              (edges[2] - y_start) / cell_height, (edges[3] - y_start) / cell_height],
+                             arrays['layer'], len(self.colors), TILE_CELLS)
+        layers, xs, ys = np.nonzero(coverage >= MIN_COVERAGE)
+        tile.update(exact=False, cells=TILE_CELLS)
+        return columnar.encode([('x', xs.astype(np.uint16)), ('y', ys.astype(np.uint16)),
+                                ('layer', layers.astype(arrays['layer'].dtype)),
+                                ('coverage', coverage[layers, xs, ys].astype(np.float32))], tile=tile, **self.header)
+
+
+def rasterize(rectangles, layers, num_layers, cells):
+    """ Exact area of rectangles covering each cell of a grid.  The area of a rectangle below and left of a point
+    is a sum of products (X - a)(Y - b) over its corners (a, b) below and left of it, with alternating signs.
+    Summing the terms of the expanded products over corners by cell, then cumulatively over cells, gives that area at
+    every grid point at once, and so the area within every cell.  Checked against the overlap of every rectangle and
+    cell, with rectangles reaching past the grid:
+    >>> rng = np.random.RandomState(0)
+    >>> edges = np.sort(rng.uniform(-1, 9, size=(2, 2, 50)), axis=1)
+    >>> layers = rng.randint(3, size=50)
+    >>> def overlaps(starts, ends):
+    ...     return np.clip(np.minimum(ends[:, np.newaxis], np.arange(1, 9)) -
+    ...                    np.maximum(starts[:, np.newaxis], np.arange(8)), 0, None)
+    >>> brute_force = np.zeros((3, 8, 8))
+    >>> for layer, x_overlap, y_overlap in zip(layers, overlaps(*edges[0]), overlaps(*edges[1])):
+    ...     brute_force[layer] += np.outer(x_overlap, y_overlap)
+    >>> np.allclose(rasterize((edges[0, 0], edges[0, 1], edges[1, 0], edges[1, 1]), layers, 3, 8), brute_force)
+    True
+
+    :param rectangles: x starts, x ends, y starts and y ends, in units of cells from the grid's origin
+    :param layers: layer of each rectangle
+    :param num_layers: number of layers
+    :param cells: cells along each side of the grid
+    :return: layers x cells x cells array of covered area, as a fraction of a cell's area
+    """
+    x_starts, x_ends, y_starts, y_ends = [np.clip(np.asarray(edges, dtype=np.float64), 0, cells)
+                                          for edges in rectangles]
+    corners_x = np.concatenate([x_starts, x_ends, x_starts, x_ends])
+    corners_y = np.concatenate([y_starts, y_starts, y_ends, y_ends])
+    signs = np.repeat([1., -1., -1., 1.], len(x_starts))
+    # corners on the far edges of the grid count towards no cell
+    cell_x = np.minimum(corners_x.astype(np.int64), cells)
+    cell_y = np.minimum(corners_y.astype(np.int64), cells)
+    bins = (np.tile(np.asarray(layers, dtype=np.int64), 4) * (cells + 1) + cell_x) * (cells + 1) + cell_y
+    shape = (num_layers, cells + 1, cells + 1)
+    grid_x = np.arange(cells + 1, dtype=np.float64)[:, np.newaxis]
+    grid_y = np.arange(cells + 1, dtype=np.float64)[np.newaxis, :]
+    area = np.zeros(shape)
+    for weights, factor in ((signs, grid_x * grid_y), (-signs * corners_x, grid_y), (-signs * corners_y, grid_x),
+                            (signs * corners_x * corners_y, 1.)):
+        sums = np.bincount(bins, weights, minlength=np.prod(shape)).reshape(shape)
+        # corners strictly below and left of each grid point
+        below_left = np.zeros(shape)
+        below_left[:, 1:, 1:] = sums[:, :-1, :-1].cumsum(axis=1).cumsum(axis=2)
+        area += below_left * factor
+    return np.diff(np.diff(area, axis=1), axis=2)
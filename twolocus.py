@@ -5,6 +5,10 @@ Purpose:
         Treat the genome as a series of intervals, some of which have a known subspecific origin.
         Over subsets of all samples, find the frequency of all pairwise combinations of origins for intervals.
         E.g. find the number of samples that are domesticus at interval A and musculus at interval B
+        The ways of counting are checked against the original count, one strain and interval pair at a time, on the
+        sample files test.csv and test2.csv (see check_counting()) by
+            python -m doctest twolocus.py
+        which also checks that ingesting a database doesn't take more memory for more strains (check_ingest_memory())
 """
 
 import os
@@ -12,17 +16,31 @@ import sys
 import numpy as np
 import csv
 import glob
+import hashlib
 import logging
-# import subspecies
-import pyximport
-
-pyximport.install()
-import subspeciesCython as subspecies
-import pickle
-from scipy import stats
-from time import clock
+import ctypes
+import multiprocessing
+import shutil
+import tempfile
+import multipleTesting
+import stageTimer
+# compiled ahead of time by setup.py, with pure python fallbacks
+try:
+    import subspeciesCython as subspecies
+except ImportError:
+    import subspecies
+try:
+    import kernelsCython as kernels
+except ImportError:
+    import kernels
+import json
+import struct
 from collections import OrderedDict, Counter
 
+# files of the sample dictionary in its directory: the pickled dictionary, and the store mapped into memory
+SAMPLE_DICT_FILE = 'sample_dict.p'
+SAMPLE_STORE_FILE = 'sample_store.bin'
+
 INT_TO_CHROMO = [str(integer) for integer in range(20)] + ['X', 'Y', 'MT']
 # integer representations of chromosomes
 CHROMO_TO_INT = {string: integer for integer, string in enumerate(INT_TO_CHROMO)}
@@ -34,21 +52,61 @@ CHROMO_SIZES = [197195432, 181748087, 159599783, 155630120, 152537259,
                 98319150, 95272651, 90772031, 61342430, 166650296,
                 91744698, 16299]
 
+# ordinal of the combination of every pair of sources, indexed by the source ints themselves.
+# 0 marks an elementary interval which a strain doesn't cover and maps to -1 (not counted)
+_SOURCE_INTS = np.arange(subspecies.UNKNOWN + 1, dtype=np.uint8)
+_ORDINAL_LUT = subspecies.to_ordinal_array(subspecies.combine_arrays(_SOURCE_INTS[:, np.newaxis], _SOURCE_INTS))
+_ORDINAL_LUT[0, :] = _ORDINAL_LUT[:, 0] = -1
+
+# ways of counting the combos of pattern pairs, chosen between by TwoLocus.plan_counting()
+COUNTING_BACKENDS = ('dense', 'gemm', 'out_of_core')
+# bytes of memory counting may take before it goes out of core
+COUNTING_MEMORY = 4 << 30
+# costs of the backends, measured with benchmark.py: seconds per distinct strain and pattern pair of dense counting,
+# per origin pair and pattern pair of taking matrix products, per multiply-add of matrix products, and per byte
+# written out of core.  Bytes per pattern pair of dense counting's temporaries
+DENSE_SECONDS = 2.2e-8
+GEMM_PRODUCT_SECONDS = 6e-9
+GEMM_FLOP_SECONDS = 1.4e-10
+OUT_OF_CORE_BYTE_SECONDS = 1e-9
+DENSE_TEMP_BYTES = 40
+
 
 class TwoLocus:
-    def __init__(self, in_path=None, chrom_sizes=None):
+    def __init__(self, in_path=None, chrom_sizes=None, num_workers=1, counting_memory=COUNTING_MEMORY):
         """ Load a database of pairwise labels for a collection of samples.
         :param in_path: default path to database of pre-computed intervals
+        :param num_workers: number of processes to count with, default 1 (count serially in this process)
+        :param counting_memory: bytes of memory counting may take before it goes out of core (see plan_counting())
         """
         self.path = in_path or os.getcwd()
-        self._sample_dict_path = os.path.join(self.path, 'sample_dict.p')
+        self._sample_dict_path = os.path.join(self.path, SAMPLE_DICT_FILE)
+        self._sample_store_path = os.path.join(self.path, SAMPLE_STORE_FILE)
         if not os.path.exists(self._sample_dict_path):
+            import pickle
             with open(self._sample_dict_path, 'w+') as fp:
                 pickle.dump({}, fp)
-        with open(self._sample_dict_path) as fp:
-            self.sample_dict = pickle.load(fp)
+        with stageTimer.stage('store load'):
+            if _store_is_current(self.path):
+                # arrays are read-only views of one mapping, shared by every process which loads the store
+                self.sample_dict = _load_sample_store(self._sample_store_path)
+                self._breakpoint_index = _load_breakpoint_index(self._sample_store_path, self.sample_dict)
+            else:
+                import pickle
+                with open(self._sample_dict_path) as fp:
+                    self.sample_dict = pickle.load(fp)
+                self._breakpoint_index = None
+                try:
+                    _write_sample_store(self.sample_dict, self._sample_store_path)
+                    self.sample_dict = _load_sample_store(self._sample_store_path)
+                    self._breakpoint_index = _load_breakpoint_index(self._sample_store_path, self.sample_dict)
+                except (IOError, OSError):
+                    pass  # read-only directory, keep the unpickled arrays
         self.sizes = chrom_sizes or CHROMO_SIZES
         self.offsets = np.cumsum([0] + self.sizes, dtype=int)
+        self._haplotypes = {}
+        self.num_workers = num_workers
+        self.counting_memory = counting_memory
 
     def genome_index_to_dict(self, index):
         """ Converts a genome position to a dictionary of chromosome and position
@@ -62,8 +120,10 @@ class TwoLocus:
         """ Saves an updated sample dictionary to disk
         :param new_dict: {sample name: (interval list, origin list)}
         """
+        import pickle
         with open(self._sample_dict_path, 'w+') as fp:
             pickle.dump(self.sample_dict, fp)
+        _write_sample_store(self.sample_dict, self._sample_store_path)
 
     def genome_index(self, chromosome, position):
         """ Converts chromosome and position to a single position in a coordinate system that covers
@@ -128,6 +188,8 @@ class TwoLocus:
             if not bad:
                 print 'good', strain_name
                 self.sample_dict[strain_name] = self.intervals_and_sources(chromosomes)
+                self._haplotypes.pop(strain_name, None)
+                self._breakpoint_index = None
             else:
                 print 'bad', strain_name
         self.save_sample_dict()
@@ -170,6 +232,81 @@ class TwoLocus:
                     intervals.append((subspecies.UNKNOWN, self.sizes[chromosome - 1]))
         return strains
 
+    def ingest_database(self, db=None, strain_names=None):
+        """ Reads subspecific origins straight from the database into the sample store, a batch of whole strains at a
+        time, giving the same intervals and sources as preprocess() would from their csv dumps.  Each batch goes into
+        the store as it is read, so that the panel is never held in memory.  It isn't pickled either: the store,
+        written after the pickled dictionary, supersedes it (see _store_is_current()).
+        :param db: path to SQLite database, default dumpOrigins.MEGA_DB
+        :param strain_names: list of strains to read, default all in the database
+        """
+        import dumpOrigins
+        db = db or dumpOrigins.MEGA_DB
+        strain_names = strain_names if strain_names is not None else dumpOrigins.get_strains(db)
+        writer = _SampleStoreWriter(self._sample_store_path)
+        for rows in dumpOrigins.get_ss_origins(strain_names, db):
+            batch = []
+            for strain_name, arrays in sorted(self.origin_rows_to_arrays(rows).iteritems()):
+                if arrays is not None:
+                    print 'good', strain_name
+                    batch.append((strain_name, arrays))
+                else:
+                    print 'bad', strain_name
+            writer.add(batch)
+        # strains which weren't read keep their arrays, copied a strain at a time from the mapped store
+        ingested = set(writer.names)
+        for strain_name in sorted(self.sample_dict):
+            if strain_name not in ingested:
+                writer.add([(strain_name, self.sample_dict[strain_name])])
+        writer.close()
+        self.sample_dict = _load_sample_store(self._sample_store_path)
+        self._breakpoint_index = _load_breakpoint_index(self._sample_store_path, self.sample_dict)
+        self._haplotypes = {}
+
+    def origin_rows_to_arrays(self, rows):
+        """ Vectorized parse_csvs() followed by intervals_and_sources() for whole strains' rows
+        :param rows: list of (strain, chromosome, start, end, subspecies), each chromosome's in order of position
+        :return: dictionary of {strain name: (array of interval ends, array of sources)}, None for strains with
+        residual heterozygosity
+        """
+        if not rows:
+            return {}
+        names, chromosomes, starts, ends, subspecies_names = zip(*rows)
+        strain_names, strain_codes = np.unique(names, return_inverse=True)
+        chromosome_names, chromosome_codes = np.unique(chromosomes, return_inverse=True)
+        chromosome_ints = np.array([CHROMO_TO_INT[c] for c in chromosome_names])[chromosome_codes]
+        source_names, source_codes = np.unique(subspecies_names, return_inverse=True)
+        source_ints = np.array([subspecies.to_int(s) for s in source_names])[source_codes]
+        # stable, so each chromosome's rows stay in order
+        order = np.lexsort((chromosome_ints, strain_codes))
+        strain_codes, chromosome_ints, source_ints = strain_codes[order], chromosome_ints[order], source_ints[order]
+        starts = np.array(starts, dtype=np.int64)[order]
+        ends = np.array(ends, dtype=np.int64)[order]
+        new_chromosome = np.ones(len(rows), dtype=bool)
+        new_chromosome[1:] = (strain_codes[1:] != strain_codes[:-1]) | (chromosome_ints[1:] != chromosome_ints[:-1])
+        last_ends = np.where(new_chromosome, 0, np.roll(ends, 1))
+        # null interval where there is a gap between intervals with assigned subspecies
+        gaps = ~((starts - 1 <= last_ends) & (last_ends <= starts + 1))
+        slots = np.arange(len(rows)) + np.cumsum(gaps)
+        offsets = self.offsets[chromosome_ints - 1]
+        intervals = np.empty(len(rows) + gaps.sum(), dtype=np.int64)
+        sources = np.empty(len(intervals), dtype=np.int64)
+        intervals[slots] = offsets + ends
+        sources[slots] = source_ints
+        intervals[slots[gaps] - 1] = offsets[gaps] + starts[gaps]
+        sources[slots[gaps] - 1] = subspecies.UNKNOWN
+        # like parse_csvs(), leaves the ends of chromosomes unpadded (its padding compares a tuple with an int)
+        bounds = np.searchsorted(strain_codes, np.arange(len(strain_names) + 1))
+        bounds = np.append(0, slots[bounds[1:] - 1] + 1)
+        arrays = {}
+        for strain_code, strain_name in enumerate(strain_names):
+            strain_sources = sources[bounds[strain_code]:bounds[strain_code + 1]]
+            # TODO: remove stuff about "bad" (residual heterozygosity)
+            arrays[str(strain_name)] = None if np.any(strain_sources == -999) else \
+                (intervals[bounds[strain_code]:bounds[strain_code + 1]].astype(np.uint32),
+                 strain_sources.astype(np.uint8))
+        return arrays
+
     def intervals_and_sources(self, chromosomes):
         """ Converts dictionary to lists of intervals and sources
         :param chromosomes: dictionary of {strain name: {chromosome number: list of (subspecies id, interval end)}}
@@ -187,6 +324,7 @@ class TwoLocus:
         return intervals, sources
 
     @staticmethod
+    @stageTimer.timed('elementary intervals')
     def make_elementary_intervals(interval_lists):
         """ Given a list of lists of interval endpoints, find minimal set of intervals
         which can cover them all without breaking any in two.
@@ -209,61 +347,325 @@ class TwoLocus:
                     i += 1
         return elem_intervals
 
-    # @profile
+    def breakpoint_index(self):
+        """ The distinct interval ends of every strain in the sample dictionary, with each strain's interval ends as
+        indices into them.  Read from the store, or built when the dictionary was loaded or changed otherwise.
+        :return: sorted array of breakpoints, {strain name: array of the index of each of its interval ends}
+        """
+        if self._breakpoint_index is None or self._breakpoint_index[0] is not self.sample_dict:
+            self._breakpoint_index = (self.sample_dict,) + _make_breakpoint_index(self.sample_dict)
+        return self._breakpoint_index[1:]
+
+    @stageTimer.timed('elementary intervals')
+    def elementary_grid(self, strain_names):
+        """ Elementary intervals of a set of strains, compacted from the breakpoint index (see breakpoint_index()) by
+        masking away the breakpoints none of the strains use, so that no intervals are merged or searched
+        :param strain_names: list of strain names
+        :return: elementary intervals, as make_elementary_intervals() finds them from the strains' intervals, list of
+        arrays of the elementary interval ending each interval of each strain
+        :raises: KeyError for an unknown strain
+        """
+        breakpoints, indices = self.breakpoint_index()
+        strain_indices = [indices[strain_name] for strain_name in strain_names]
+        used = np.zeros(len(breakpoints), dtype=bool)
+        for interval_indices in strain_indices:
+            used[interval_indices] = True
+        compacted = np.cumsum(used) - 1
+        return breakpoints[used], [compacted[interval_indices] for interval_indices in strain_indices]
+
+    def haplotype(self, strain_name):
+        """ Splits a strain's intervals at chromosome boundaries and fingerprints each chromosome, so that
+        strains with byte-identical chromosomes can be counted once
+        :param strain_name: name of a strain in the sample dictionary
+        :return: array of indices at which each chromosome's intervals begin (followed by the total number of
+        intervals), list of chromosome digests
+        """
+        try:
+            return self._haplotypes[strain_name]
+        except KeyError:
+            pass
+        intervals, sources = self.sample_dict[strain_name]
+        bounds = np.searchsorted(intervals, self.offsets, side='right')
+        bounds[-1] = len(intervals)
+        digests = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            # the start of a chromosome's first interval is the end of the preceding one
+            # (which wraps around to the last interval for the first chromosome)
+            digest = hashlib.sha1(intervals[lo - 1:lo].tostring() if lo else intervals[-1:].tostring())
+            digest.update(intervals[lo:hi].tostring())
+            digest.update(sources[lo:hi].tostring())
+            digests.append(digest.digest())
+        self._haplotypes[strain_name] = bounds, digests
+        return bounds, digests
+
+    def haplotype_blocks(self, strain_names):
+        """ Groups strains whose haplotypes are identical on both chromosomes of a chromosome pair
+        :param strain_names: list of strain names to analyze
+        :return: list of (proximal chromosome index, distal chromosome index, representative strain, number of
+        strains sharing the representative's haplotypes on that chromosome pair)
+        """
+        haplotypes = [(strain_name,) + self.haplotype(strain_name) for strain_name in strain_names]
+        blocks = []
+        for prox_chrom in xrange(len(self.sizes)):
+            for dist_chrom in xrange(prox_chrom, len(self.sizes)):
+                groups = OrderedDict()
+                for strain_name, bounds, digests in haplotypes:
+                    if bounds[prox_chrom] == bounds[prox_chrom + 1] or bounds[dist_chrom] == bounds[dist_chrom + 1]:
+                        continue  # no intervals on one of the chromosomes
+                    group = groups.setdefault((digests[prox_chrom], digests[dist_chrom]), [strain_name, 0])
+                    group[1] += 1
+                blocks.extend((prox_chrom, dist_chrom, strain_name, weight)
+                              for strain_name, weight in groups.itervalues())
+        return blocks
+
+    def _block_inputs(self, strain_names):
+        """ Lays out the haplotype blocks of a set of strains over one concatenated interval array, which can be
+        shared with worker processes
+        :param strain_names: list of strain names to analyze
+        :return: list of blocks as taken by _count_blocks(), concatenated intervals, concatenated sources,
+        index of each strain's first interval (followed by the total number of intervals)
+        """
+        strain_indices = OrderedDict()
+        blocks = []
+        for prox_chrom, dist_chrom, strain_name, weight in self.haplotype_blocks(strain_names):
+            strain_index = strain_indices.setdefault(strain_name, len(strain_indices))
+            bounds = self.haplotype(strain_name)[0]
+            blocks.append((strain_index, bounds[prox_chrom], bounds[prox_chrom + 1],
+                           bounds[dist_chrom], bounds[dist_chrom + 1], weight))
+        arrays = [self.sample_dict[strain_name] for strain_name in strain_indices]
+        starts = np.cumsum([0] + [len(intervals) for intervals, _ in arrays])
+        intervals = np.concatenate([intervals for intervals, _ in arrays] or [np.empty(0, dtype=np.uint32)])
+        sources = np.concatenate([sources for _, sources in arrays] or [np.empty(0, dtype=np.uint8)])
+        return blocks, intervals, sources, starts
+
+    def _pool(self, **shared_arrays):
+        """ Starts worker processes which share the given arrays
+        :param shared_arrays: arrays in shared memory (see _share()) for the workers to read or write, which
+        they inherit rather than receive pickled with every task
+        :return: multiprocessing pool
+        """
+        return multiprocessing.Pool(self.num_workers, _init_worker, (shared_arrays,))
+
+    @stageTimer.timed('matrix build')
     def build_pairwise_matrix(self, strain_names, elem_intervals):
         # 3d matrix. First index is combo, remaining 2d matrices are counts for pairwise intervals
-        source_counts = np.zeros([(subspecies.NUM_SUBSPECIES + 1) ** 2, len(elem_intervals), len(elem_intervals)],
-                                 dtype=np.int16)
-        for strain_name in strain_names:
-            intervals, sources = self.sample_dict[strain_name]
-            # map this strain's intervals onto the elementary intervals
-            breaks = np.insert(np.searchsorted(elem_intervals, intervals), 0, -1)
-            for row in xrange(len(intervals)):
-                for col in xrange(row, len(intervals)):  # only upper triangle
-                    source = subspecies.combine(sources[row], sources[col])
-                    source_ordinate = subspecies.to_ordinal(source)
-                    source_counts[source_ordinate, breaks[row] + 1:breaks[row + 1] + 1,
-                    breaks[col] + 1:breaks[col + 1] + 1] += 1
-        return source_counts
+        shape = [(subspecies.NUM_SUBSPECIES + 1) ** 2, len(elem_intervals), len(elem_intervals)]
+        blocks, intervals, sources, starts = self._block_inputs(strain_names)
+        elem_intervals = np.asarray(elem_intervals)
+        if self.num_workers <= 1 or len(blocks) < 2:
+            source_counts = np.zeros(shape, dtype=np.int16)
+            _count_blocks(source_counts, blocks, intervals, sources, starts, elem_intervals)
+            return source_counts
+        # each worker counts its share of the blocks into its own slot, then slots are summed pairwise
+        chunks = _split_blocks(blocks, self.num_workers)
+        slots = _shared_zeros([len(chunks)] + shape, np.int16)
+        pool = self._pool(intervals=_share(intervals), sources=_share(sources), starts=_share(starts),
+                          elem_intervals=_share(elem_intervals), source_counts=slots)
+        try:
+            pool.map(_count_blocks_worker, list(enumerate(chunks)))
+            step = 1
+            while step < len(chunks):
+                pool.map(_reduce_slots_worker,
+                         [(slot, slot + step) for slot in xrange(0, len(chunks) - step, 2 * step)])
+                step *= 2
+        finally:
+            pool.close()
+            pool.join()
+        return _shared_view(slots)[0].copy()
 
-    def pairwise_frequencies(self, strain_names):
+    def pairwise_frequencies(self, strain_names, by_chromosome_pair=False):
         """ For every locus pair and every label pair, count the number of strains which have those
         labels at those pairs of loci.
         :param strain_names: list of strain names to analyze (must be a subset of the output from preprocess())
+        :param by_chromosome_pair: True to return the output laid out by group_by_chromosome_pair()
         """
-        output = [[[], [], [], []] for _ in xrange(subspecies.NUM_SUBSPECIES**2)]
-        for strain_name in strain_names:
+        blocks, intervals, sources, starts = self._block_inputs(strain_names)
+        with stageTimer.stage('matrix build'):
+            if self.num_workers <= 1 or len(blocks) < 2:
+                output = _block_frequencies(blocks, intervals, sources, starts)
+            else:
+                pool = self._pool(intervals=_share(intervals), sources=_share(sources), starts=_share(starts))
+                try:
+                    partial_outputs = pool.map(_block_frequencies_worker, _split_blocks(blocks, self.num_workers))
+                finally:
+                    pool.close()
+                    pool.join()
+                output = [[np.concatenate(columns) for columns in zip(*partial_combo_outputs)]
+                          for partial_combo_outputs in zip(*partial_outputs)]
+        colors = [subspecies.to_color(i, True) for i in xrange(subspecies.NUM_SUBSPECIES**2)]
+        if by_chromosome_pair:
+            return self.group_by_chromosome_pair(output, colors)
+        return output, colors
+
+    @stageTimer.timed('patterns')
+    def elementary_patterns(self, strain_names, elem_intervals, breaks=None):
+        """ Groups elementary intervals whose origins are identical across all strains.  Runs of adjacent
+        elementary intervals usually differ only because some strain has a breakpoint elsewhere, so the number
+        of distinct patterns is far smaller than the number of elementary intervals.
+        :param strain_names: list of strain names to analyze
+        :param elem_intervals: elementary intervals induced by (at least) the intervals of strain_names
+        :param breaks: elementary interval ending each interval of each strain, from elementary_grid(), or None to
+        search the strains' intervals for each elementary interval
+        :return: pattern id of every elementary interval, matrix of the origins of each strain (rows) in each
+        pattern (columns), with 0 where a strain doesn't cover the pattern's intervals
+        """
+        origins = np.zeros([len(strain_names), len(elem_intervals)], dtype=np.uint8)
+        for row, strain_name in enumerate(strain_names):
             intervals, sources = self.sample_dict[strain_name]
-            for i in xrange(len(intervals)):
-                # only upper triangle is meaningful
-                if subspecies.is_known(sources[i]):
-                    for j in xrange(i, len(intervals)):
-                        if subspecies.is_known(sources[j]):
-                            combo_output = output[subspecies.to_ordinal(subspecies.combine(sources[i], sources[j]))]
-                            combo_output[0].append(intervals[i-1])
-                            combo_output[1].append(intervals[i])
-                            combo_output[2].append(intervals[j-1])
-                            combo_output[3].append(intervals[j])
-        return output, [subspecies.to_color(i, True) for i in xrange(subspecies.NUM_SUBSPECIES**2)]
-
-    def absent_regions(self, strain_names):
+            if breaks is not None:
+                # an interval covers the elementary intervals after the end of the one before, up to its own end
+                if len(breaks[row]):
+                    origins[row, :breaks[row][-1] + 1] = np.repeat(sources, np.diff(np.append(-1, breaks[row])))
+                continue
+            # index of the strain interval containing each elementary interval
+            covering = np.searchsorted(intervals, elem_intervals)
+            covered = covering < len(intervals)
+            origins[row, covered] = sources[covering[covered]]
+        patterns, pattern_ids = np.unique(origins, return_inverse=True, axis=1)
+        return pattern_ids, patterns
+
+    @staticmethod
+    @stageTimer.timed('matrix build')
+    def build_pattern_matrix(patterns):
+        """ Counts the strains having each combination of origins at each pair of patterns, densely (see
+        count_patterns())
+        :param patterns: matrix of origins of each strain in each pattern, from elementary_patterns()
+        :return: 3d matrix. First index is combo, remaining 2d matrices are counts for pairwise patterns
+        """
+        num_patterns = patterns.shape[1]
+        source_counts = np.zeros([(subspecies.NUM_SUBSPECIES + 1) ** 2, num_patterns, num_patterns],
+                                 dtype=np.int16)
+        if patterns.size:
+            # strains with identical origins in every pattern are counted once
+            _count_dense(source_counts, *np.unique(patterns, return_counts=True, axis=0))
+        return source_counts
+
+    def plan_counting(self, num_strains, num_patterns, num_origins, backend=None):
+        """ Chooses how to count the combos of pattern pairs, as the fastest backend whose estimated memory fits in
+        counting_memory, or out of core if none does:
+            dense           adds each strain's combos at every pattern pair to the counts
+            gemm            takes the matrix product of the strains having each origin in each pattern with those
+                            having each other origin, which is faster for all but a few strains
+            out_of_core     counts densely a stripe of proximal patterns at a time, into a temporary file
+        :param num_strains: number of distinct strains
+        :param num_patterns: number of patterns
+        :param num_origins: number of origins the strains have in the patterns
+        :param backend: one of COUNTING_BACKENDS to use regardless of the estimates, or None to choose
+        :return: backend, {backend: (estimated seconds, estimated bytes)}
+        """
+        cells = num_patterns ** 2
+        counts_bytes = 2 * (subspecies.NUM_SUBSPECIES + 1) ** 2 * cells
+        dense_seconds = DENSE_SECONDS * num_strains * cells
+        stripe_bytes = DENSE_TEMP_BYTES * num_patterns * self._stripe_rows(num_patterns)
+        estimates = {
+            'dense': (dense_seconds, counts_bytes + DENSE_TEMP_BYTES * cells),
+            'gemm': (num_origins ** 2 * (GEMM_PRODUCT_SECONDS + GEMM_FLOP_SECONDS * num_strains) * cells,
+                     counts_bytes + 6 * cells + 4 * (num_origins + 1) * num_strains * num_patterns),
+            'out_of_core': (dense_seconds + OUT_OF_CORE_BYTE_SECONDS * counts_bytes, stripe_bytes)}
+        if backend is None:
+            in_memory = [name for name in ('dense', 'gemm') if estimates[name][1] <= self.counting_memory]
+            backend = min(in_memory, key=lambda name: estimates[name][0]) if in_memory else 'out_of_core'
+        elif backend not in COUNTING_BACKENDS:
+            raise ValueError('Unknown counting backend ' + backend)
+        return backend, estimates
+
+    def _stripe_rows(self, num_patterns):
+        """
+        :return: number of proximal patterns counted at a time out of core
+        """
+        return max(1, min(num_patterns, self.counting_memory // (DENSE_TEMP_BYTES * max(num_patterns, 1))))
+
+    @stageTimer.timed('matrix build')
+    def count_patterns(self, patterns, backend=None):
+        """ Counts the strains having each combination of origins at each pair of patterns, with the backend chosen by
+        plan_counting() from the number of distinct strains, patterns and origins.  The choice is logged, and the
+        backend is timed as a stage of its own.
+        :param patterns: matrix of origins of each strain in each pattern, from elementary_patterns()
+        :param backend: one of COUNTING_BACKENDS, or None to choose
+        :return: 3d matrix. First index is combo, remaining 2d matrices are counts for pairwise patterns
+        :raises: ValueError for an unknown backend
+        """
+        num_patterns = patterns.shape[1]
+        shape = [(subspecies.NUM_SUBSPECIES + 1) ** 2, num_patterns, num_patterns]
+        if not patterns.size:
+            return np.zeros(shape, dtype=np.int16)
+        # strains with identical origins in every pattern are counted once
+        distinct, weights = np.unique(patterns, return_counts=True, axis=0)
+        origins = np.flatnonzero(np.bincount(distinct.reshape(-1), minlength=len(_ORDINAL_LUT))[1:]) + 1
+        backend, estimates = self.plan_counting(len(distinct), num_patterns, len(origins), backend)
+        logging.info('counting %d strains over %d patterns with %s (estimates %s)', len(distinct), num_patterns,
+                     backend, ', '.join('%s %.3gs %.3gMB' % (name, seconds, num_bytes / 1e6)
+                                        for name, (seconds, num_bytes) in sorted(estimates.iteritems())))
+        with stageTimer.stage(backend):
+            if backend == 'out_of_core':
+                with tempfile.TemporaryFile(prefix='twolocus') as fp:
+                    # the file has no name, and its space is freed once the mapping is too
+                    source_counts = np.memmap(fp, dtype=np.int16, mode='w+', shape=tuple(shape))
+                _count_dense(source_counts, distinct, weights, self._stripe_rows(num_patterns))
+                return source_counts
+            source_counts = np.zeros(shape, dtype=np.int16)
+            if backend == 'gemm':
+                _count_gemm(source_counts, distinct, weights, origins)
+            else:
+                _count_dense(source_counts, distinct, weights)
+        return source_counts
+
+    @staticmethod
+    @stageTimer.timed('extraction')
+    def expand_pattern_pairs(pattern_ids, pattern_pairs):
+        """ Finds the elementary interval pairs (upper triangle only) whose pair of patterns is selected
+        :param pattern_ids: pattern id of every elementary interval, from elementary_patterns()
+        :param pattern_pairs: boolean matrix of selected (proximal pattern, distal pattern) pairs
+        :return: proximal elementary interval indices, distal elementary interval indices (in row-major order)
+        """
+        order = np.argsort(pattern_ids, kind='mergesort')
+        starts = np.searchsorted(pattern_ids[order], np.arange(pattern_pairs.shape[0] + 1))
+        rows, cols = [], []
+        for pattern in np.flatnonzero(pattern_pairs.any(axis=1)):
+            prox = order[starts[pattern]:starts[pattern + 1]]
+            dist = np.flatnonzero(pattern_pairs[pattern, pattern_ids])
+            prox, dist = np.meshgrid(prox, dist, indexing='ij')
+            upper = prox <= dist
+            rows.append(prox[upper])
+            cols.append(dist[upper])
+        if not rows:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        order = np.lexsort((cols, rows))
+        return rows[order], cols[order]
+
+    def absent_regions(self, strain_names, by_chromosome_pair=False, backend=None):
         """ finds regions in which no samples have a certain combo
         :param strain_names: list of strain names to analyze (must be a subset of the output from preprocess())
+        :param by_chromosome_pair: True to return the output laid out by group_by_chromosome_pair()
+        :param backend: counting backend (see plan_counting()), or None to choose
         """
-        elem_intervals = self.make_elementary_intervals(
-            [self.sample_dict[sn][0] for sn in strain_names])
-        background = self.build_pairwise_matrix(strain_names, elem_intervals)
+        elem_intervals, breaks = self.elementary_grid(strain_names)
+        pattern_ids, patterns = self.elementary_patterns(strain_names, elem_intervals, breaks)
+        background = self.count_patterns(patterns, backend)
         output = [[[], [], [], []] for _ in xrange(subspecies.NUM_SUBSPECIES**2)]
         for combo in xrange(subspecies.NUM_SUBSPECIES**2):
-            for i in xrange(len(elem_intervals)):
-                for j in xrange(i, len(elem_intervals)):
-                    if not background[combo, i, j]:
-                        output[combo][0].append(elem_intervals[i-1])
-                        output[combo][1].append(elem_intervals[i])
-                        output[combo][2].append(elem_intervals[j-1])
-                        output[combo][3].append(elem_intervals[j])
+            rows, cols = self.expand_pattern_pairs(pattern_ids, background[combo] == 0)
+            output[combo][0].extend(elem_intervals[rows - 1])
+            output[combo][1].extend(elem_intervals[rows])
+            output[combo][2].extend(elem_intervals[cols - 1])
+            output[combo][3].extend(elem_intervals[cols])
+        if by_chromosome_pair:
+            return self.group_by_chromosome_pair(
+                output, [subspecies.to_color(combo, ordinal=True) for combo in xrange(subspecies.NUM_SUBSPECIES**2)])
         return output
 
+    def group_by_chromosome_pair(self, output, colors):
+        """ Lays out the output of a query by chromosome pair (see the module function group_by_chromosome_pair())
+        """
+        return group_by_chromosome_pair(output, colors, self.offsets)
+
+    def chromosome_pair_rows(self, layout, prox_chrom, dist_chrom, combo):
+        """ Rows of a chromosome pair and combo (see the module function chromosome_pair_rows())
+        """
+        return chromosome_pair_rows(layout, prox_chrom, dist_chrom, combo)
+
     def calculate_genomic_area(self, counts, intervals):
         """
         Compute the total genomic 'area' occupied by each combination of subspecies.
@@ -301,21 +703,17 @@ class TwoLocus:
         output = {}
         samples = [[[] for _ in subspecies.iter_subspecies(True)] for _ in subspecies.iter_subspecies(True)]
         key = [subspecies.to_string(s) for s in subspecies.iter_subspecies(True)]
-        for strain_name in strain_names:
-            intervals = self.sample_dict[strain_name][0]
-            sources = self.sample_dict[strain_name][1]
+        located_sources = np.empty([len(strain_names), 2], dtype=np.uint8)
+        for row, strain_name in enumerate(strain_names):
+            intervals, sources = self.sample_dict[strain_name]
             # find interval containing each location
-            i = 0
-            interval_indices = [None, None]
-            for loc_num in xrange(2):
-                while intervals[i] < coords[loc_num]:
-                    i += 1
-                if i > 0:
-                    mins[loc_num] = max(mins[loc_num], intervals[i - 1])
-                maxes[loc_num] = min(maxes[loc_num], intervals[i])
-                interval_indices[loc_num] = i
-            samples[subspecies.to_ordinal(sources[interval_indices[0]])][
-                subspecies.to_ordinal(sources[interval_indices[1]])].append(strain_name)
+            interval_indices = np.searchsorted(intervals, coords)
+            mins = np.maximum(mins, np.where(interval_indices > 0, intervals[interval_indices - 1], 0))
+            maxes = np.minimum(maxes, intervals[interval_indices])
+            located_sources[row] = sources[interval_indices]
+        for strain_name, (prox_ordinal, dist_ordinal) in zip(strain_names,
+                                                              subspecies.to_ordinal_array(located_sources)):
+            samples[prox_ordinal][dist_ordinal].append(strain_name)
         output['Key'] = key
         output['Samples'] = samples
         output['Intervals'] = [
@@ -329,13 +727,16 @@ class TwoLocus:
         :param strain_names: list of strain names to analyze
         :return: elementary intervals, matrix of chi square values, matrix of p values (both upper triangular)
         """
-        combo_count_dict, intervals = self.pairwise_frequencies(strain_names)
+        from scipy import stats
+        intervals = self.elementary_grid(strain_names)[0]
+        # dense counts, indexed by the ordinal of each origin pair
+        combo_count_dict = self.build_pairwise_matrix(strain_names, intervals)
         # convert source_counts to matrix combo_counts
         combo_counts = np.empty([len(intervals), len(intervals), subspecies.NUM_SUBSPECIES ** 2], dtype=np.uint16)
         species_counts = np.zeros([len(intervals), subspecies.NUM_SUBSPECIES])
         for i, prox_species in enumerate(subspecies.iter_subspecies()):
             for j, dist_species in enumerate(subspecies.iter_subspecies()):
-                counts = combo_count_dict[subspecies.combine(prox_species, dist_species)]
+                counts = combo_count_dict[subspecies.to_ordinal(subspecies.combine(prox_species, dist_species))]
                 species_counts[:, i] += np.diag(counts)
                 combo_counts[:, :, i * subspecies.NUM_SUBSPECIES + j] = counts
         # compute expected combo frequencies from source frequencies
@@ -346,29 +747,32 @@ class TwoLocus:
                     np.outer(species_counts[:, i], species_counts[:, j])
         # normalize expectations using the actual total frequency
         sums = np.sum(combo_counts, axis=2)
-        old_settings = np.seterr(invalid='ignore')  # ignore division by 0 errors for intervals with no assigned origin
+        # ignore division by 0 errors for interval pairs with no assigned origins, which expect nothing
+        old_settings = np.seterr(divide='ignore', invalid='ignore')
         for i in xrange(subspecies.NUM_SUBSPECIES ** 2):
             combo_expectations[:, :, i] = np.true_divide(combo_expectations[:, :, i], sums)
         np.seterr(**old_settings)
+        combo_expectations[sums == 0] = 0
         combo_expectations = np.nan_to_num(combo_expectations)
-        # do chi-square test
-        output = []
-        for i in xrange(len(intervals)):
-            # only upper triangle is meaningful
-            for j in xrange(i + 1, len(intervals)):
-                nonzero_expectations = np.where(combo_expectations[i, j])
-                chi_sq, p_value = stats.chisquare(
-                    combo_counts[i, j][nonzero_expectations], combo_expectations[i, j][nonzero_expectations])
-                output.append([
-                        chi_sq,
-                        p_value,
-                        # proximal interval
-                        intervals[i-1],
-                        intervals[i],
-                        # distal interval
-                        intervals[j],
-                        intervals[j-1]
-                        ])
+        with stageTimer.stage('statistics'):
+            # do chi-square test
+            output = []
+            for i in xrange(len(intervals)):
+                # only upper triangle is meaningful
+                for j in xrange(i + 1, len(intervals)):
+                    nonzero_expectations = np.where(combo_expectations[i, j])
+                    chi_sq, p_value = stats.chisquare(
+                        combo_counts[i, j][nonzero_expectations], combo_expectations[i, j][nonzero_expectations])
+                    output.append([
+                            chi_sq,
+                            p_value,
+                            # proximal interval
+                            intervals[i-1],
+                            intervals[i],
+                            # distal interval
+                            intervals[j],
+                            intervals[j-1]
+                            ])
         return output
 
     @staticmethod
@@ -388,46 +792,60 @@ class TwoLocus:
             hi = intervals1[index1]
         return lo, hi
 
-    def not_in_background(self, background_strains, foreground_strains):
+    def not_in_background(self, background_strains, foreground_strains, by_chromosome_pair=False, backend=None):
         """ finds combinations at interval pairs that are present in 1+ fg strains but is absent from the background
         :param background_strains: list of strain names
         :param foreground_strains: list of strain names
+        :param by_chromosome_pair: True to return the output laid out by group_by_chromosome_pair()
+        :param backend: counting backend (see plan_counting()), or None to choose
         :return: json object containing interval pairs
         """
         output = [[[], [], [], [], []] for _ in xrange(subspecies.NUM_SUBSPECIES**2)]
         for strain in foreground_strains:
-            elem_intervals = self.make_elementary_intervals(
-                [self.sample_dict[sn][0] for sn in background_strains + [strain]])
-            background_absent = np.logical_not(self.build_pairwise_matrix(background_strains, elem_intervals))
-            foreground = self.build_pairwise_matrix([strain], elem_intervals)
+            elem_intervals, breaks = self.elementary_grid(background_strains + [strain])
+            pattern_ids, patterns = self.elementary_patterns(background_strains + [strain], elem_intervals, breaks)
+            background_absent = np.logical_not(self.count_patterns(patterns[:-1], backend))
+            foreground = self.count_patterns(patterns[-1:], backend)
             uniquities = np.logical_and(foreground, background_absent)
             for combo in xrange(subspecies.NUM_SUBSPECIES**2):
-                combo_uniquities = np.where(uniquities[combo])
-                for i, j in zip(combo_uniquities[0], combo_uniquities[1]):
-                    output[combo][0].append(elem_intervals[i-1])
-                    output[combo][1].append(elem_intervals[i])
-                    output[combo][2].append(elem_intervals[j-1])
-                    output[combo][3].append(elem_intervals[j])
-                    output[combo][4].append(strain)
-        return output, [subspecies.to_color(combo, ordinal=True) for combo in xrange(subspecies.NUM_SUBSPECIES**2)]
-
-    # @profile
-    def unique_combos(self, background_strains, foreground_strains):
+                rows, cols = self.expand_pattern_pairs(pattern_ids, uniquities[combo])
+                output[combo][0].extend(elem_intervals[rows - 1])
+                output[combo][1].extend(elem_intervals[rows])
+                output[combo][2].extend(elem_intervals[cols - 1])
+                output[combo][3].extend(elem_intervals[cols])
+                output[combo][4].extend([strain] * len(rows))
+        colors = [subspecies.to_color(combo, ordinal=True) for combo in xrange(subspecies.NUM_SUBSPECIES**2)]
+        if by_chromosome_pair:
+            return self.group_by_chromosome_pair(output, colors)
+        return output, colors
+
+    def unique_combos(self, background_strains, foreground_strains, by_chromosome_pair=False, backend=None):
         """ finds combinations at interval pairs that is absent from the background but shared by all foreground samples
         :param background_strains: list of strain names
         :param foreground_strains: list of strain names
+        :param by_chromosome_pair: True to return the output laid out by group_by_chromosome_pair()
+        :param backend: counting backend (see plan_counting()), or None to choose
         :return: json object containing interval pairs
         """
-        elem_intervals = self.make_elementary_intervals(
-            [self.sample_dict[sn][0] for sn in background_strains + foreground_strains])
-        background = self.build_pairwise_matrix(background_strains, elem_intervals)
-        foreground = self.build_pairwise_matrix(foreground_strains, elem_intervals)
+        elem_intervals, breaks = self.elementary_grid(background_strains + foreground_strains)
+        pattern_ids, patterns = self.elementary_patterns(background_strains + foreground_strains, elem_intervals,
+                                                         breaks)
+        background = self.count_patterns(patterns[:len(background_strains)], backend)
+        foreground = self.count_patterns(patterns[len(background_strains):], backend)
         output = []
         uniquities = np.logical_and(foreground == len(foreground_strains), np.logical_not(background))
+        if by_chromosome_pair:
+            combo_outputs = []
+            for combo in xrange(subspecies.NUM_SUBSPECIES**2):
+                rows, cols = self.expand_pattern_pairs(pattern_ids, uniquities[combo])
+                combo_outputs.append([elem_intervals[rows - 1], elem_intervals[rows],
+                                      elem_intervals[cols - 1], elem_intervals[cols]])
+            return self.group_by_chromosome_pair(combo_outputs, [subspecies.to_color(combo, ordinal=True)
+                                                                 for combo in xrange(subspecies.NUM_SUBSPECIES**2)])
         for combo in xrange(subspecies.NUM_SUBSPECIES**2):
-            combo_uniquities = np.where(uniquities[combo])
+            rows, cols = self.expand_pattern_pairs(pattern_ids, uniquities[combo])
             combo_color = subspecies.to_color(combo, ordinal=True)
-            for i, j in zip(combo_uniquities[0], combo_uniquities[1]):
+            for i, j in zip(rows, cols):
                 output.append([
                     # proximal interval start, end
                     elem_intervals[i - 1],
@@ -439,32 +857,508 @@ class TwoLocus:
                 ])
         return output
 
-    def contingency_table(self, dead_strains, live_strains, output_file):
-        elem_intervals = self.make_elementary_intervals(
-            [self.sample_dict[sn][0] for sn in dead_strains + live_strains]
-        )
+    def contingency_table(self, dead_strains, live_strains, output_file, correction='bh', backend=None):
+        """ Tests each pair of elementary intervals and pair of origins for association with the dead strains,
+        writing a row per test, with nan for pairs whose table has an empty row or column
+        :param dead_strains: list of strain names
+        :param live_strains: list of strain names
+        :param output_file: path to csv file
+        :param correction: multiple-testing correction of the p-values (see multipleTesting.py), or None
+        :param backend: counting backend (see plan_counting()), or None to choose
+        """
+        from scipy import stats
+        elem_intervals, breaks = self.elementary_grid(dead_strains + live_strains)
         num_dead = len(dead_strains)
         num_live = len(live_strains)
-        dead_observed = self.build_pairwise_matrix(dead_strains, elem_intervals)
-        live_observed = self.build_pairwise_matrix(live_strains, elem_intervals)
+        pattern_ids, patterns = self.elementary_patterns(dead_strains + live_strains, elem_intervals, breaks)
+        dead_observed = self.count_patterns(patterns[:num_dead], backend)
+        live_observed = self.count_patterns(patterns[num_dead:], backend)
         with open(output_file, 'w+') as fp:
             writer = csv.writer(fp)
             writer.writerow(['Proximal chromosome', 'Proximal start', 'Proximal end',
                              'Distal chromosome', 'Distal start', 'Distal end',
                              'Proximal origin', 'Distal origin', 'chi squared', 'p-value'])
-            elem_intervals.insert(0, 0)
+            elem_intervals = [0] + elem_intervals.tolist()
             for combo in xrange(subspecies.NUM_SUBSPECIES**2):
-                for i in xrange(len(elem_intervals)-1):
-                    for j in xrange(i+1, len(elem_intervals)-1):
-                        if dead_observed[combo, i, j] and live_observed[combo, i, j]:
-                            contingency = np.array([[dead_observed[combo, i, j], live_observed[combo, i, j]],
-                                                    [num_dead-dead_observed[combo, i, j],
-                                                     num_live-live_observed[combo, i, j]]])
-                            chi_squared, p, _, _ = stats.chi2_contingency(contingency)
-                            proximal_pos = self.chrom_and_pos(elem_intervals[i], elem_intervals[i+1])
-                            distal_pos = self.chrom_and_pos(elem_intervals[j], elem_intervals[j+1])
-                            writer.writerow(proximal_pos + distal_pos +
-                                            (subspecies.proximal(combo), subspecies.distal(combo), chi_squared, p))
+                observed = np.logical_and(dead_observed[combo], live_observed[combo])
+                tests = {}  # interval pairs sharing a pattern pair share a test
+                for i, j in zip(*self.expand_pattern_pairs(pattern_ids, observed)):
+                    if i == j:
+                        continue
+                    prox, dist = pattern_ids[i], pattern_ids[j]
+                    if (prox, dist) not in tests:
+                        contingency = np.array([[dead_observed[combo, prox, dist], live_observed[combo, prox, dist]],
+                                                [num_dead-dead_observed[combo, prox, dist],
+                                                 num_live-live_observed[combo, prox, dist]]])
+                        if contingency.sum(axis=0).all() and contingency.sum(axis=1).all():
+                            with stageTimer.stage('statistics'):
+                                tests[prox, dist] = stats.chi2_contingency(contingency)[:2]
+                        else:
+                            # an origin pair every strain has (or none does) expects zero, and goes untested
+                            tests[prox, dist] = (np.nan, np.nan)
+                    chi_squared, p = tests[prox, dist]
+                    proximal_pos = self.chrom_and_pos(elem_intervals[i], elem_intervals[i+1])
+                    distal_pos = self.chrom_and_pos(elem_intervals[j], elem_intervals[j+1])
+                    writer.writerow(proximal_pos + distal_pos +
+                                    (subspecies.proximal(combo), subspecies.distal(combo), chi_squared, p))
+        if correction:
+            with stageTimer.stage('multiple testing'):
+                multipleTesting.correct_csv(output_file, output_file, 'p-value', 'corrected p-value', correction)
+
+
+@stageTimer.timed('layout')
+def group_by_chromosome_pair(output, colors, offsets):
+    """ Lays out the output of a query contiguously by origin combo, proximal chromosome and distal chromosome, so
+    that the rows of a chromosome pair are a slice (see chromosome_pair_rows())
+    :param output: for each combo, lists of proximal starts, proximal ends, distal starts, distal ends and
+    optionally samples
+    :param colors: color of each combo
+    :param offsets: genome index at which each chromosome starts, followed by the length of the genome, as held by
+    TwoLocus and QueryClient
+    :return: {'columns': OrderedDict of arrays over rows ('prox_start', 'prox_end', 'dist_start', 'dist_end' and
+    'sample' if given), 'combo': array of the combo of each row, 'colors': colors, 'chromosomes': number of
+    chromosomes, 'index': first row of each (combo, proximal chromosome, distal chromosome) in row-major order,
+    followed by the number of rows}
+    """
+    names = ['prox_start', 'prox_end', 'dist_start', 'dist_end', 'sample']
+    columns = OrderedDict(
+        (name, np.concatenate([np.asarray(combo_output[column], dtype=object if name == 'sample' else np.int64)
+                               for combo_output in output]))
+        for column, name in enumerate(names[:len(output[0]) if output else 4]))
+    combos = np.repeat(np.arange(len(output)), [len(combo_output[0]) for combo_output in output])
+    num_chroms = len(offsets) - 1
+    keys = ((combos * num_chroms + np.searchsorted(offsets, columns['prox_start'], side='right') - 1) *
+            num_chroms + np.searchsorted(offsets, columns['dist_start'], side='right') - 1)
+    order = np.argsort(keys, kind='mergesort')
+    for name in columns:
+        columns[name] = columns[name][order]
+    return {'columns': columns, 'combo': combos[order], 'colors': colors, 'chromosomes': num_chroms,
+            'index': np.searchsorted(keys[order], np.arange(len(output) * num_chroms ** 2 + 1))}
+
+
+def chromosome_pair_rows(layout, prox_chrom, dist_chrom, combo):
+    """
+    :param layout: output laid out by group_by_chromosome_pair()
+    :param prox_chrom: proximal chromosome index, counting from 0
+    :param dist_chrom: distal chromosome index, counting from 0
+    :param combo: origin combo
+    :return: slice of the rows of the chromosome pair and combo
+    """
+    num_chroms = layout['chromosomes']
+    key = (combo * num_chroms + prox_chrom) * num_chroms + dist_chrom
+    return slice(layout['index'][key], layout['index'][key + 1])
+
+
+def _make_breakpoint_index(sample_dict):
+    """
+    :param sample_dict: {sample name: (interval ends, sources)}
+    :return: sorted array of the distinct interval ends of all samples, {sample name: array of the index of each
+    of its interval ends in them}
+    """
+    names = list(sample_dict)
+    starts = np.cumsum([0] + [len(sample_dict[name][0]) for name in names])
+    breakpoints, indices = np.unique(np.concatenate([sample_dict[name][0] for name in names] or
+                                                    [np.empty(0, dtype=np.uint32)]), return_inverse=True)
+    indices = indices.astype(np.uint32)
+    return breakpoints.astype(np.uint32), {name: indices[start:end]
+                                           for name, start, end in zip(names, starts[:-1], starts[1:])}
+
+
+def _write_sample_store(sample_dict, path):
+    """ Writes the intervals and sources of all samples to a single file which can be memory mapped, replacing
+    any existing store atomically (processes which have mapped it keep their mapping).  The file is a header
+    length (8 bytes), a json header of sample names, the index of each one's first interval and the number of
+    breakpoints, then all interval ends (uint32) followed by all sources (uint8), padded to 4 bytes, then the
+    breakpoint index: the breakpoints (uint32) followed by the index of every interval end in them (uint32).
+    :param sample_dict: {sample name: (interval ends, sources)}
+    :param path: path to store file
+    """
+    writer = _SampleStoreWriter(path)
+    writer.add([(name, sample_dict[name]) for name in sorted(sample_dict)])
+    writer.close()
+
+
+class _SampleStoreWriter:
+    """ Writes a store in the format of _write_sample_store() a batch of samples at a time, holding only the batch
+    and the breakpoints in memory.  Interval ends and sources are spilled to temporary files beside the store and
+    copied in behind the header once every sample has been added.  The breakpoints are the marker positions the
+    samples share, so their number doesn't grow with the number of samples.
+    """
+    # values copied or indexed at a time when the store is written
+    CHUNK = 1 << 16
+
+    def __init__(self, path):
+        """
+        :param path: path to store file
+        """
+        self.path = path
+        self.names = []
+        self.starts = [0]
+        self.breakpoints = np.empty(0, dtype=np.uint32)
+        directory = os.path.dirname(os.path.abspath(path))
+        self._intervals = tempfile.TemporaryFile(dir=directory)
+        self._sources = tempfile.TemporaryFile(dir=directory)
+
+    def add(self, samples):
+        """ Appends a batch of samples to the store
+        :param samples: list of (sample name, (interval ends, sources)), names not added before
+        """
+        for name, (intervals, sources) in samples:
+            np.asarray(intervals, dtype='<u4').tofile(self._intervals)
+            np.asarray(sources, dtype=np.uint8).tofile(self._sources)
+            self.names.append(name)
+            self.starts.append(self.starts[-1] + len(intervals))
+        self.breakpoints = np.unique(np.concatenate(
+            [self.breakpoints] + [np.asarray(intervals, dtype=np.uint32) for _, (intervals, _) in samples]))
+
+    def close(self):
+        """ Writes the header, the samples and their breakpoint index to the store, replacing any existing store
+        atomically
+        """
+        header = json.dumps({'names': self.names, 'starts': self.starts, 'breakpoints': len(self.breakpoints)})
+        header += ' ' * (-(len(header) + 8) % 8)  # align the arrays
+        temp_path = self.path + '.%d.tmp' % os.getpid()
+        with open(temp_path, 'wb') as fp:
+            fp.write(struct.pack('<Q', len(header)))
+            fp.write(header)
+            for spilled in (self._intervals, self._sources):
+                spilled.seek(0)
+                shutil.copyfileobj(spilled, fp, self.CHUNK)
+            fp.write('\0' * (-self.starts[-1] % 4))
+            self.breakpoints.astype('<u4').tofile(fp)
+            # the index of every interval end in the breakpoints, as np.unique() would give it
+            self._intervals.seek(0)
+            for _ in xrange(0, self.starts[-1], self.CHUNK):
+                ends = np.fromfile(self._intervals, dtype='<u4', count=self.CHUNK)
+                np.searchsorted(self.breakpoints, ends).astype('<u4').tofile(fp)
+        self._intervals.close()
+        self._sources.close()
+        os.rename(temp_path, self.path)
+
+
+def _store_is_current(path):
+    """
+    :param path: directory of the sample dictionary
+    :return: True if its store was written since the pickled dictionary was
+    """
+    store_path = os.path.join(path, SAMPLE_STORE_FILE)
+    return os.path.exists(store_path) and \
+        os.path.getmtime(store_path) >= os.path.getmtime(os.path.join(path, SAMPLE_DICT_FILE))
+
+
+def _read_store_header(path):
+    """
+    :param path: path to store file
+    :return: header length, header of a store written by _write_sample_store()
+    """
+    with open(path, 'rb') as fp:
+        header_length, = struct.unpack('<Q', fp.read(8))
+        return header_length, json.loads(fp.read(header_length))
+
+
+def available_strains(path):
+    """ Lists the strains of a sample dictionary from the header of its store, without loading the dictionary or
+    mapping the store, for pages which only offer strains to pick
+    :param path: directory of the sample dictionary
+    :return: list of strain names, or None if it has no current store
+    """
+    try:
+        if not _store_is_current(path):
+            return None
+        return [name.encode('utf-8') for name in _read_store_header(os.path.join(path, SAMPLE_STORE_FILE))[1]['names']]
+    except (IOError, OSError):
+        return None
+
+
+def _load_sample_store(path):
+    """ Maps a store written by _write_sample_store() into memory without reading the arrays
+    :param path: path to store file
+    :return: {sample name: (interval ends, sources)}, read-only views of the mapping
+    """
+    header_length, header = _read_store_header(path)
+    starts = header['starts']
+    if not starts[-1]:
+        return {name.encode('utf-8'): (np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint8))
+                for name in header['names']}
+    intervals = np.memmap(path, dtype='<u4', mode='r', offset=8 + header_length, shape=(starts[-1],))
+    sources = np.memmap(path, dtype=np.uint8, mode='r', offset=8 + header_length + 4 * starts[-1],
+                        shape=(starts[-1],))
+    # plain arrays over the mapping, so that copies and pickles of them are ordinary arrays
+    intervals, sources = intervals.view(np.ndarray), sources.view(np.ndarray)
+    return {name.encode('utf-8'): (intervals[start:end], sources[start:end])
+            for name, start, end in zip(header['names'], starts[:-1], starts[1:])}
+
+
+def _load_breakpoint_index(path, sample_dict):
+    """ Maps the breakpoint index of a store written by _write_sample_store() into memory
+    :param path: path to store file
+    :param sample_dict: sample dictionary loaded from the store
+    :return: (sample_dict, breakpoints, {sample name: indices of its interval ends}) as held by TwoLocus, or None
+    for a store written without a breakpoint index
+    """
+    header_length, header = _read_store_header(path)
+    if 'breakpoints' not in header:
+        return None
+    starts = header['starts']
+    if not starts[-1]:
+        return sample_dict, np.empty(0, dtype=np.uint32), {name.encode('utf-8'): np.empty(0, dtype=np.uint32)
+                                                           for name in header['names']}
+    offset = 8 + header_length + 5 * starts[-1] + (-starts[-1] % 4)
+    breakpoints = np.memmap(path, dtype='<u4', mode='r', offset=offset, shape=(header['breakpoints'],))
+    indices = np.memmap(path, dtype='<u4', mode='r', offset=offset + 4 * header['breakpoints'], shape=(starts[-1],))
+    breakpoints, indices = breakpoints.view(np.ndarray), indices.view(np.ndarray)
+    return sample_dict, breakpoints, {name.encode('utf-8'): indices[start:end]
+                                      for name, start, end in zip(header['names'], starts[:-1], starts[1:])}
+
+
+# arrays shared with pool worker processes, which inherit them when the pool is forked
+_worker_arrays = {}
+
+
+def _share(array):
+    """ Copies an array into shared memory
+    :param array: numpy array
+    :return: (shared buffer, dtype, shape), as taken by _shared_view()
+    """
+    shared = _shared_zeros(array.shape, array.dtype)
+    _shared_view(shared)[...] = array
+    return shared
+
+
+def _shared_zeros(shape, dtype):
+    """ Allocates a zeroed array in shared memory
+    :return: (shared buffer, dtype, shape), as taken by _shared_view()
+    """
+    dtype = np.dtype(dtype)
+    return multiprocessing.RawArray(ctypes.c_byte, max(int(np.prod(shape)) * dtype.itemsize, 1)), dtype, shape
+
+
+def _shared_view(shared):
+    """ Views shared memory as a numpy array without copying
+    :param shared: (shared buffer, dtype, shape)
+    """
+    buf, dtype, shape = shared
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _init_worker(shared_arrays):
+    for name, shared in shared_arrays.iteritems():
+        _worker_arrays[name] = _shared_view(shared)
+
+
+def _split_blocks(blocks, num_chunks):
+    """ Splits blocks into chunks of roughly equal work, largest blocks first
+    :param blocks: list of blocks as taken by _count_blocks()
+    :param num_chunks: maximum number of chunks
+    :return: list of non-empty lists of blocks
+    """
+    chunks = [[] for _ in xrange(min(num_chunks, len(blocks)))]
+    loads = [0] * len(chunks)
+    for block in sorted(blocks, key=lambda b: -(b[2] - b[1]) * (b[4] - b[3])):
+        lightest = loads.index(min(loads))
+        chunks[lightest].append(block)
+        loads[lightest] += (block[2] - block[1]) * (block[4] - block[3])
+    return chunks
+
+
+def _count_blocks(source_counts, blocks, intervals, sources, starts, elem_intervals):
+    """ Adds the source combos of blocks of interval pairs to counts over pairs of elementary intervals
+    :param source_counts: 3d matrix. First index is combo, remaining 2d matrices are counts for pairwise intervals
+    :param blocks: list of (strain index, first proximal interval, end of proximal intervals, first distal
+    interval, end of distal intervals, weight), with interval indices relative to the strain's first interval
+    :param intervals: concatenated interval ends of all strains
+    :param sources: concatenated sources of all strains
+    :param starts: index of each strain's first interval, followed by the total number of intervals
+    :param elem_intervals: elementary intervals
+    """
+    # map every interval onto the elementary intervals
+    interval_breaks = np.searchsorted(elem_intervals, intervals).astype(np.int64)
+    kernels.count_blocks(source_counts, np.array(blocks, dtype=np.int64).reshape(-1, 6), interval_breaks, sources,
+                         starts.astype(np.int64), _ORDINAL_LUT)
+
+
+def _count_dense(source_counts, distinct, weights, stripe_rows=None):
+    """ Adds the combos of each strain at every pair of patterns to the counts, a stripe of proximal patterns at a
+    time
+    :param source_counts: 3d matrix. First index is combo, remaining 2d matrices are counts for pairwise patterns
+    :param distinct: matrix of origins of each distinct strain in each pattern
+    :param weights: number of strains of each distinct strain
+    :param stripe_rows: number of proximal patterns per stripe, default all
+    """
+    num_patterns = source_counts.shape[1]
+    flat_counts = source_counts.reshape(-1)
+    stripe_rows = stripe_rows or num_patterns
+    for lo in xrange(0, num_patterns, stripe_rows):
+        hi = min(lo + stripe_rows, num_patterns)
+        cells = np.arange(lo * num_patterns, hi * num_patterns)
+        for origins, weight in zip(distinct, weights):
+            ordinals = _ORDINAL_LUT[origins[lo:hi, np.newaxis], origins].reshape(-1)
+            covered = ordinals >= 0
+            # every cell gets exactly one combo, so the fancy indices are unique
+            flat_counts[ordinals[covered].astype(int) * num_patterns ** 2 + cells[covered]] += weight
+
+
+def _count_gemm(source_counts, distinct, weights, origins):
+    """ Adds the combos of strains at every pair of patterns to the counts, as matrix products: the count of a pair
+    of origins at a pair of patterns is the weighted number of strains having the one origin in the one pattern and the
+    other in the other.  Products are exact in float32 for fewer than 2^24 strains.
+    :param source_counts: 3d matrix. First index is combo, remaining 2d matrices are counts for pairwise patterns
+    :param distinct: matrix of origins of each distinct strain in each pattern
+    :param weights: number of strains of each distinct strain
+    :param origins: origins the strains have in the patterns (0, not covered, excluded)
+    """
+    having = [(distinct == origin).astype(np.float32) for origin in origins]
+    for proximal, proximal_having in zip(origins, having):
+        weighted = proximal_having.T * weights.astype(np.float32)
+        for distal, distal_having in zip(origins, having):
+            if _ORDINAL_LUT[proximal, distal] >= 0:
+                source_counts[_ORDINAL_LUT[proximal, distal]] += np.dot(weighted, distal_having).astype(np.int16)
+
+
+def _block_frequencies(blocks, intervals, sources, starts):
+    """ Lists the interval pairs of blocks with known origins, by combo
+    :param blocks: list of blocks as taken by _count_blocks()
+    :param intervals: concatenated interval ends of all strains
+    :param sources: concatenated sources of all strains
+    :param starts: index of each strain's first interval, followed by the total number of intervals
+    :return: for each combo, arrays of proximal starts, proximal ends, distal starts and distal ends
+    """
+    # known combos have the lowest ordinals
+    return kernels.block_frequencies(np.array(blocks, dtype=np.int64).reshape(-1, 6), intervals, sources,
+                                     starts.astype(np.int64), _ORDINAL_LUT, subspecies.NUM_SUBSPECIES ** 2)
+
+
+def _count_blocks_worker(task):
+    slot, blocks = task
+    _count_blocks(_worker_arrays['source_counts'][slot], blocks, _worker_arrays['intervals'],
+                  _worker_arrays['sources'], _worker_arrays['starts'], _worker_arrays['elem_intervals'])
+
+
+def _reduce_slots_worker(task):
+    slot, other_slot = task
+    _worker_arrays['source_counts'][slot] += _worker_arrays['source_counts'][other_slot]
+
+
+def _block_frequencies_worker(blocks):
+    return _block_frequencies(blocks, _worker_arrays['intervals'], _worker_arrays['sources'],
+                              _worker_arrays['starts'])
+
+
+def _baseline_pairwise_matrix(sample_dict, strain_names, elem_intervals):
+    """ Counts the origin combos of every pair of elementary intervals (upper triangle only) one strain and one pair
+    of its intervals at a time, as build_pairwise_matrix() originally did
+    :return: 3d matrix. First index is combo, remaining 2d matrices are counts for pairwise intervals
+    """
+    source_counts = np.zeros([(subspecies.NUM_SUBSPECIES + 1) ** 2, len(elem_intervals), len(elem_intervals)],
+                             dtype=np.int16)
+    for strain_name in strain_names:
+        intervals, sources = sample_dict[strain_name]
+        breaks = np.insert(np.searchsorted(elem_intervals, intervals), 0, -1)
+        for row in xrange(len(intervals)):
+            for col in xrange(row, len(intervals)):
+                source_ordinate = subspecies.to_ordinal(subspecies.combine(sources[row], sources[col]))
+                source_counts[source_ordinate, breaks[row] + 1:breaks[row + 1] + 1,
+                              breaks[col] + 1:breaks[col + 1] + 1] += 1
+    return source_counts
+
+
+def check_counting(file_names=('test.csv', 'test2.csv'), chrom_sizes=(20000000, 20000000), num_workers=3):
+    """ Counts the interval pairs of sample files every way there is, and compares the counts with
+    _baseline_pairwise_matrix() over make_elementary_intervals().  Every strain is also loaded under a second name
+    and the first is listed twice, so that identical haplotypes and patterns are counted with weights.  The ways are
+    build_pairwise_matrix() serially and on a pool, and the patterns of elementary_grid() and elementary_patterns()
+    counted by each of COUNTING_BACKENDS (out of core a pattern at a time) and by build_pattern_matrix().  Patterns
+    are compared on the upper triangle, to which queries of them are confined (see expand_pattern_pairs()), as the
+    baseline also counts the mirrored cells of each interval's diagonal block.
+    >>> check_counting()
+    test.csv: 7 strains, 7 elementary intervals, 5 patterns
+    test2.csv: 21 strains, 3 elementary intervals, 3 patterns
+    []
+
+    :param file_names: csv files beside this module, as read by parse_csvs()
+    :param chrom_sizes: chromosome sizes of the files
+    :param num_workers: number of processes of the pool
+    :return: list of (file name, way of counting) whose counts differ
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix='twolocus')
+    mismatches = []
+    try:
+        for file_name in file_names:
+            tl = TwoLocus(work_dir, list(chrom_sizes))
+            # a new dictionary, so that no breakpoint index of the one loaded is used
+            tl.sample_dict = {}
+            for strain_name, chromosomes in tl.parse_csvs([os.path.join(directory, file_name)]).iteritems():
+                tl.sample_dict[strain_name] = tl.sample_dict[strain_name + ' copy'] = \
+                    tl.intervals_and_sources(chromosomes)
+            strain_names = sorted(tl.sample_dict)
+            strain_names.append(strain_names[0])
+            elem_intervals = tl.make_elementary_intervals([tl.sample_dict[name][0] for name in set(strain_names)])
+            baseline = _baseline_pairwise_matrix(tl.sample_dict, strain_names, elem_intervals)
+            grid, breaks = tl.elementary_grid(strain_names)
+            if not np.array_equal(grid, elem_intervals):
+                mismatches.append((file_name, 'elementary_grid'))
+                continue
+            pattern_ids, patterns = tl.elementary_patterns(strain_names, grid, breaks)
+            searched_ids, searched = tl.elementary_patterns(strain_names, elem_intervals)
+            if not (np.array_equal(pattern_ids, searched_ids) and np.array_equal(patterns, searched)):
+                mismatches.append((file_name, 'elementary_patterns'))
+            print '%s: %d strains, %d elementary intervals, %d patterns' % (
+                file_name, len(strain_names), len(elem_intervals), patterns.shape[1])
+            counts = [('build_pairwise_matrix', tl.build_pairwise_matrix(strain_names, elem_intervals))]
+            tl.num_workers = num_workers
+            counts.append(('build_pairwise_matrix on a pool', tl.build_pairwise_matrix(strain_names, elem_intervals)))
+            # every pattern pair's counts spread over its elementary interval pairs
+            expand = (slice(None), pattern_ids[:, np.newaxis], pattern_ids)
+            counts.append(('build_pattern_matrix', np.triu(tl.build_pattern_matrix(patterns)[expand])))
+            tl.counting_memory = 1
+            for backend in COUNTING_BACKENDS:
+                counts.append((backend, np.triu(tl.count_patterns(patterns, backend)[expand])))
+            mismatches.extend((file_name, way) for way, count in counts
+                              if not np.array_equal(count, baseline if way.startswith('build_pairwise_matrix') else
+                                                    np.triu(baseline)))
+    finally:
+        shutil.rmtree(work_dir)
+    return mismatches
+
+
+# ingests the first strains of a database into a directory in a new process, and prints its peak resident memory
+_INGEST_SCRIPT = """
+import os, sys, resource, twolocus, dumpOrigins
+path, db, num_strains = sys.argv[1:]
+sys.stdout = open(os.devnull, 'w')
+twolocus.TwoLocus(path).ingest_database(db, dumpOrigins.get_strains(db)[:int(num_strains)])
+sys.__stdout__.write('%d' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def check_ingest_memory(num_strains=(800, 1600), num_markers=2000):
+    """ Ingests growing panels of a database of random calls (see dumpOrigins.write_fixture()), each in a new process,
+    and compares how much the peak resident memory of the processes grows with how much their stores grow.  Holding
+    the panel in memory, the peak grows several times as much as the store does.
+    >>> check_ingest_memory()
+    True
+
+    :param num_strains: numbers of strains to ingest
+    :param num_markers: number of markers of the database, each starting a new run of origins
+    :return: True if the peak grew by less than the store
+    """
+    import subprocess
+    import dumpOrigins
+    work_dir = tempfile.mkdtemp()
+    try:
+        db = os.path.join(work_dir, 'fixture.db')
+        dumpOrigins.write_fixture(db, ['strain%d' % i for i in xrange(max(num_strains))], num_markers, switch_rate=1)
+        peaks, store_sizes = [], []
+        for num in num_strains:
+            path = os.path.join(work_dir, str(num))
+            os.mkdir(path)
+            peaks.append(1024 * int(subprocess.check_output([sys.executable, '-c', _INGEST_SCRIPT, path, db, str(num)],
+                                                            cwd=os.path.dirname(os.path.abspath(__file__)))))
+            store_sizes.append(os.path.getsize(os.path.join(path, SAMPLE_STORE_FILE)))
+    finally:
+        shutil.rmtree(work_dir)
+    return peaks[-1] - peaks[0] < store_sizes[-1] - store_sizes[0]
 
 
 def main():